@@ -0,0 +1,58 @@
+"""Shadow removal: full-resolution background vs. low-resolution background.
+
+Runs removeShadow on test/阴影.jpg upscaled to several sizes, once with the
+background estimated at full resolution and once with bg_max_side, and
+reports runtime, peak traced memory and PSNR / SSIM of the low-resolution
+mode against the full-resolution result. Run from the project root:
+
+    python -m benchmarks.bench_shadow
+"""
+import os
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+from function_method.DocShadowRemoval import removeShadow
+
+SAMPLE = os.path.join('test', '阴影.jpg')
+
+
+def measure(fn, *args, **kwargs):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, elapsed, peak
+
+
+def main():
+    parser = ArgumentParser(description='benchmark low-resolution shadow background')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 1.0, 2.0, 3.0],
+                        help='resize factors applied to the sample (default 0.5 1 2 3)')
+    parser.add_argument('--bg-max-side', type=int, default=1024,
+                        help='background model size for the low-resolution mode')
+    args = parser.parse_args()
+
+    src = cv2.imdecode(np.fromfile(SAMPLE, np.uint8), cv2.IMREAD_COLOR)
+    print('{:>12}{:>10}{:>10}{:>9}{:>10}{:>10}{:>9}{:>8}'.format(
+        'size', 'full ms', 'low ms', 'speedup', 'full MB', 'low MB', 'PSNR', 'SSIM'))
+    for scale in args.scales:
+        img = cv2.resize(src, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+        full, t_full, m_full = measure(removeShadow, img)
+        low, t_low, m_low = measure(removeShadow, img, bg_max_side=args.bg_max_side)
+        psnr = peak_signal_noise_ratio(full, low)
+        ssim = structural_similarity(cv2.cvtColor(full, cv2.COLOR_BGR2GRAY),
+                                     cv2.cvtColor(low, cv2.COLOR_BGR2GRAY))
+        print('{:>12}{:>10.0f}{:>10.0f}{:>8.2f}x{:>10.1f}{:>10.1f}{:>9.2f}{:>8.3f}'.format(
+            '{}x{}'.format(img.shape[1], img.shape[0]), t_full * 1000, t_low * 1000,
+            t_full / max(t_low, 1e-9), m_full / 2 ** 20, m_low / 2 ** 20, psnr, ssim))
+
+
+if __name__ == '__main__':
+    main()
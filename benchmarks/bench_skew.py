@@ -0,0 +1,92 @@
+"""Skew estimation benchmark: estimate_skew vs. the original estimate_skew_angle.
+
+Run from the project root:
+
+    python -m benchmarks.bench_skew
+"""
+import os
+import time
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+import PIL.Image as Image
+
+from function_method.TextOrientationCorrection import estimate_skew, estimate_skew_angle
+
+SAMPLE = os.path.join('test', '文字方向.jpg')
+ANGLES = (-27.5, -12.0, -4.3, -0.6, 0.0, 0.4, 2.5, 9.7, 18.2, 29.0)
+
+
+def synthetic_page(width=1240, height=1754, seed=0):
+    """A4 at 150 DPI with word-like blocks on regular text lines."""
+    rng = np.random.default_rng(seed)
+    page = np.full((height, width), 255, np.uint8)
+    for y in range(150, height - 150, 46):
+        x = 120
+        while x < width - 160:
+            w = int(rng.integers(20, 110))
+            cv2.rectangle(page, (x, y), (min(x + w, width - 120), y + 16), 0, -1)
+            x += w + int(rng.integers(10, 28))
+    return page
+
+
+def rotate(gray, angle):
+    return np.array(Image.fromarray(gray).rotate(angle, expand=1, fillcolor=255))
+
+
+def timed(fn, *args, repeat=1):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = ArgumentParser(description='benchmark skew estimators')
+    parser.add_argument('--range', type=int, nargs=2, default=[-30, 30],
+                        help='angle search range (default -30 30, as the web uses)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timing repeats for the fast estimator')
+    args = parser.parse_args()
+    angle_range = list(args.range)
+
+    rows = []
+    if os.path.exists(SAMPLE):
+        gray = cv2.imdecode(np.fromfile(SAMPLE, np.uint8), cv2.IMREAD_GRAYSCALE)
+        ref, t_ref = timed(estimate_skew_angle, gray, angle_range)
+        (fast, conf), t_fast = timed(estimate_skew, gray, angle_range, repeat=args.repeat)
+        rows.append((os.path.basename(SAMPLE), None, ref, fast, conf, t_ref, t_fast))
+
+    page = synthetic_page()
+    for applied in ANGLES:
+        gray = rotate(page, applied)
+        ref, t_ref = timed(estimate_skew_angle, gray, angle_range)
+        (fast, conf), t_fast = timed(estimate_skew, gray, angle_range, repeat=args.repeat)
+        # rotating by +a is undone by an estimate of -a
+        rows.append(('synthetic', 0.0 - applied, ref, fast, conf, t_ref, t_fast))
+
+    print('{:<14}{:>9}{:>9}{:>9}{:>7}{:>10}{:>10}{:>9}'.format(
+        'input', 'truth', 'old', 'new', 'conf', 'old ms', 'new ms', 'speedup'))
+    err_ref, err_fast, total_ref, total_fast = [], [], 0.0, 0.0
+    for name, truth, ref, fast, conf, t_ref, t_fast in rows:
+        total_ref += t_ref
+        total_fast += t_fast
+        if truth is not None:
+            err_ref.append(abs(ref - truth))
+            err_fast.append(abs(fast - truth))
+        print('{:<14}{:>9}{:>9.2f}{:>9.2f}{:>7.2f}{:>10.1f}{:>10.1f}{:>8.1f}x'.format(
+            name, '-' if truth is None else '{:.2f}'.format(truth), ref, fast, conf,
+            t_ref * 1000, t_fast * 1000, t_ref / max(t_fast, 1e-9)))
+    if err_ref:
+        print('mean abs error: old {:.3f} deg, new {:.3f} deg'.format(
+            np.mean(err_ref), np.mean(err_fast)))
+    print('total time: old {:.2f} s, new {:.2f} s ({:.1f}x)'.format(
+        total_ref, total_fast, total_ref / max(total_fast, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Benchmark suite: every action and a few pipelines, with regression gates.
+
+Each case runs tasks.process_image_bytes (decode, pipeline, JPEG encode, as
+/process does) on the images in test/ and on synthetic A4 pages at 150, 300
+and 600 DPI. Wall time and CPU time are the median over --repeat runs; peak
+RSS is the process high-water mark during the case (reset before each case
+on Linux). Results are written as JSON and, with --baseline, compared
+against a stored run. Run from the project root:
+
+    python -m benchmarks.bench_suite --output bench.json
+    python -m benchmarks.bench_suite --baseline benchmarks/baseline.json
+    python -m benchmarks.bench_suite --save-baseline benchmarks/baseline.json
+
+The exit status is 1 when a case regresses past its threshold.
+"""
+import glob
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+
+from benchmarks.bench_skew import synthetic_page
+from web import tasks
+
+TEST_DIR = 'test'
+A4_INCHES = (8.27, 11.69)
+DPIS = (150, 300, 600)
+PIPELINES = (
+    'trim|orientation',
+    'orientation|shadow|bleach',
+    'trim|orientation|denoise',
+    'dewarp|shadow|sharpen',
+)
+# metric -> allowed relative increase over the baseline
+THRESHOLDS = {
+    'wall_s': 0.20,
+    'cpu_s': 0.20,
+    'peak_rss_mb': 0.15,
+    'output_bytes': 0.10,
+}
+# absolute slack so that tiny cases do not fail on noise
+MIN_DELTA = {
+    'wall_s': 0.05,
+    'cpu_s': 0.05,
+    'peak_rss_mb': 20.0,
+    'output_bytes': 4096,
+}
+
+
+def a4_page(dpi, seed=0):
+    """Colour A4 scan at ``dpi``: text blocks on tinted paper with a shadow
+    gradient, a slight skew and sensor noise."""
+    w, h = int(A4_INCHES[0] * dpi), int(A4_INCHES[1] * dpi)
+    page = synthetic_page(seed=seed)
+    page = cv2.resize(page, (w, h), interpolation=cv2.INTER_LINEAR)
+    m = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), 1.5, 1.0)
+    page = cv2.warpAffine(page, m, (w, h), borderValue=255)
+    shade = np.linspace(0.65, 1.0, w, dtype=np.float32)[None, :]
+    tint = np.array([0.92, 0.95, 0.97], np.float32)
+    color = page[:, :, None].astype(np.float32) * shade[:, :, None] * tint
+    rng = np.random.default_rng(seed)
+    color += rng.normal(0, 3, size=(h, w, 1)).astype(np.float32)
+    return np.clip(color, 0, 255).astype(np.uint8)
+
+
+def load_inputs(names=None):
+    """(name, encoded bytes) of the test images and synthetic pages."""
+    inputs = []
+    for path in sorted(glob.glob(os.path.join(TEST_DIR, '*'))):
+        if path.lower().endswith(('.jpg', '.jpeg', '.png')):
+            with open(path, 'rb') as f:
+                inputs.append((os.path.basename(path), f.read()))
+    for dpi in DPIS:
+        if names and 'a4-%d' % dpi not in names:
+            continue
+        ok, buf = cv2.imencode('.jpg', a4_page(dpi), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        inputs.append(('a4-%d' % dpi, buf.tobytes()))
+    if names:
+        inputs = [(n, d) for n, d in inputs if n in names]
+    return inputs
+
+
+def _reset_peak_rss():
+    # Linux >= 4.0: "5" resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    # ru_maxrss: KiB on Linux, bytes on macOS; never reset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2.0 ** 20 if sys.platform == 'darwin' else 1024.0)
+
+
+def run_case(data, action, repeat):
+    walls, cpus = [], []
+    _reset_peak_rss()
+    for _ in range(repeat):
+        t0, c0 = time.perf_counter(), time.process_time()
+        out = tasks.process_image_bytes(data, action)
+        walls.append(time.perf_counter() - t0)
+        cpus.append(time.process_time() - c0)
+    return {
+        'wall_s': round(statistics.median(walls), 4),
+        'cpu_s': round(statistics.median(cpus), 4),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'output_bytes': len(out),
+    }
+
+
+def compare(results, baseline, thresholds):
+    """List of (case, metric, old, new) that exceed their threshold."""
+    regressions = []
+    for case, metrics in results.items():
+        old = baseline.get(case)
+        if old is None:
+            continue
+        for metric, limit in thresholds.items():
+            if metric not in old or metric not in metrics:
+                continue
+            delta = metrics[metric] - old[metric]
+            if delta > MIN_DELTA[metric] and delta > limit * old[metric]:
+                regressions.append((case, metric, old[metric], metrics[metric]))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='benchmark all actions and pipelines')
+    parser.add_argument('--actions', nargs='+', default=None,
+                        help='actions or pipelines to run (default: every action and PIPELINES)')
+    parser.add_argument('--inputs', nargs='+', default=None,
+                        help='input names to run, e.g. 阴影.jpg a4-300 (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case')
+    parser.add_argument('--output', default=None, help='write results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare against this JSON file')
+    parser.add_argument('--save-baseline', default=None, help='write results as the new baseline')
+    for metric, limit in THRESHOLDS.items():
+        parser.add_argument('--max-' + metric.replace('_', '-'), dest=metric, type=float, default=limit,
+                            help='allowed relative increase of %s (default %.2f)' % (metric, limit))
+    args = parser.parse_args()
+    # time the pipeline, not step-cache hits on the warm-up run's output
+    tasks.STEP_CACHE = None
+
+    actions = args.actions or list(tasks.get_supported_actions()) + list(PIPELINES)
+    for action in actions:
+        tasks.parse_actions(action)
+    inputs = load_inputs(args.inputs)
+
+    results = {}
+    print('{:<40}{:>10}{:>10}{:>10}{:>12}'.format('case', 'wall s', 'cpu s', 'rss MB', 'out bytes'))
+    for action in actions:
+        for name, data in inputs:
+            case = '%s@%s' % (action, name)
+            try:
+                # one untimed run loads models and warms caches
+                tasks.process_image_bytes(data, action)
+                metrics = run_case(data, action, args.repeat)
+            except Exception as e:
+                results[case] = {'error': str(e)}
+                print('{:<40} error: {}'.format(case, e))
+                continue
+            results[case] = metrics
+            print('{:<40}{:>10.3f}{:>10.3f}{:>10.1f}{:>12}'.format(
+                case, metrics['wall_s'], metrics['cpu_s'], metrics['peak_rss_mb'], metrics['output_bytes']))
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = any('error' in m for m in results.values())
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        thresholds = {metric: getattr(args, metric) for metric in THRESHOLDS}
+        regressions = compare(results, baseline, thresholds)
+        for case, metric, old, new in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(case, metric, old, new))
+        missing = sorted(set(baseline) - set(results))
+        if missing:
+            print('not run (in baseline): ' + ', '.join(missing))
+        print('{} regression(s) against {}'.format(len(regressions), args.baseline))
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
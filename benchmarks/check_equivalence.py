@@ -0,0 +1,307 @@
+"""Numerical equivalence harness: reference vs. candidate kernels.
+
+Runs a reference and a candidate implementation of each kernel side by side
+over a corpus (the images in test/ plus a synthetic page by default) and
+reports max abs diff, PSNR, SSIM, binary mismatch rate, skew-angle delta or
+trim-corner distance, depending on the kernel. A kernel fails when any
+image exceeds one of its tolerances; the exit status is then 1. Kernels
+whose imports fail (e.g. no torch or weights) are reported as skipped.
+
+Run from the project root:
+
+    python -m benchmarks.check_equivalence
+    python -m benchmarks.check_equivalence --kernels sauvola shadow \\
+        --candidate sauvola=my_module:fast_sauvola --tolerance sauvola.binary_mismatch=0.001
+
+A candidate must take the same arguments as the default one it replaces.
+"""
+import glob
+import importlib
+import json
+import os
+import sys
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+from benchmarks.bench_skew import rotate, synthetic_page
+
+
+# ---------------------------------------------------------------------------
+# Wrappers for kernels whose reference / fast paths are not single functions
+
+def dewarp_unwarp_reference(img, bm):
+    from function_method.document_image_dewarping.correct import unwarp
+    import torch
+    bm = torch.from_numpy(bm.transpose(2, 0, 1)[None].copy())
+    return (unwarp(img, bm) * 255).astype(np.uint8)
+
+
+def dewarp_unwarp_remap(img, bm):
+    # the proxy-geometry path: the smoothed map applied with one cv2.remap
+    from function_method.document_image_dewarping.correct import bm_to_numpy
+    from web.pipeline import apply_geometry, grid_transform
+    import torch
+    smooth = bm_to_numpy(torch.from_numpy(bm.transpose(2, 0, 1)[None].copy()))
+    h, w = img.shape[:2]
+    return apply_geometry(img, [grid_transform(smooth, (w, h), 0)])
+
+
+def trim_corners_full(img):
+    from function_method.DocTrimmingEnhancement import doc_trimming_enhancement_corners
+    corners, _ = doc_trimming_enhancement_corners(img, channel_order='BGR')
+    return np.asarray(corners, dtype=np.float64)
+
+
+def trim_corners_proxy(img):
+    from function_method.DocTrimmingEnhancement import doc_trimming_enhancement_corners
+    from web.pipeline import make_proxy
+    proxy, scale = make_proxy(img, 1200)
+    corners, _ = doc_trimming_enhancement_corners(proxy, channel_order='BGR')
+    return np.asarray(corners, dtype=np.float64) / scale
+
+
+def dewarp_bm_full(img):
+    from function_method.document_image_dewarping.correct import bm_to_numpy, predict_bm
+    return bm_to_numpy(predict_bm(img))
+
+
+def dewarp_bm_proxy(img):
+    from function_method.document_image_dewarping.correct import bm_to_numpy, predict_bm
+    from web.pipeline import make_proxy
+    return bm_to_numpy(predict_bm(make_proxy(img, 1200)[0]))
+
+
+def skew_fast(gray, angle_range):
+    from function_method.TextOrientationCorrection import estimate_skew
+    return estimate_skew(gray, angle_range)[0]
+
+
+def docscan_reference(img):
+    from function_method.HandwritingDenoisingBeautifying import docscan_main_reference, get_argument_parser
+    return docscan_main_reference(img, get_argument_parser().parse_args([]))
+
+
+def docscan_fast(img):
+    from function_method.HandwritingDenoisingBeautifying import docscan_main, get_argument_parser
+    return docscan_main(img, get_argument_parser().parse_args([]))
+
+
+def synthetic_bm(h=128, w=128, seed=0):
+    """A smooth page-curl backward map in normalized [-1, 1] coordinates."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[-1:1:h * 1j, -1:1:w * 1j]
+    a, b = rng.uniform(0.03, 0.08, size=2)
+    bx = x * 0.95 + a * np.sin(np.pi * y)
+    by = y * 0.95 + b * x * x
+    return np.stack([bx, by], axis=-1).astype(np.float32)
+
+
+# ---------------------------------------------------------------------------
+# Kernels: reference, candidate, how to build the arguments and compare,
+# and tolerances as metric -> limit (psnr / ssim are minimums, the rest maximums)
+
+KERNELS = {
+    'sauvola': {
+        'reference': 'function_method.DocBleach:sauvola_threshold_reference',
+        'candidate': 'function_method.DocBleach:sauvola_threshold',
+        'args': lambda img: (img,),
+        'compare': 'binary',
+        'tolerance': {'binary_mismatch': 1e-4},
+    },
+    'shadow': {
+        'reference': 'function_method.DocShadowRemoval:removeShadowReference',
+        'candidate': 'function_method.DocShadowRemoval:removeShadow',
+        'args': lambda img: (img,),
+        'compare': 'image',
+        'tolerance': {'max_abs': 0},
+    },
+    'skew': {
+        'reference': 'function_method.TextOrientationCorrection:estimate_skew_angle',
+        'candidate': 'benchmarks.check_equivalence:skew_fast',
+        'args': lambda img: (cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), [-30, 30]),
+        'compare': 'angle',
+        # the reference searches whole degrees and wanders on curved pages
+        'tolerance': {'angle_delta': 2.0},
+    },
+    'docscan': {
+        'reference': 'benchmarks.check_equivalence:docscan_reference',
+        'candidate': 'benchmarks.check_equivalence:docscan_fast',
+        'args': lambda img: (img,),
+        'compare': 'image',
+        # palettes come from different (seeded vs. random) k-means runs
+        'tolerance': {'psnr': 33.0, 'ssim': 0.95},
+    },
+    'unwarp': {
+        'reference': 'benchmarks.check_equivalence:dewarp_unwarp_reference',
+        'candidate': 'benchmarks.check_equivalence:dewarp_unwarp_remap',
+        'args': lambda img: (img, synthetic_bm()),
+        'compare': 'image',
+        'tolerance': {'psnr': 35.0, 'ssim': 0.97},
+    },
+    'trim': {
+        'reference': 'benchmarks.check_equivalence:trim_corners_full',
+        'candidate': 'benchmarks.check_equivalence:trim_corners_proxy',
+        'args': lambda img: (img,),
+        'compare': 'corners',
+        'tolerance': {'corner_rel': 0.01},
+    },
+    'dewarp': {
+        'reference': 'benchmarks.check_equivalence:dewarp_bm_full',
+        'candidate': 'benchmarks.check_equivalence:dewarp_bm_proxy',
+        'args': lambda img: (img,),
+        'compare': 'array',
+        # normalized coordinates: 0.01 is 0.5% of the page
+        'tolerance': {'max_abs': 0.01},
+    },
+}
+MINIMUM_METRICS = ('psnr', 'ssim')
+
+
+def load_function(spec):
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def _gray(img):
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+
+def compare(kind, ref, cand, img):
+    if kind == 'angle':
+        return {'reference': float(ref), 'candidate': float(cand), 'angle_delta': abs(float(ref) - float(cand))}
+    if kind == 'corners':
+        dist = np.sqrt(((np.asarray(ref) - np.asarray(cand)) ** 2).sum(axis=1)).max()
+        diag = float(np.hypot(*img.shape[:2]))
+        return {'corner_px': float(dist), 'corner_rel': float(dist / diag)}
+    ref, cand = np.asarray(ref), np.asarray(cand)
+    if ref.shape != cand.shape:
+        return {'shape_mismatch': 1, 'reference_shape': ref.shape, 'candidate_shape': cand.shape}
+    diff = np.abs(ref.astype(np.float64) - cand.astype(np.float64))
+    out = {'max_abs': float(diff.max()) if diff.size else 0.0}
+    if kind == 'array':
+        out['mean_abs'] = float(diff.mean())
+        return out
+    out['psnr'] = float(peak_signal_noise_ratio(ref, cand, data_range=255)) if out['max_abs'] else float('inf')
+    out['ssim'] = float(structural_similarity(_gray(ref), _gray(cand), data_range=255))
+    if kind == 'binary':
+        out['binary_mismatch'] = float(((ref > 127) != (cand > 127)).mean())
+    return out
+
+
+def violations(metrics, tolerance):
+    bad = []
+    if metrics.get('shape_mismatch'):
+        return ['shape %s != %s' % (metrics['reference_shape'], metrics['candidate_shape'])]
+    for metric, limit in tolerance.items():
+        value = metrics.get(metric)
+        if value is None:
+            continue
+        if metric in MINIMUM_METRICS and value < limit:
+            bad.append('%s %.4g < %.4g' % (metric, value, limit))
+        elif metric not in MINIMUM_METRICS and value > limit:
+            bad.append('%s %.4g > %.4g' % (metric, value, limit))
+    return bad
+
+
+def load_corpus(patterns):
+    corpus = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            if not path.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')):
+                continue
+            img = cv2.imdecode(np.fromfile(path, np.uint8), cv2.IMREAD_COLOR)
+            if img is not None:
+                corpus.append((os.path.basename(path), img))
+    # a page with a known skew, so every kernel also sees clean text lines
+    page = cv2.cvtColor(rotate(synthetic_page(), 3.5), cv2.COLOR_GRAY2BGR)
+    corpus.append(('synthetic', page))
+    return corpus
+
+
+def run_kernel(name, kernel, corpus):
+    try:
+        reference = load_function(kernel['reference'])
+        candidate = load_function(kernel['candidate'])
+    except Exception as e:
+        return {'status': 'skipped', 'reason': '%s: %s' % (type(e).__name__, e)}
+    images, worst, failed = {}, {}, False
+    for image_name, img in corpus:
+        try:
+            args = kernel['args'](img)
+            metrics = compare(kernel['compare'], reference(*args), candidate(*args), img)
+        except Exception as e:
+            if isinstance(e, (ImportError, FileNotFoundError)):
+                return {'status': 'skipped', 'reason': '%s: %s' % (type(e).__name__, e)}
+            images[image_name] = {'error': '%s: %s' % (type(e).__name__, e)}
+            failed = True
+            continue
+        bad = violations(metrics, kernel['tolerance'])
+        metrics['violations'] = bad
+        failed = failed or bool(bad)
+        images[image_name] = metrics
+        for metric in kernel['tolerance']:
+            if metric in metrics:
+                pick = min if metric in MINIMUM_METRICS else max
+                worst[metric] = pick(worst.get(metric, metrics[metric]), metrics[metric])
+    return {
+        'status': 'fail' if failed else 'pass',
+        'reference': kernel['reference'],
+        'candidate': kernel['candidate'],
+        'tolerance': kernel['tolerance'],
+        'worst': worst,
+        'images': images,
+    }
+
+
+def main():
+    parser = ArgumentParser(description='compare candidate kernels against their references')
+    parser.add_argument('--kernels', nargs='+', default=list(KERNELS), choices=list(KERNELS))
+    parser.add_argument('--corpus', nargs='+', default=[os.path.join('test', '*')],
+                        help='image globs (default test/*); a synthetic page is always added')
+    parser.add_argument('--reference', nargs='+', default=[], metavar='KERNEL=MODULE:FUNC')
+    parser.add_argument('--candidate', nargs='+', default=[], metavar='KERNEL=MODULE:FUNC')
+    parser.add_argument('--tolerance', nargs='+', default=[], metavar='KERNEL.METRIC=VALUE')
+    parser.add_argument('--json', default=None, help='write the full report to this file')
+    args = parser.parse_args()
+    # kernels load lazily; any that go through web.tasks must compute every
+    # step rather than return a cached one
+    os.environ['STEP_CACHE_MB'] = '0'
+
+    kernels = {name: dict(KERNELS[name], tolerance=dict(KERNELS[name]['tolerance'])) for name in args.kernels}
+    for role in ('reference', 'candidate'):
+        for item in getattr(args, role):
+            name, _, spec = item.partition('=')
+            if name in kernels:
+                kernels[name][role] = spec
+    for item in args.tolerance:
+        key, _, value = item.partition('=')
+        name, _, metric = key.partition('.')
+        if name in kernels:
+            kernels[name]['tolerance'][metric] = float(value)
+
+    corpus = load_corpus(args.corpus)
+    report = {}
+    for name, kernel in kernels.items():
+        result = run_kernel(name, kernel, corpus)
+        report[name] = result
+        if result['status'] == 'skipped':
+            print('{:<10} skipped ({})'.format(name, result['reason']))
+            continue
+        worst = ', '.join('%s=%.4g' % kv for kv in sorted(result['worst'].items()))
+        print('{:<10} {:<5} worst: {}'.format(name, result['status'].upper(), worst))
+        for image_name, metrics in result['images'].items():
+            problems = metrics.get('violations') or ([metrics['error']] if 'error' in metrics else [])
+            if problems:
+                print('    {}: {}'.format(image_name, '; '.join(problems)))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    sys.exit(1 if any(r['status'] == 'fail' for r in report.values()) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,77 @@
 import cv2
 import numpy as np
 
-def sauvola_threshold(image, window_size=15, k=0.2, r=128):
+from function_method.TileScheduler import run_tiles
+
+# 每个条带的行数；条带之间并行处理
+BAND_ROWS = 256
+
+
+def _sauvola(gray, window_size, k, r):
+    """对一个条带计算 Sauvola 阈值（float64 积分图，O(1)/像素）"""
+    h, w = gray.shape
+    top, bottom = window_size // 2, window_size - 1 - window_size // 2
+    # 按 cv2.blur 的默认方式（REFLECT_101）补边
+    band = cv2.copyMakeBorder(gray, top, bottom, top, bottom, cv2.BORDER_REFLECT_101)
+    isum, isqsum = cv2.integral2(band, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+    n = float(window_size * window_size)
+    def window(img):
+        return (img[window_size:window_size + h, window_size:window_size + w]
+                - img[:h, window_size:window_size + w]
+                - img[window_size:window_size + h, :w]
+                + img[:h, :w])
+
+    mean = window(isum) / n
+    var = window(isqsum) / n - mean * mean
+    np.maximum(var, 0, out=var)
+    # threshold = mean * (1 + k * (std / r - 1))
+    threshold = np.sqrt(var, out=var)
+    threshold *= k / r
+    threshold += 1 - k
+    threshold *= mean
+    out = np.greater(gray, threshold).view(np.uint8)
+    out *= 255
+    return out
+
+
+def sauvola_threshold(image, window_size=15, k=0.2, r=128, out=None, band_rows=BAND_ROWS, workers=None):
     # 将图像转换为灰度图
     if len(image.shape) > 2:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     else:
         gray = image
+    if gray.dtype != np.uint8:
+        gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    if window_size < 1:
+        raise ValueError("window_size must be >= 1")
 
-    # 计算图像的平均值和标准差
-    mean = cv2.blur(gray, (window_size, window_size))
-    mean_square = cv2.blur(gray * gray, (window_size, window_size))
-    std = np.sqrt(mean_square - mean * mean)
+    # 结果直接写入预分配的输出缓冲区
+    if out is None:
+        out = np.empty_like(gray)
+    elif out.shape != gray.shape or out.dtype != np.uint8:
+        raise ValueError("out must be a uint8 array with the image's height and width")
 
-    # 计算阈值
-    threshold = mean * (1 + k * (std / r - 1))
+    # 按行条带切分，条带带上窗口半径的邻域
+    run_tiles(lambda band: _sauvola(band, window_size, k, r), gray, halo=window_size // 2,
+              out=out, rows=band_rows, workers=workers)
+
+    return out
 
-    # 阈值化图像
+
+def sauvola_threshold_reference(image, window_size=15, k=0.2, r=128):
+    # 整图 float64 计算的参考实现，用于校验 sauvola_threshold
+    if len(image.shape) > 2:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = image
+    if gray.dtype != np.uint8:
+        gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    g = gray.astype(np.float64)
+    mean = cv2.blur(g, (window_size, window_size))
+    mean_square = cv2.blur(g * g, (window_size, window_size))
+    std = np.sqrt(np.maximum(mean_square - mean * mean, 0))
+    threshold = mean * (1 + k * (std / r - 1))
     binary = np.zeros_like(gray)
     binary[gray > threshold] = 255
-
     return binary
-
-
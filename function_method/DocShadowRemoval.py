@@ -1,9 +1,12 @@
+import cv2
 import numpy as np
 from scipy import ndimage
 import matplotlib.image as mpimg
 from skimage import color
 from skimage.filters import threshold_otsu
 
+from function_method.TileScheduler import run_tiles
+
 
 def read_img(filename, isRGB=False):
   img = mpimg.imread(filename)
@@ -81,12 +84,122 @@ def fineTune(img, L, G, final):
   if len(img.shape) == 3: tuned = tuned.astype(np.uint8)
   return tuned
 
-def removeShadow(img):
-  img = img[:,:,::-1]
+def removeShadowReference(img):
+  # original float64 implementation, kept for comparison with removeShadow
   L = get_LocalBG(img, 13) # get the local background color
   G = get_GlobalBG(L) # get the global background color
   final = get_FinalImg(img, L, G) # show the input vs output
   # mpimg.imsave(r'E:\pycharm project\DocImgTool\test.jpg', final)
   # tuned = fineTune(img, L, G, final) # show effects of tuning
-  final = final[:, :, ::-1]
   return final
+
+
+# ---------------------------------------------------------------------------
+# Memory-lean engine: uint8 max filter, scalar global background and one
+# lookup per pixel for the relighting. Same output as removeShadowReference.
+
+HIST_BAND_PIXELS = 1 << 22  # cv2.calcHist counts in float32, exact below 2**24
+
+def lean_LocalBG(img, kernel_size=5):
+  # max filter == dilation with a rectangle; the border handling of
+  # ndimage.maximum_filter (reflect) cannot change a maximum
+  kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+  return cv2.dilate(img, kernel)
+
+def _hist(plane):
+  rows = max(1, HIST_BAND_PIXELS // max(plane.shape[1], 1))
+  counts = np.zeros(256, dtype=np.int64)
+  for y in range(0, plane.shape[0], rows):
+    band = np.ascontiguousarray(plane[y:y + rows])
+    counts += cv2.calcHist([band], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+  return counts
+
+def lean_GlobalBG(plane):
+  # mean of the unshadowed (above Otsu) local background, as a scalar
+  counts = _hist(plane)
+  values = np.nonzero(counts)[0]
+  lo, hi = values[0], values[-1]
+  if lo == hi:
+    thresh = lo
+  else:
+    thresh = threshold_otsu(hist=(counts[lo:hi + 1], np.arange(lo, hi + 1)))
+  above = np.arange(256) > thresh
+  n = counts[above].sum()
+  if n == 0:
+    # flat background: nothing to relight
+    return float(hi)
+  return (counts[above] * np.arange(256)[above]).sum() / float(n)
+
+def relight_lut(G):
+  """lut[L, v] == uint8(G / L * v), evaluated exactly as get_FinalImg does.
+
+  With a full-resolution L the pixel never exceeds its local background, so
+  the result is at most G; an upsampled background (see removeShadow with
+  bg_max_side) can fall below a pixel, hence the clip to 255.
+  """
+  with np.errstate(divide='ignore', invalid='ignore'):
+    r = G / np.arange(256, dtype=np.float64)
+    lut = r[:, None] * np.arange(256, dtype=np.float64)[None, :]
+  # 0 / 0 is NaN -> 0, as the reference casts it; v / 0 saturates
+  lut = np.nan_to_num(np.minimum(lut, 255))
+  return lut.astype(np.uint8).ravel()
+
+def relight(plane, L, G):
+  idx = L.astype(np.uint16)
+  idx <<= 8
+  idx |= plane
+  return relight_lut(G)[idx]
+
+def lowres_LocalBG(img, kernel_size, max_side):
+  """Local background estimated on a copy whose longer side is about
+  ``max_side``; returned at that small size."""
+  h, w = img.shape[:2]
+  f = int(np.ceil(max(h, w) / float(max_side)))
+  # block maximum (dilate by f, sample every f pixels) keeps the paper
+  # brightness that area averaging would lose next to text
+  small = lean_LocalBG(img, f)[f // 2::f, f // 2::f]
+  small = lean_LocalBG(small, max(1, int(round(kernel_size / float(f)))))
+  return cv2.blur(small, (3, 3))
+
+def _relight_all(img, L, G):
+  if len(img.shape) == 2:
+    return relight(img, L, G[0])
+  out = np.empty(img.shape, dtype=np.uint8)
+  for i in range(img.shape[2]):
+    out[:,:,i] = relight(img[:,:,i], L[:,:,i], G[i])
+  return out
+
+def removeShadow(img, kernel_size=13, bg_max_side=0, workers=None):
+  """Shadow removal; with ``bg_max_side`` > 0 the background model is
+  estimated on an image whose longer side is about that size and only the
+  relighting runs at full resolution. The local filters run in parallel
+  bands (see TileScheduler.run_tiles) on ``workers`` threads."""
+  # purely per-channel: works on BGR or RGB input and keeps the channel order
+  if bg_max_side and max(img.shape[:2]) > bg_max_side:
+    return removeShadowLowRes(img, kernel_size, bg_max_side)
+  # get the local background color; bands overlap by the kernel radius
+  L = run_tiles(lambda band: lean_LocalBG(band, kernel_size), img,
+                halo=kernel_size // 2, workers=workers)
+  if len(img.shape) == 2:
+    G = [lean_GlobalBG(L)]
+  else:
+    # int(): the reference stores G as an integer array per channel
+    G = [int(lean_GlobalBG(L[:,:,i])) for i in range(img.shape[2])]
+  return run_tiles(lambda band, bg: _relight_all(band, bg, G), (img, L), workers=workers)
+
+def removeShadowLowRes(img, kernel_size=13, max_side=1024):
+  # The background model (local max and global level) comes from a small
+  # image and is upsampled one channel at a time, so only the relighting
+  # touches every pixel. The result is approximate anyway, so cv2.divide
+  # (rounding, saturating, 0 where L == 0) replaces the exact lookup table.
+  h, w = img.shape[:2]
+  small = lowres_LocalBG(img, kernel_size, max_side)
+  if len(img.shape) == 2:
+    L = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    return cv2.divide(img, L, scale=lean_GlobalBG(small))
+  out = np.empty(img.shape, dtype=np.uint8)
+  for i in range(img.shape[2]):
+    G = int(lean_GlobalBG(small[:,:,i]))
+    L = cv2.resize(small[:,:,i], (w, h), interpolation=cv2.INTER_LINEAR)
+    out[:,:,i] = cv2.divide(cv2.extractChannel(img, i), L, scale=G)
+  return out
@@ -1,12 +1,47 @@
 import cv2
+import math
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from function_method.TileScheduler import run_tiles
 
 model_path = './weights/image_sharpening'
-model_path = os.path.join(model_path, 'espcn_x3.pb')
 name = 'espcn'
 scale = 3
 
-def img_enh(img, type='usm'):
+# ESPCN 模型按放大倍数命名，x2 / x4 权重放入同一目录即可启用
+SCALES = (2, 3, 4)
+# 输出像素上限（约 A4 600 DPI）；超过时选更小的倍数或不放大
+MAX_OUTPUT_PIXELS = 40_000_000
+# 每块的输入边长（像素）
+TILE_SIZE = 512
+# ESPCN 感受野半径（5x5 + 3x3 + 3x3 卷积）及色度双三次插值的输入像素数
+SR_RADIUS = 4
+# img_enh 在输出图上的邻域半径：GaussianBlur(sigma=5) 对 uint8 取 31x31 核
+ENH_RADIUS = {'usm': 15, 'sobel': 2}
+# 分块超分辨率的常驻线程数
+WORKERS = min(4, os.cpu_count() or 1)
+
+
+def _model_file(s):
+    for fname in ('ESPCN_x%d.pb' % s, 'espcn_x%d.pb' % s):
+        path = os.path.join(model_path, fname)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def available_scales():
+    return [s for s in SCALES if _model_file(s) is not None]
+
+
+def img_enh(img, type='usm', workers=1):
+    if workers != 1:
+        # 按条带并行，条带带上滤波核半径的邻域
+        return run_tiles(lambda band: img_enh(band, type), img, halo=ENH_RADIUS[type], workers=workers)
     if type == 'usm':
         blur_img = cv2.GaussianBlur(img, (0, 0), 5)
         sharp_img = cv2.addWeighted(img, 1.5, blur_img, -0.5, 0)
@@ -15,14 +50,67 @@ def img_enh(img, type='usm'):
         sharp_img = cv2.Sobel(blur_img, cv2.CV_8U, 1, 0, ksize=3)
     return sharp_img
 
-def load_model():
-    print('init and load doc sharpening model...')
+def load_model(scale=scale):
+    print('init and load doc sharpening model (x%d)...' % scale)
     model = cv2.dnn_superres.DnnSuperResImpl_create()
-    model.readModel(model_path)
+    model.readModel(_model_file(scale) or os.path.join(model_path, 'ESPCN_x%d.pb' % scale))
     model.setModel(name, scale)
     return model
 
-def doc_sharpening_pred(image):
+
+# dnn 网络不能被多个线程同时使用，每个线程各持有一份模型；
+# 分块在常驻线程池里运行，模型每个线程只加载一次，所有请求共用
+_local = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='sharpen')
+        return _pool
+
+def _get_model(s):
+    models = getattr(_local, 'models', None)
+    if models is None:
+        models = _local.models = {}
+    if s not in models:
+        models[s] = doc_sharpening_model if s == scale and threading.current_thread() is threading.main_thread() \
+            else load_model(s)
+    return models[s]
+
+
+def choose_scale(h, w, max_output_pixels=MAX_OUTPUT_PIXELS, dpi=0, target_dpi=0):
+    '''
+    选择放大倍数：默认 x3；给出 dpi 与 target_dpi 时取不小于 target_dpi / dpi 的最小可用倍数。
+    输出超过 max_output_pixels 时退到更小的倍数，都放不下则返回 1（不放大）；上限不能超过 MAX_OUTPUT_PIXELS。
+    '''
+    wanted = float(target_dpi) / dpi if dpi and target_dpi else scale
+    if wanted <= 1:
+        return 1
+    max_output_pixels = min(max_output_pixels, MAX_OUTPUT_PIXELS)
+    fits = [s for s in available_scales() if h * w * s * s <= max_output_pixels]
+    if not fits:
+        return 1
+    larger = [s for s in fits if s >= wanted - 1e-6]
+    return min(larger) if larger else max(fits)
+
+
+def _upsample_enh(patch, s, enh):
+    up = _get_model(s).upsample(np.ascontiguousarray(patch)) if s > 1 else patch
+    return img_enh(up, enh) if enh else up
+
+
+def doc_sharpening_pred(image, enh=None, max_output_pixels=MAX_OUTPUT_PIXELS, dpi=0, target_dpi=0,
+                        tile_size=TILE_SIZE, workers=None):
+    '''
+    分块超分辨率：每块带 halo 重叠边（覆盖网络感受野和 img_enh 的邻域），结果与整图处理一致；
+    enh 为 'usm' / 'sobel' 时在每块上直接做 img_enh，避免在放大后的整图上再分配多份缓冲。
+    内存占用为输入 + 输出 + 每个线程一块。
+    分块默认在模块的常驻线程池（WORKERS 个线程）中运行；workers=1 时在调用线程中依次处理。
+    '''
     # ensure image has 3 channels (dnn_superres does not support 4-channel images)
     if image is None:
         return image
@@ -30,9 +118,15 @@ def doc_sharpening_pred(image):
         image = image[:, :, :3]
     if image.dtype != 'uint8':
         image = image.astype('uint8')
-    result = doc_sharpening_model.upsample(image)
-    return result
-
-doc_sharpening_model = load_model()
+    h, w = image.shape[:2]
+    s = choose_scale(h, w, max_output_pixels, dpi, target_dpi)
+    if s == 1 and not enh:
+        return image
 
+    halo = (SR_RADIUS if s > 1 else 0) + (int(math.ceil(ENH_RADIUS[enh] / float(s))) if enh else 0)
+    pool = None if workers == 1 else _get_pool()
+    out = run_tiles(lambda patch: _upsample_enh(patch, s, enh), image, halo=halo,
+                    rows=tile_size, cols=tile_size, scale=s, workers=workers or WORKERS, pool=pool)
+    return out
 
+doc_sharpening_model = load_model()
@@ -55,11 +55,18 @@ def load_model(num_classes=2, model_name="mbv3", checkpoint_path=None):
     model.eval()
     return model
 
-def doc_trimming_enhancement_pred(image, image_size=384, BUFFER=10):
+def doc_trimming_enhancement_corners(image, image_size=384, BUFFER=10, channel_order='RGB'):
+    """Predict the ordered page corners (tl, tr, br, bl) in ``image`` pixel
+    coordinates, plus the (left, top, right, bottom) zero padding the warp
+    needs when the page box reaches outside the image."""
+    # The segmentation model expects RGB; only the small resized copy is
+    # flipped, the input itself is never converted.
     IMAGE_SIZE = image_size
     half = IMAGE_SIZE // 2
-    imH, imW, C = image.shape
+    imH, imW = image.shape[:2]
     image_resize = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE), interpolation=cv2.INTER_NEAREST)
+    if channel_order == 'BGR':
+        image_resize = cv2.cvtColor(image_resize, cv2.COLOR_BGR2RGB)
 
     scale_x = imW / IMAGE_SIZE
     scale_y = imH / IMAGE_SIZE
@@ -107,10 +114,10 @@ def doc_trimming_enhancement_pred(image, image_size=384, BUFFER=10):
 
 
     # check if corners are inside.if not find smallest enclosing box, expand_image then extract document else extract document
+    left_pad, top_pad, right_pad, bottom_pad = 0, 0, 0, 0
 
     if not (np.all(corners.min(axis=0) >= (0, 0)) and np.all(corners.max(axis=0) <= (imW, imH))):
         print('enter check...')
-        left_pad, top_pad, right_pad, bottom_pad = 0, 0, 0, 0
         # 获取最小外接矩阵
         rect = cv2.minAreaRect(corners.reshape((-1, 1, 2)))
         # 获取矩形四个顶点
@@ -136,6 +143,27 @@ def doc_trimming_enhancement_pred(image, image_size=384, BUFFER=10):
         if box_y_max >= imH:
             bottom_pad = (box_y_max - imH) + BUFFER
 
+        corners = box_corners
+
+    # ordering only depends on relative positions, so it is the same before
+    # and after shifting by the padding
+    corners = sorted(corners.tolist())
+    corners = order_points(corners)
+    return corners, (left_pad, top_pad, right_pad, bottom_pad)
+
+def perspective_from_corners(corners):
+    """Forward perspective matrix and output (w, h) for ordered corners."""
+    destination_corners = find_dest(corners)
+    M = cv2.getPerspectiveTransform(np.float32(corners), np.float32(destination_corners))
+    return M, (destination_corners[2][0], destination_corners[2][1])
+
+def doc_trimming_enhancement_pred(image, image_size=384, BUFFER=10, channel_order='RGB'):
+    # The warp runs on the input as-is and keeps its channel order.
+    imH, imW, C = image.shape
+    corners, (left_pad, top_pad, right_pad, bottom_pad) = doc_trimming_enhancement_corners(
+        image, image_size, BUFFER, channel_order)
+
+    if left_pad or top_pad or right_pad or bottom_pad:
         # new image with additional zeros pixels
         image_extended = np.zeros((top_pad + bottom_pad + imH, left_pad + right_pad + imW, C), dtype=image.dtype)
 
@@ -143,22 +171,16 @@ def doc_trimming_enhancement_pred(image, image_size=384, BUFFER=10):
         image_extended[top_pad : top_pad + imH, left_pad : left_pad + imW, :] = image
         image_extended = image_extended.astype(np.float32)
 
-        # shifting 'box_corners' the required amount
-        box_corners[:, 0] += left_pad
-        box_corners[:, 1] += top_pad
-
-        corners = box_corners
+        # shifting corners the required amount
+        corners = [[x + left_pad, y + top_pad] for x, y in corners]
         image = image_extended
 
-    corners = sorted(corners.tolist())
-    corners = order_points(corners)
-    destination_corners = find_dest(corners)
-    M = cv2.getPerspectiveTransform(np.float32(corners), np.float32(destination_corners))
+    M, size = perspective_from_corners(corners)
 
-    final = cv2.warpPerspective(image, M, (destination_corners[2][0], destination_corners[2][1]), flags=cv2.INTER_LANCZOS4)
+    final = cv2.warpPerspective(image, M, size, flags=cv2.INTER_LANCZOS4)
     final = np.clip(final, a_min=0., a_max=255.)
     if len(final.shape) == 3: final = final.astype(np.uint8)
-    return final[:,:,::-1]
+    return final
 
 doc_trimming_enhancement_model = load_model(2, model_name='mbv3', checkpoint_path=model_path)
 
@@ -273,6 +273,13 @@ def get_argument_parser():
                         default='convert %i %o',
                         help='PDF command (default "%(default)s")')
 
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='random seed for sampling and k-means' + show_default)
+
+    parser.add_argument('--lut-bits', dest='lut_bits', type=int, default=6,
+                        help='bits per channel of the palette lookup '
+                        'table' + show_default)
+
     return parser
 
 ######################################################################
@@ -456,6 +463,20 @@ the background color to pure white.
 
 ######################################################################
 
+def merge_page_samples(all_samples):
+
+    '''Merge the samples of several pages for a global palette, keeping
+an equal share of each page so the total is about one page's worth.'''
+
+    num_inputs = len(all_samples)
+
+    all_samples = [s[:int(round(float(s.shape[0])/num_inputs))]
+                   for s in all_samples]
+
+    return np.vstack(tuple(all_samples))
+
+######################################################################
+
 def get_global_palette(filenames, options):
 
     '''Fetch the global palette for a series of input files by merging
@@ -483,12 +504,7 @@ their samples together into one large array.
         input_filenames.append(input_filename)
         all_samples.append(samples)
 
-    num_inputs = len(input_filenames)
-
-    all_samples = [s[:int(round(float(s.shape[0])/num_inputs))]
-                   for s in all_samples]
-
-    all_samples = np.vstack(tuple(all_samples))
+    all_samples = merge_page_samples(all_samples)
 
     global_palette = get_palette(all_samples, options)
 
@@ -527,10 +543,191 @@ def emit_pdf(outputs, options):
 
 ######################################################################
 
-def docscan_main(img_cv, options):
-    img_cv = img_cv[:, :, ::-1]
-    img = Image.fromarray(img_cv)
-    img = np.array(img)
+def sample_pixels_seeded(img, options, rng):
+
+    '''Pick about a fixed percentage of pixels at positions drawn from a
+seeded generator. Positions are drawn with replacement, so no
+permutation of every pixel index is needed; the samples come out in
+random order, as with sample_pixels.'''
+
+    pixels = img.reshape((-1, 3))
+    num_pixels = pixels.shape[0]
+    num_samples = max(1, int(num_pixels*options.sample_fraction))
+
+    return pixels[rng.integers(0, num_pixels, num_samples)]
+
+######################################################################
+
+def _sq_distances(points, centers):
+
+    '''Squared euclidean distance of every point to every center.'''
+
+    d = (points*points).sum(axis=1)[:, None] - 2*points.dot(centers.T)
+    d += (centers*centers).sum(axis=1)[None, :]
+    return np.maximum(d, 0, out=d)
+
+def kmeans_pp(points, k, rng, n_init=3, max_iter=50, thresh=1e-5):
+
+    '''K-means with k-means++ seeding. Each run stops as soon as the mean
+distortion improves by less than ``thresh`` (relative), like
+scipy.cluster.vq.kmeans; the best of ``n_init`` runs is returned.'''
+
+    points = points.astype(np.float32)
+    best_centers, best_dist = None, None
+
+    for _ in range(n_init):
+
+        centers = np.empty((k, points.shape[1]), dtype=np.float32)
+        centers[0] = points[rng.integers(len(points))]
+        closest = _sq_distances(points, centers[:1])[:, 0]
+        for i in range(1, k):
+            total = closest.sum()
+            if total <= 0:
+                centers[i] = points[rng.integers(len(points))]
+            else:
+                centers[i] = points[rng.choice(len(points), p=closest/total)]
+            closest = np.minimum(closest, _sq_distances(points, centers[i:i+1])[:, 0])
+
+        prev = None
+        for _ in range(max_iter):
+            d = _sq_distances(points, centers)
+            labels = d.argmin(axis=1)
+            dist = float(np.sqrt(d[np.arange(len(points)), labels]).mean())
+            counts = np.bincount(labels, minlength=k)
+            filled = counts > 0 # empty clusters keep their center
+            for j in range(points.shape[1]):
+                sums = np.bincount(labels, weights=points[:, j], minlength=k)
+                centers[filled, j] = sums[filled]/counts[filled]
+            if prev is not None and prev - dist <= thresh*prev:
+                break
+            prev = dist
+
+        if best_dist is None or dist < best_dist:
+            best_centers, best_dist = centers.copy(), dist
+
+    return best_centers
+
+######################################################################
+
+def get_palette_fast(samples, options, rng):
+
+    '''Same palette as get_palette (background color first, then
+K-means centers of the foreground samples), using kmeans_pp.'''
+
+    bg_color = get_bg_color(samples, 6)
+
+    fg = samples[get_fg_mask(bg_color, samples, options)]
+    num_centers = options.num_colors-1
+
+    if len(fg) == 0:
+        centers = np.empty((0, 3))
+    elif len(np.unique(fg, axis=0)) <= num_centers:
+        centers = np.unique(fg, axis=0)
+    else:
+        centers = kmeans_pp(fg, num_centers, rng)
+
+    return np.vstack((bg_color, centers)).astype(np.uint8)
+
+######################################################################
+
+def palette_lut(palette, bits=6):
+
+    '''Nearest palette entry for every cell of the color cube quantized
+to ``bits`` per channel, matched at the cell center.'''
+
+    shift = 8-bits
+    centers = (np.arange(1 << bits) << shift) + ((1 << shift) >> 1)
+    cube = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'),
+                    axis=-1).reshape((-1, 3))
+
+    d = _sq_distances(cube.astype(np.float32), palette.astype(np.float32))
+
+    return d.argmin(axis=1).astype(np.uint8)
+
+def lut_index(img, bits=6):
+
+    '''Flat color-cube cell index of every pixel.'''
+
+    q = img >> (8-bits)
+    idx = q[:, :, 0].astype(np.uint32) << (2*bits)
+    idx |= q[:, :, 1].astype(np.uint32) << bits
+    idx |= q[:, :, 2]
+    return idx
+
+def fg_lut(bg_color, options):
+
+    '''Foreground test of get_fg_mask for every (max, min) channel pair;
+saturation and value only depend on those two, so the test is exact.'''
+
+    cmax, cmin = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+    pairs = np.stack((cmax, cmin, cmin), axis=-1).reshape((-1, 3))
+
+    return get_fg_mask(bg_color, pairs, options)
+
+def sv_index(img):
+
+    '''Flat (max, min) index of every pixel, for fg_lut.'''
+
+    b, g, r = cv2.split(img)
+    idx = cv2.max(cv2.max(b, g), r).astype(np.uint16) << 8
+    idx |= cv2.min(cv2.min(b, g), r)
+    return idx
+
+######################################################################
+
+def output_palette(palette, options):
+
+    '''Palette as written out: optionally saturated and with a white
+background (see save).'''
+
+    if options.saturate:
+        palette = palette.astype(np.float32)
+        pmin = palette.min()
+        pmax = palette.max()
+        palette = 255 * (palette - pmin)/(pmax-pmin)
+        palette = palette.astype(np.uint8)
+
+    if options.white_bg:
+        palette = palette.copy()
+        palette[0] = (255, 255, 255)
+
+    return palette
+
+######################################################################
+
+def docscan_main(img_cv, options, palette=None):
+
+    '''Denoise one page: seeded sampling, k-means++ palette and lookup
+tables, so mapping the image is a gather of the palette label per pixel
+(quantized color cube) plus an exact background test on the channel
+max / min. Pass ``palette`` to skip the palette search (e.g. a global
+palette shared by several pages).'''
+
+    # Channel order is kept: everything below treats the three channels
+    # symmetrically (BGR from the web pipeline stays BGR).
+    img = np.ascontiguousarray(img_cv)
+    bits = getattr(options, 'lut_bits', 6)
+
+    if palette is None:
+        rng = np.random.default_rng(getattr(options, 'seed', 0))
+        samples = sample_pixels_seeded(img, options, rng)
+        palette = get_palette_fast(samples, options, rng)
+
+    labels = palette_lut(palette, bits)[lut_index(img, bits)]
+    labels *= fg_lut(palette[0], options)[sv_index(img)] # background -> 0
+
+    colors = np.zeros((256, 1, 3), dtype=np.uint8)
+    colors[:len(palette), 0] = output_palette(palette, options)
+
+    return cv2.LUT(cv2.merge((labels, labels, labels)), colors)
+
+######################################################################
+
+def docscan_main_reference(img_cv, options):
+    # Sampling, k-means and the palette lookup treat the three channels
+    # symmetrically, so the image is processed in its own channel order
+    # (BGR from the web pipeline) and returned in that same order.
+    img = np.ascontiguousarray(img_cv)
 
     samples = sample_pixels(img, options)
     palette = get_palette(samples, options)
@@ -550,6 +747,6 @@ def docscan_main(img_cv, options):
 
     output_img = Image.fromarray(labels, 'P')
     output_img.putpalette(palette.flatten())
-    output_img = output_img.convert('RGB') # 转为rgb
-    output_img = np.array(output_img)[:, :, ::-1] # 转为bgr，因为后面会转成rgb
+    output_img = output_img.convert('RGB') # 与输入相同的通道顺序
+    output_img = np.array(output_img)
     return output_img
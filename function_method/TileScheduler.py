@@ -0,0 +1,57 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# 自动切分时每个条带 / 块的目标像素数
+BAND_PIXELS = 1 << 20
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def _spans(n, size):
+    return [(a, min(n, a + size)) for a in range(0, n, size)]
+
+
+def run_tiles(func, srcs, halo=0, out=None, rows=None, cols=None, scale=1, workers=None, pool=None):
+    '''
+    把图像切成条带（cols 为 None）或 rows x cols 的块并行处理，结果写入同一个输出缓冲区。
+    srcs 为一张图或同尺寸的多张图（元组）；每块连同四周 halo 像素的邻域交给 func(*patches)，
+    func 返回尺寸为 patch 的 scale 倍的结果，去掉 halo 部分后写入 out。
+    halo 不小于滤波器的半径时，结果与整图处理完全一致：图像边界处 patch 的边就是图像的边，补边方式不变。
+    numpy / OpenCV 在计算时会释放 GIL，因此用线程池即可多核并行。
+    pool 为调用方常驻的线程池时所有块都在其中运行（线程里缓存的模型等可以复用），workers 只用于切分。
+    '''
+    if not isinstance(srcs, tuple):
+        srcs = (srcs,)
+    src = srcs[0]
+    h, w = src.shape[:2]
+    if out is None:
+        out = np.empty((h * scale, w * scale) + src.shape[2:], dtype=src.dtype)
+    if workers is None:
+        workers = default_workers()
+    if rows is None:
+        # 条带数至少为线程数的两倍，条带也不要比 halo 薄太多
+        rows = max(1, min(BAND_PIXELS // max(w if cols is None else cols, 1), -(-h // (2 * workers))), 4 * halo)
+    tiles = [(y0, y1, x0, x1) for y0, y1 in _spans(h, rows) for x0, x1 in _spans(w, cols or w)]
+
+    def job(tile):
+        y0, y1, x0, x1 = tile
+        sy0, sy1 = max(0, y0 - halo), min(h, y1 + halo)
+        sx0, sx1 = max(0, x0 - halo), min(w, x1 + halo)
+        res = func(*[s[sy0:sy1, sx0:sx1] for s in srcs])
+        oy, ox = (y0 - sy0) * scale, (x0 - sx0) * scale
+        out[y0 * scale:y1 * scale, x0 * scale:x1 * scale] = \
+            res[oy:oy + (y1 - y0) * scale, ox:ox + (x1 - x0) * scale]
+
+    if pool is not None:
+        list(pool.map(job, tiles))
+    elif workers <= 1 or len(tiles) == 1:
+        for t in tiles:
+            job(t)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(job, tiles))
+    return out
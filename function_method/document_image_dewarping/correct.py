@@ -62,13 +62,19 @@ def load(wc_model_path, bm_model_path):
     bm_model.to(DEVICE)
     return  wc_model, bm_model
 
-def unwarp(img, bm):
-    w, h = img.shape[0], img.shape[1]
+def bm_to_numpy(bm):
+    """Smoothed backward map as a (128, 128, 2) array of normalized (x, y)
+    source coordinates in [-1, 1], as consumed by grid_sample."""
     bm = bm.transpose(1, 2).transpose(2, 3).detach().cpu().numpy()[0, :, :, :]
     bm0 = cv2.blur(bm[:, :, 0], (3, 3))
     bm1 = cv2.blur(bm[:, :, 1], (3, 3))
-    bm0 = cv2.resize(bm0, (h, w))
-    bm1 = cv2.resize(bm1, (h, w))
+    return np.stack([bm0, bm1], axis=-1)
+
+def unwarp(img, bm):
+    w, h = img.shape[0], img.shape[1]
+    bm = bm_to_numpy(bm)
+    bm0 = cv2.resize(bm[:, :, 0], (h, w))
+    bm1 = cv2.resize(bm[:, :, 1], (h, w))
     bm = np.stack([bm0, bm1], axis=-1)
     bm = np.expand_dims(bm, 0)
     bm = torch.from_numpy(bm).double()
@@ -84,12 +90,12 @@ def unwarp(img, bm):
 
     return res
 
-def dewarping_pred(img):
+def predict_bm(img):
+    """Run both stages on a BGR image and return the raw backward map."""
     wc_img_size = (256, 256)
     bm_img_size = (128, 128)
-    img_copy = img.copy()
     img = cv2.resize(img, wc_img_size)
-    img = img[:, :, ::-1]
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     img = img.astype(float) / 255.0
     img = img.transpose(2, 0, 1)  # NHWC -> NCHW
     img = np.expand_dims(img, 0)
@@ -102,11 +108,16 @@ def dewarping_pred(img):
         pred_wc = htan(wc_outputs)
         bm_input = F.interpolate(pred_wc, bm_img_size)
         outputs_bm = bm_model(bm_input)
-    uwpred = unwarp(img_copy, outputs_bm)
-    uwpred = uwpred[:, :, ::-1] * 255
+    return outputs_bm
+
+def dewarping_pred(img):
+    # BGR in, BGR out; only the 256x256 model input is flipped to RGB.
+    outputs_bm = predict_bm(img)
+    uwpred = unwarp(img, outputs_bm)
+    uwpred = uwpred * 255
     if len(uwpred.shape) == 3: uwpred = uwpred.astype(np.uint8)
 
-    return uwpred[:,:,::-1]
+    return uwpred
 
 wc_model, bm_model = load(wc_model_path, bm_model_path)
 
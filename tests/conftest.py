@@ -0,0 +1,34 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def page():
+    """Small grey-tinted colour page with text-like blocks."""
+    from benchmarks.bench_skew import synthetic_page
+    gray = cv2.resize(synthetic_page(seed=1), (310, 438), interpolation=cv2.INTER_AREA)
+    shade = np.linspace(0.7, 1.0, gray.shape[1], dtype=np.float32)[None, :, None]
+    return (gray[:, :, None] * shade * np.float32([0.92, 0.95, 0.97])).astype(np.uint8)
+
+
+@pytest.fixture
+def step_calls(monkeypatch):
+    """Names of the actions actually run, in order."""
+    from web import tasks
+    calls = []
+    dispatch = tasks._dispatch_single
+
+    def counting(img, action, *args, **kwargs):
+        calls.append(action)
+        return dispatch(img, action, *args, **kwargs)
+
+    monkeypatch.setattr(tasks, "_dispatch_single", counting)
+    return calls
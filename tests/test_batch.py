@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from web import tasks
+from web.batch import collect_inputs, parse_steps
+from web.pipeline import STEP_SPECS
+
+
+def test_step_table_matches_supported_actions():
+    assert set(STEP_SPECS) == set(tasks.SUPPORTED_ACTIONS)
+
+
+@pytest.mark.parametrize("action", ["trim|orientation|shadow", "Bleach, denoise", " sharpen "])
+def test_parse_steps_matches_parse_actions(action):
+    assert parse_steps(action) == tasks.parse_actions(action)
+
+
+@pytest.mark.parametrize("action", ["", "|", "trim|blech"])
+def test_parse_steps_rejects(action):
+    with pytest.raises(ValueError):
+        parse_steps(action)
+
+
+def test_parent_does_not_import_tasks():
+    code = ("import sys; import web.batch, web.watch; web.batch.parse_steps('trim|bleach'); "
+            "sys.exit('web.tasks' in sys.modules)")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", code], cwd=root).returncode == 0
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x')
+    return path
+
+
+def test_collect_inputs_keeps_directory_structure(tmp_path):
+    _touch(str(tmp_path / "in" / "a" / "page1.jpg"))
+    _touch(str(tmp_path / "in" / "b" / "page1.jpg"))
+    rels = sorted(rel for _, rel in collect_inputs([str(tmp_path / "in")], recursive=True))
+    assert rels == [os.path.join("a", "page1.jpg"), os.path.join("b", "page1.jpg")]
+
+
+@pytest.mark.parametrize("names", [
+    ("x/page1.jpg", "x/page1.png"),
+    ("x/scan_001.jpg", "y/scan_001.jpg"),
+])
+def test_collect_inputs_rejects_clashing_outputs(tmp_path, names):
+    paths = [_touch(str(tmp_path / name)) for name in names]
+    with pytest.raises(ValueError, match="same output name"):
+        collect_inputs(paths)
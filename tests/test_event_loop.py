@@ -0,0 +1,93 @@
+"""Handlers must not touch the result store or the disk on the event loop."""
+import asyncio
+import os
+
+import cv2
+import pytest
+
+fastapi = pytest.importorskip("fastapi")
+
+from fastapi.testclient import TestClient
+
+from web import app as web_app
+from web import tasks
+from web.storage import FileStore
+
+
+def _off_loop(what):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    raise AssertionError(f"{what} called on the event loop")
+
+
+class GuardedStore:
+    # path arithmetic only
+    PURE = ("path", "profile_path")
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if not callable(attr) or name in self.PURE:
+            return attr
+
+        def guarded(*args, **kwargs):
+            _off_loop(f"STORE.{name}")
+            return attr(*args, **kwargs)
+        return guarded
+
+
+class GuardedOs:
+    """``os`` as web.app sees it, with file checks guarded."""
+
+    class path:
+        def __getattr__(self, name):
+            return getattr(os.path, name)
+
+        @staticmethod
+        def exists(p):
+            _off_loop("os.path.exists")
+            return os.path.exists(p)
+
+    path = path()
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(tasks, "STORE", GuardedStore(FileStore(str(tmp_path))))
+    monkeypatch.setattr(web_app, "os", GuardedOs())
+    with TestClient(web_app.app) as client:
+        yield client
+
+
+def test_handlers_keep_io_off_the_loop(client, page):
+    data = cv2.imencode(".png", page)[1].tobytes()
+    upload = {"file": ("page.png", data)}
+
+    r = client.post("/process", files=upload, data={"action": "bleach", "profile": "true"})
+    assert r.status_code == 200 and r.headers["X-Profile-Url"]
+    result_id = r.headers["X-Result-Id"]
+    r = client.post("/process", files=upload, data={"action": "bleach", "preview": "true"})
+    assert r.status_code == 200
+
+    job_id = client.post("/process_async", files=upload, data={"action": "bleach"}).json()["job_id"]
+    batch = client.post("/process_async_batch", files=[("files", ("a.png", data))],
+                        data={"action": "bleach"}).json()
+    tree = client.post("/process_tree", files=upload, data={"tree": "{bleach, shadow}"}).json()
+
+    assert client.get(f"/status/{job_id}").json()["status"] == "finished"
+    for batch_id in (batch["batch_id"], tree["batch_id"]):
+        r = client.post("/status_batch", json={"batch_id": batch_id})
+        assert r.status_code == 200 and r.json()["counts"] == {"finished": r.json()["total"]}
+    assert client.get(f"/result/{job_id}").status_code == 200
+    assert client.get(f"/download/{result_id}").status_code == 200
+    assert client.get(f"/profile/{result_id}").status_code == 200
+    assert client.post("/share", json={"result_id": result_id}).status_code == 200
+    assert client.post("/download_all", json={"ids": [result_id, job_id]}).status_code == 200
+    assert client.post("/clear_results", json={"ids": [result_id, job_id]}).json()["removed"] > 0
@@ -0,0 +1,48 @@
+import struct
+import zlib
+
+import cv2
+import numpy as np
+import pytest
+
+from web import ingest
+
+
+def _png(width, height):
+    """A valid 1x1 PNG whose header announces ``width`` x ``height``."""
+    data = bytearray(cv2.imencode(".png", np.zeros((1, 1), np.uint8))[1].tobytes())
+    ihdr = bytes(data[12:16]) + struct.pack(">II", width, height) + bytes(data[24:29])
+    data[16:24] = struct.pack(">II", width, height)
+    data[29:33] = struct.pack(">I", zlib.crc32(ihdr))
+    return bytes(data)
+
+
+@pytest.fixture
+def no_decode(monkeypatch):
+    def fail(*args):
+        raise AssertionError("decoded")
+    monkeypatch.setattr(ingest.cv2, "imdecode", fail)
+
+
+def test_oversized_header_is_rejected_before_decoding(no_decode):
+    data = _png(50000, 50000)
+    with pytest.raises(ingest.ImageTooLarge):
+        ingest.check_header(data)
+    with pytest.raises(ingest.ImageTooLarge):
+        ingest.decode_image(data)
+
+
+def test_unidentified_format_is_not_decoded(no_decode):
+    # Radiance HDR: OpenCV reads it, Pillow cannot tell its size
+    data = cv2.imencode(".hdr", np.ones((8, 8, 3), np.float32))[1].tobytes()
+    assert ingest.check_header(data) is None
+    assert ingest.decode_image(data) == (None, {})
+
+
+def test_pixel_budget(page):
+    data = cv2.imencode(".jpg", page)[1].tobytes()
+    img, info = ingest.decode_image(data, pixel_budget=page.shape[0] * page.shape[1] // 4)
+    assert info["size"] == [page.shape[1], page.shape[0]]
+    assert img.shape[0] * img.shape[1] <= page.shape[0] * page.shape[1] // 4
+    full, info = ingest.decode_image(data, pixel_budget=1, full_res=True)
+    assert full.shape == page.shape and info["decoded"] == info["size"]
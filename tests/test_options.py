@@ -0,0 +1,27 @@
+import pytest
+
+from web import tasks
+
+
+def test_defaults_and_bounds():
+    assert tasks.parse_options({"bleach": {"window_size": 255, "k": 0.3}}) == {"bleach": {"window_size": 255, "k": 0.3}}
+    assert tasks.get_action_options()["bleach"]["window_size"] == 15
+
+
+@pytest.mark.parametrize("options", [
+    {"bleach": {"window_size": 0}},
+    {"bleach": {"window_size": 256}},
+    {"bleach": {"window_size": 10 ** 6}},
+    {"bleach": {"window_size": 2.5}},
+    {"bleach": {"nope": 1}},
+    '{"bleach": ',
+])
+def test_rejected(options):
+    with pytest.raises(ValueError):
+        tasks.parse_options(options)
+
+
+@pytest.mark.parametrize("value", [0, tasks.MAX_OUTPUT_PIXELS + 1])
+def test_sharpen_output_cap_cannot_be_lifted(value):
+    with pytest.raises(ValueError):
+        tasks.parse_options({"sharpen": {"max_output_pixels": value}})
@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+
+from web.pipeline import (
+    apply_geometry,
+    fuse_geometry,
+    image_format,
+    perspective_transform,
+    plan_pipeline,
+    run_plan,
+)
+
+GEOMETRIC = ("trim", "orientation", "dewarp")
+
+
+def _shift(dx, dy, size):
+    m = np.float64([[1, 0, -dx], [0, 1, -dy], [0, 0, 1]])
+    return perspective_transform(m, size, size, fill=255)
+
+
+def test_fused_geometric_chain_warps_once(page):
+    plan, _ = plan_pipeline(["trim", "orientation"], image_format(page))
+    plan = fuse_geometry(plan, GEOMETRIC)
+    assert plan == [("geometry", ("trim", "orientation"))]
+
+    warps = []
+    size = (page.shape[1], page.shape[0])
+
+    def run_geometry(img, steps):
+        warps.append(steps)
+        return apply_geometry(img, [_shift(3, 0, size), _shift(0, 5, size)])
+
+    def run_step(img, name):
+        raise AssertionError(f"{name} ran outside the fused warp")
+
+    out, stats = run_plan(page, plan, run_step, run_geometry=run_geometry)
+    assert warps == [("trim", "orientation")]
+    assert stats["copies"] == 0 and stats["copy_bytes"] == 0 and stats["conversions"] == []
+    assert stats["allocations"] == 1
+    assert out.shape == page.shape
+
+
+def test_unfused_chain_counts_each_step(page):
+    plan, _ = plan_pipeline(["trim", "orientation"], image_format(page))
+    assert plan == [("step", "trim"), ("step", "orientation")]
+    out, stats = run_plan(page, plan, lambda img, name: cv2.flip(img, 1))
+    assert stats["copies"] == 0
+    assert stats["allocations"] == 2
+
+
+def test_conversions_and_in_place_steps(page):
+    gray = cv2.cvtColor(page, cv2.COLOR_BGR2GRAY)
+    # shadow needs three channels, so the gray input is converted once
+    plan, fmt = plan_pipeline(["shadow", "orientation"], image_format(gray))
+    assert plan == [("convert", "gray_to_color"), ("step", "shadow"), ("step", "orientation")]
+    assert fmt == ("BGR", "uint8", 3)
+
+    def run_step(img, name):
+        if name == "shadow":
+            img += 1  # in place: no new buffer
+            return img
+        return img[:, ::-1]  # a view, made contiguous once by run_plan
+
+    out, stats = run_plan(gray, plan, run_step)
+    assert stats["conversions"] == ["gray_to_color", "contiguous"]
+    assert stats["copies"] == 2
+    assert stats["copy_bytes"] == 2 * page.nbytes
+    # gray_to_color and the contiguous copy; the in-place step adds none
+    assert stats["allocations"] == 2
+    assert out.flags.c_contiguous
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from web import tasks
+
+
+def test_parse_tree():
+    assert tasks.parse_tree("trim|orientation -> {bleach, denoise, shadow|sharpen}") == [
+        ["trim", "orientation", "bleach"],
+        ["trim", "orientation", "denoise"],
+        ["trim", "orientation", "shadow", "sharpen"],
+    ]
+    assert tasks.parse_tree("trim -> {orientation -> {bleach, denoise}, sharpen}") == [
+        ["trim", "orientation", "bleach"],
+        ["trim", "orientation", "denoise"],
+        ["trim", "sharpen"],
+    ]
+    assert tasks.parse_tree("{bleach, denoise, bleach}") == [["bleach"], ["denoise"]]
+    # outside braces a comma still separates steps
+    assert tasks.parse_tree("shadow,bleach") == [["shadow", "bleach"]]
+
+
+@pytest.mark.parametrize("spec", ["trim -> {bleach", "trim {bleach}", "trim -> {bleach} x", "trim -> {bleach,}",
+                                  "nope -> {bleach}"])
+def test_parse_tree_errors(spec):
+    with pytest.raises(ValueError):
+        tasks.parse_tree(spec)
+
+
+@pytest.fixture
+def shared_steps(monkeypatch):
+    """The _SharedSteps instances run_tree creates."""
+    created = []
+
+    class Recording(tasks._SharedSteps):
+        def __init__(self, refs):
+            super().__init__(refs)
+            created.append(self)
+
+    monkeypatch.setattr(tasks, "_SharedSteps", Recording)
+    return created
+
+
+@pytest.mark.parametrize("spec, branch_points", [
+    ("{bleach, denoise}", 0),
+    ("shadow -> {bleach, denoise}", 1),
+    ("shadow|bleach -> {denoise, shadow}", 1),
+    ("shadow -> {bleach -> {denoise, shadow}, denoise}", 2),
+    ("shadow -> {bleach, bleach|denoise}", 1),
+])
+def test_run_tree_runs_each_prefix_once(page, step_calls, shared_steps, spec, branch_points):
+    leaves = tasks.parse_tree(spec)
+    results = list(tasks.run_tree(page, leaves))
+
+    # every node of the tree ran exactly once
+    nodes = {tuple(leaf[:i + 1]) for leaf in leaves for i in range(len(leaf))}
+    assert len(step_calls) == len(nodes)
+    # only branch points were retained, and all were released
+    shared, = shared_steps
+    assert shared.peak == branch_points
+    assert not shared.items and not shared.refs
+
+    for leaf, out, error in results:
+        assert error is None
+        expected = tasks.Pipeline(leaf, cache=False).run(page.copy())
+        assert np.array_equal(out, expected), leaf
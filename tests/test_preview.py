@@ -0,0 +1,28 @@
+import threading
+
+import cv2
+
+from web import tasks
+
+
+def test_preview_rates_survive_concurrent_updates(monkeypatch, page):
+    monkeypatch.setattr(tasks, "_preview_rates", {})
+    data = cv2.imencode(".png", page)[1].tobytes()
+    errors = []
+
+    def preview():
+        try:
+            out, info = tasks.process_preview(data, "shadow|bleach")
+            assert out and info["size"] == [page.shape[1], page.shape[0]]
+            assert tasks.PREVIEW_MIN_PIXELS <= tasks.preview_budget("shadow|bleach") <= tasks.PREVIEW_PIXELS
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=preview) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert list(tasks._preview_rates) == ["shadow|bleach"]
+    assert tasks._preview_rates["shadow|bleach"] > 0
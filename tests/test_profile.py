@@ -0,0 +1,73 @@
+import threading
+import uuid
+
+import cv2
+import pytest
+
+from web import tasks
+from web.storage import FileStore
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    store = FileStore(str(tmp_path))
+    monkeypatch.setattr(tasks, "STORE", store)
+    return store
+
+
+def _run_job(data, profile):
+    job_id = uuid.uuid4().hex
+    thread = threading.Thread(target=tasks.process_job_bg, args=(job_id, data, "bleach"),
+                              kwargs={"profile": profile})
+    thread.start()
+    return job_id, thread
+
+
+def test_should_profile(monkeypatch):
+    monkeypatch.setattr(tasks, "PROFILE_SAMPLE_PERCENT", 0)
+    assert tasks.should_profile(True) == "requested"
+    assert tasks.should_profile(False) is None
+    monkeypatch.setattr(tasks, "PROFILE_SAMPLE_PERCENT", 100)
+    assert tasks.should_profile(False) == "sampled"
+
+
+def test_requested_profile_waits_for_the_profiler(store, page):
+    data = cv2.imencode(".png", page)[1].tobytes()
+    with tasks._profile_lock:
+        job_id, thread = _run_job(data, "requested")
+        thread.join(0.5)
+        # still waiting, and no link to a profile that does not exist yet
+        assert thread.is_alive()
+        assert "url" not in store.get_status(job_id)[1].get("profile", {})
+    thread.join()
+    status, meta = store.get_status(job_id)
+    assert status == "finished"
+    assert meta["profile"]["url"] == f"/profile/{job_id}"
+    assert store.profile_path(job_id) and tasks.profile_report(job_id)
+
+
+def test_sampled_profile_is_skipped_while_busy(store, page):
+    data = cv2.imencode(".png", page)[1].tobytes()
+    with tasks._profile_lock:
+        job_id, thread = _run_job(data, "sampled")
+        thread.join(10)
+        assert not thread.is_alive()
+    status, meta = store.get_status(job_id)
+    assert status == "finished"
+    assert "url" not in meta["profile"]
+
+
+def test_profile_url_is_published_once_saved(store, page):
+    pytest.importorskip("fastapi")
+    from fastapi.testclient import TestClient
+    from web import app as web_app
+
+    data = cv2.imencode(".png", page)[1].tobytes()
+    with TestClient(web_app.app) as client:
+        r = client.post("/process_async", files={"file": ("a.png", data)}, data={"action": "bleach"},
+                        headers={"X-Profile": "1"})
+        out = r.json()
+        assert "profile_url" not in out
+        status = client.get(out["status_url"]).json()
+        assert status["status"] == "finished"
+        assert client.get(status["profile_url"]).status_code == 200
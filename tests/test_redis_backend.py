@@ -0,0 +1,87 @@
+import time
+import uuid
+
+import cv2
+import numpy as np
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from web.jobqueue import RQQueue
+from web.storage import RedisStore
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def store(redis, tmp_path):
+    return RedisStore(redis, str(tmp_path))
+
+
+def test_store_round_trip(store, redis):
+    job_id = uuid.uuid4().hex
+    assert store.get_status(job_id) == (None, {})
+    assert store.result_ref(job_id) is None
+
+    store.put_status(job_id, "processing", {"id": job_id})
+    assert store.get_status(job_id) == ("processing", {"id": job_id})
+
+    store.commit(job_id, b"jpeg", {"id": job_id, "status": "finished"})
+    status, meta = store.get_status(job_id)
+    assert status == "finished" and meta["status"] == "finished"
+    assert store.read_result(job_id) == b"jpeg"
+    ref = store.result_ref(job_id)
+    assert ref.data == b"jpeg" and ref.length == 4
+    assert redis.exists(store._key(job_id))
+
+    batch_id = uuid.uuid4().hex
+    store.put_batch(batch_id, [job_id])
+    assert store.get_batch(batch_id) == [job_id]
+
+    assert store.delete(job_id) == 1
+    assert not redis.exists(store._key(job_id))
+    assert store.get_status(job_id) == (None, {})
+    assert store.result_ref(job_id) is None
+
+
+def test_store_rejects_bad_ids(store):
+    assert store.get_status("../etc") == (None, {})
+    assert store.read_result("nothex") is None
+    assert store.delete("nothex") == 0
+
+
+def test_store_expiry(redis, tmp_path):
+    store = RedisStore(redis, str(tmp_path), ttl=1)
+    job_id, batch_id = uuid.uuid4().hex, uuid.uuid4().hex
+    store.commit(job_id, b"jpeg", {"id": job_id})
+    store.put_batch(batch_id, [job_id])
+    assert 0 < redis.ttl(store._key(job_id)) <= 1
+    time.sleep(1.2)
+    assert store.get_status(job_id) == (None, {})
+    assert store.get_batch(batch_id) is None
+
+
+def test_queue_enqueue_and_status(redis, store, monkeypatch, page):
+    from rq import SimpleWorker
+    from rq.job import Job
+
+    from web import tasks
+    monkeypatch.setattr(tasks, "STORE", store)
+
+    queue = RQQueue(redis, queue_name="test")
+    job_id = uuid.uuid4().hex
+    data = cv2.imencode(".png", page)[1].tobytes()
+    queue.submit(None, job_id, tasks.process_job_bg, data, "bleach")
+    assert queue.depth() == 1
+    assert Job.fetch(job_id, connection=redis).get_status() == "queued"
+    assert store.get_status(job_id)[0] is None
+
+    SimpleWorker([queue.queue], connection=redis).work(burst=True)
+    assert queue.depth() == 0
+    status, meta = store.get_status(job_id)
+    assert status == "finished", meta
+    result = cv2.imdecode(np.frombuffer(store.read_result(job_id), np.uint8), cv2.IMREAD_UNCHANGED)
+    assert result.shape[:2] == page.shape[:2]
@@ -0,0 +1,32 @@
+import cv2
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.skipif(not hasattr(cv2, "dnn_superres"), reason="needs opencv-contrib (dnn_superres)")
+
+
+@pytest.fixture
+def sharpening():
+    from function_method import DocSharpening
+    return DocSharpening
+
+
+def test_models_load_once_per_pool_thread(sharpening, monkeypatch):
+    loads = []
+    load_model = sharpening.load_model
+    monkeypatch.setattr(sharpening, "load_model", lambda s=sharpening.scale: loads.append(s) or load_model(s))
+    img = np.full((700, 700, 3), 200, np.uint8)
+    cv2.putText(img, "text", (50, 350), cv2.FONT_HERSHEY_SIMPLEX, 4, (0, 0, 0), 8)
+
+    first = sharpening.doc_sharpening_pred(img, enh="usm")
+    loaded = len(loads)
+    assert loaded <= sharpening.WORKERS
+    second = sharpening.doc_sharpening_pred(img, enh="usm")
+    assert len(loads) == loaded
+    assert np.array_equal(first, second)
+    assert np.array_equal(first, sharpening.doc_sharpening_pred(img, enh="usm", workers=1))
+
+
+def test_output_cap_is_clamped(sharpening):
+    h = w = 4000
+    assert sharpening.choose_scale(h, w, max_output_pixels=10 ** 12) == 1
@@ -0,0 +1,21 @@
+import numpy as np
+
+from web import tasks
+from web.pipeline import StepCache
+
+
+def test_disabled_cache_recomputes(monkeypatch, page, step_calls):
+    monkeypatch.setattr(tasks, "STEP_CACHE", None)
+    first = tasks.Pipeline("shadow|bleach").run(page.copy())
+    second = tasks.Pipeline("shadow|bleach").run(page.copy())
+    assert step_calls == ["shadow", "bleach", "shadow", "bleach"]
+    assert np.array_equal(first, second)
+
+
+def test_enabled_cache_resumes_after_prefix(monkeypatch, page, step_calls):
+    monkeypatch.setattr(tasks, "STEP_CACHE", StepCache(64 << 20))
+    stats = tasks.new_stats()
+    tasks.Pipeline("shadow|bleach").run(page.copy())
+    tasks.Pipeline("shadow|denoise").run(page.copy(), stats)
+    assert step_calls == ["shadow", "bleach", "denoise"]
+    assert stats["cached_steps"] == 1
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from argparse import Namespace
+
+from web.batch import output_key
+from web.watch import MAX_WORKER_DEATHS, Watcher
+
+
+def _args(tmp_path, **kwargs):
+    args = dict(input=str(tmp_path / "in"), output=str(tmp_path / "out"), format="jpg", recursive=True,
+                settle=0.0, interval=0.05, checkpoint=None, retry_errors=False, workers=1, threads=1,
+                action="trim", proxy_analysis=False, max_pixels=None)
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x')
+
+
+def test_clashing_output_gets_error_marker(tmp_path):
+    _touch(str(tmp_path / "in" / "page1.jpg"))
+    _touch(str(tmp_path / "in" / "page1.png"))
+    _touch(str(tmp_path / "in" / "page2.png"))
+    watcher = Watcher(_args(tmp_path), "")
+    watcher.ready_files()
+    assert watcher.claim("page1.jpg") is None
+    assert watcher.claim("page1.jpg") is None
+    assert watcher.claim("page1.png") == "page1.jpg"
+    assert watcher.claim("page2.png") is None
+
+    watcher.reject("page1.png", 1, 0.0, "page1.jpg")
+    with open(str(tmp_path / "out" / "page1.png.error.txt"), encoding='utf-8') as f:
+        assert "page1.jpg" in f.read()
+    assert watcher.done["page1.png"]["status"] == "error"
+
+
+def test_output_is_free_once_its_writer_is_gone(tmp_path):
+    _touch(str(tmp_path / "in" / "page1.png"))
+    watcher = Watcher(_args(tmp_path), "")
+    watcher.done["page1.jpg"] = {"size": 1, "mtime": 0.0, "status": "done"}
+    watcher.owners[output_key("page1.jpg")] = "page1.jpg"
+    watcher.ready_files()
+    assert watcher.claim("page1.png") is None
+
+
+def _init_test_worker(threads):
+    pass
+
+
+def _crash_on_page1(src, dst, *args):
+    # page1 kills its worker the first time; with "always" in the name, every time
+    marker = dst + '.crashed'
+    if 'page1' in src and ('always' in src or not os.path.exists(marker)):
+        open(marker, 'w').close()
+        os._exit(1)
+    with open(dst, 'wb') as f:
+        f.write(b'ok')
+
+
+class _TestWatcher(Watcher):
+    initializer = staticmethod(_init_test_worker)
+    process_file = staticmethod(_crash_on_page1)
+
+    def check_options(self, pool):
+        pass
+
+
+def _run_until(watcher, paths, timeout=60):
+    def stop_when_written():
+        deadline = time.time() + timeout
+        while time.time() < deadline and not all(os.path.exists(p) for p in paths):
+            time.sleep(0.05)
+        watcher.stop()
+    threading.Thread(target=stop_when_written, daemon=True).start()
+    watcher.run()
+
+
+def test_worker_death_retries_running_files(tmp_path):
+    for name in ("page1.png", "page2.png", "page3.png"):
+        _touch(str(tmp_path / "in" / name))
+    watcher = _TestWatcher(_args(tmp_path, workers=2), "")
+    outputs = [str(tmp_path / "out" / name) for name in ("page1.jpg", "page2.jpg", "page3.jpg")]
+    _run_until(watcher, outputs)
+    assert os.path.exists(outputs[0] + '.crashed')
+    assert all(os.path.exists(p) for p in outputs)
+    assert {rel: e["status"] for rel, e in watcher.done.items()} == {
+        "page1.png": "done", "page2.png": "done", "page3.png": "done"}
+    assert not any(name.endswith('.error.txt') for name in os.listdir(str(tmp_path / "out")))
+
+
+def test_file_that_always_kills_its_worker_is_an_error(tmp_path):
+    _touch(str(tmp_path / "in" / "page1_always.png"))
+    watcher = _TestWatcher(_args(tmp_path), "")
+    marker = str(tmp_path / "out" / "page1_always.error.txt")
+    _run_until(watcher, [marker])
+    assert watcher.done["page1_always.png"]["status"] == "error"
+    assert watcher.deaths == {}
+    assert MAX_WORKER_DEATHS > 1
@@ -1,8 +1,6 @@
-from fastapi import FastAPI, File, UploadFile, Form, BackgroundTasks, Request
-from fastapi.responses import Response, JSONResponse, FileResponse, StreamingResponse
+from fastapi import FastAPI, File, UploadFile, Form, BackgroundTasks, Request, Header
+from fastapi.responses import Response, JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-import numpy as np
-import cv2
 import os
 import uuid
 import io
@@ -11,45 +9,118 @@ import re
 import json
 import socket
 import time
+from contextlib import asynccontextmanager
 from urllib.parse import urlsplit, urlunsplit
 
+from starlette.concurrency import run_in_threadpool
+
 from  web import tasks
+from web.ingest import ImageTooLarge, check_header
+from web.jobqueue import open_queue
+from web.loopmonitor import LoopLagMonitor
+
+loop_monitor = LoopLagMonitor()
+# in-process background tasks or RQ workers (QUEUE_BACKEND)
+JOB_QUEUE = open_queue()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    loop_monitor.start()
+    yield
+    await loop_monitor.stop()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="web/static"), name="static")
 
 # results dir
 RESULT_DIR = os.path.join('web', 'results')
 os.makedirs(RESULT_DIR, exist_ok=True)
 SHARE_DB_PATH = os.path.join(RESULT_DIR, "shares.json")
+# /status_batch: ids per request, and how far the "since" cursor lags behind
+MAX_STATUS_IDS = 10000
+STATUS_CURSOR_SLACK = 2.0
 
 
-def _result_path_from_id(result_id: str):
+def _result_id(result_id: str):
+    """Lower-cased id, or None if it is not a 32-digit hex id."""
     if not isinstance(result_id, str):
         return None
     if not re.fullmatch(r"[0-9a-fA-F]{32}", result_id):
         return None
-    return os.path.join(RESULT_DIR, f"{result_id.lower()}.jpg")
-
-
-def _meta_path_from_id(result_id: str):
-    if not isinstance(result_id, str):
-        return None
-    if not re.fullmatch(r"[0-9a-fA-F]{32}", result_id):
-        return None
-    return os.path.join(RESULT_DIR, f"{result_id.lower()}.meta.json")
-
-
-def _load_job_meta(job_id: str):
-    p = _meta_path_from_id(job_id)
-    if not p or not os.path.exists(p):
-        return {}
-    try:
-        with open(p, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data if isinstance(data, dict) else {}
-    except Exception:
-        return {}
+    return result_id.lower()
+
+
+def _result_ref(result_id: str):
+    rid = _result_id(result_id)
+    return tasks.STORE.result_ref(rid) if rid else None
+
+
+class BlobResponse(Response):
+    """Serves ``ref.length`` bytes at ``ref.offset`` of ``ref.path`` (a result
+    inside a pack file).
+
+    Uses the ASGI zero-copy send extension (sendfile in the server) when the
+    server offers it, otherwise reads in chunks off the event loop.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, ref, media_type: str, filename: str = None):
+        self.ref = ref
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        headers = {"content-length": str(ref.length)}
+        if filename:
+            headers["content-disposition"] = f'attachment; filename="{filename}"'
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope.get("method", "GET").upper() == "HEAD" or not self.ref.length:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        with open(self.ref.path, "rb") as f:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.ref.offset,
+                    "count": self.ref.length,
+                })
+                return
+            f.seek(self.ref.offset)
+            remaining = self.ref.length
+            while remaining:
+                chunk = await run_in_threadpool(f.read, min(self.chunk_size, remaining))
+                if not chunk:
+                    raise RuntimeError(f"Result blob in {self.ref.path} is truncated")
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+
+
+def _blob_response(ref, media_type: str, filename: str = None):
+    if ref.data is not None:
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'} if filename else None
+        return Response(content=ref.data, media_type=media_type, headers=headers)
+    # whole files (flat / sharded store) go through FileResponse, which
+    # uses the server's pathsend and handles Range requests
+    if ref.offset == 0 and os.path.getsize(ref.path) == ref.length:
+        return FileResponse(ref.path, media_type=media_type, filename=filename)
+    return BlobResponse(ref, media_type, filename)
+
+
+async def _submit_job(background_tasks, job_id, *args, func=None):
+    """Run ``func`` (default tasks.process_job_bg) for ``job_id`` on the
+    configured queue."""
+    await run_in_threadpool(JOB_QUEUE.submit, background_tasks, job_id, func or tasks.process_job_bg, *args)
+
+
+def _profile_requested(profile: bool, x_profile: str) -> bool:
+    """Profiling is asked for by form field ``profile`` or header ``X-Profile``."""
+    return bool(profile) or (x_profile or "").strip().lower() in ("1", "true", "yes")
 
 
 def _load_share_db():
@@ -118,58 +189,153 @@ async def list_actions():
             "actions": tasks.get_supported_actions(),
             "pipeline_separator": "|",
             "examples": ["trim|orientation|bleach", "shadow|sharpen"],
+            "options": tasks.get_action_options(),
         }
     )
 
 
+@app.get("/metrics/loop_lag")
+async def loop_lag(reset: bool = False):
+    """Event-loop stalls since start (or the last ``reset=true``)."""
+    return JSONResponse(loop_monitor.snapshot(reset))
+
+
+@app.get("/metrics/step_cache")
+async def step_cache():
+    """Size and hit counts of the intermediate step cache."""
+    if tasks.STEP_CACHE is None:
+        return JSONResponse({"enabled": False})
+    return JSONResponse(dict(tasks.STEP_CACHE.info(), enabled=True))
+
+
+@app.get("/metrics/queue")
+def queue_metrics():
+    """Backend of the async job queue and, for rq, how many jobs wait."""
+    out = {"backend": JOB_QUEUE.name}
+    if hasattr(JOB_QUEUE, "depth"):
+        out["queued"] = JOB_QUEUE.depth()
+    return JSONResponse(out)
+
+
+async def _process_preview(background_tasks, job_id, data, action, proxy_analysis, opts, do_profile, max_pixels, t0):
+    """Preview mode of /process: the pipeline on a small proxy now, the full
+    resolution result as background job ``job_id`` (see /status, /result)."""
+    try:
+        out, info = await run_in_threadpool(tasks.process_preview, data, action, proxy_analysis, opts)
+    except ImageTooLarge as e:
+        return Response(content=str(e), status_code=413)
+    except Exception as e:
+        return Response(content=f"Processing error: {e}", status_code=500)
+    if out is None:
+        return Response(content="Invalid image", status_code=400)
+    await _submit_job(background_tasks, job_id, data, action, proxy_analysis, opts, None, do_profile, max_pixels)
+    headers = {
+        "X-Result-Id": job_id,
+        "X-Elapsed-Ms": str(int((time.perf_counter() - t0) * 1000)),
+        "X-Preview": "1",
+        "X-Preview-Size": "%dx%d" % tuple(info["decoded"]),
+        "X-Status-Url": f"/status/{job_id}",
+    }
+    return Response(content=out, media_type='image/jpeg', headers=headers)
+
+
 @app.post("/process")
-async def process(file: UploadFile = File(...), action: str = Form(...)):
+async def process(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    action: str = Form(...),
+    proxy_analysis: bool = Form(False),
+    options: str = Form(""),
+    profile: bool = Form(False),
+    max_pixels: int | None = Form(None),
+    preview: bool = Form(False),
+    x_profile: str = Header(""),
+):
     try:
-        tasks.parse_actions(action)
+        steps = tasks.parse_actions(action)
     except Exception as e:
         return Response(content=f"Invalid action: {e}", status_code=400)
+    try:
+        opts = tasks.parse_options(options)
+    except ValueError as e:
+        return Response(content=f"Invalid options: {e}", status_code=400)
+    if max_pixels is not None and max_pixels < 0:
+        return Response(content="Invalid max_pixels", status_code=400)
+
+    # Result id is chosen up front so a profile can be stored under it.
+    result_id = uuid.uuid4().hex
+    profile_mode = tasks.should_profile(_profile_requested(profile, x_profile))
+    profile_id = result_id if profile_mode else None
 
     t0 = time.perf_counter()
     data = await file.read()
-    nparr = np.frombuffer(data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+    if preview:
+        return await _process_preview(
+            background_tasks, result_id, data, action, proxy_analysis, opts, profile_mode, max_pixels, t0
+        )
+    try:
+        img, _ = await run_in_threadpool(tasks.decode_input, data, steps, max_pixels)
+    except ImageTooLarge as e:
+        return Response(content=str(e), status_code=413)
     if img is None:
         return Response(content="Invalid image", status_code=400)
 
-    # synchronous processing (keeps previous behavior)
+    # synchronous processing (keeps previous behavior), off the event loop
     try:
-        out = tasks.process_image_bytes(data, action)
+        out = await run_in_threadpool(
+            tasks.process_image_bytes, img, action, proxy_analysis, opts, profile_id,
+            profile_wait=profile_mode == "requested",
+        )
     except Exception as e:
         return Response(content=f"Processing error: {e}", status_code=500)
     elapsed_ms = int((time.perf_counter() - t0) * 1000)
 
     # Save sync result so it can join current-session "download all".
-    result_id = uuid.uuid4().hex
-    result_path = _result_path_from_id(result_id)
-    if result_path:
-        with open(result_path, "wb") as f:
-            f.write(out)
+    await run_in_threadpool(tasks.STORE.put_result, result_id, out)
 
     # Return image bytes and id for client-side session tracking.
-    return Response(
-        content=out,
-        media_type='image/jpeg',
-        headers={"X-Result-Id": result_id, "X-Elapsed-Ms": str(elapsed_ms)},
-    )
+    headers = {"X-Result-Id": result_id, "X-Elapsed-Ms": str(elapsed_ms)}
+    if profile_id and await run_in_threadpool(os.path.exists, tasks.profile_path(profile_id)):
+        headers["X-Profile-Url"] = f"/profile/{profile_id}"
+    return Response(content=out, media_type='image/jpeg', headers=headers)
 
 
 @app.post('/process_async')
-async def process_async(background_tasks: BackgroundTasks, file: UploadFile = File(...), action: str = Form(...)):
+async def process_async(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    action: str = Form(...),
+    proxy_analysis: bool = Form(False),
+    options: str = Form(""),
+    profile: bool = Form(False),
+    max_pixels: int | None = Form(None),
+    x_profile: str = Header(""),
+):
     try:
         tasks.parse_actions(action)
     except Exception as e:
         return Response(content=f"Invalid action: {e}", status_code=400)
+    try:
+        opts = tasks.parse_options(options)
+    except ValueError as e:
+        return Response(content=f"Invalid options: {e}", status_code=400)
+    if max_pixels is not None and max_pixels < 0:
+        return Response(content="Invalid max_pixels", status_code=400)
 
     data = await file.read()
+    # only the header is read here; the job decodes
+    try:
+        header = await run_in_threadpool(check_header, data)
+    except ImageTooLarge as e:
+        return Response(content=str(e), status_code=413)
+    if header is None:
+        return Response(content="Invalid image", status_code=400)
     job_id = uuid.uuid4().hex
+    do_profile = tasks.should_profile(_profile_requested(profile, x_profile))
     # schedule background task
-    background_tasks.add_task(tasks.process_job_bg, job_id, data, action)
-    return JSONResponse({'job_id': job_id, 'status_url': f'/status/{job_id}', 'result_url': f'/result/{job_id}'} )
+    await _submit_job(background_tasks, job_id, data, action, proxy_analysis, opts, None, do_profile, max_pixels)
+    out = {'job_id': job_id, 'status_url': f'/status/{job_id}', 'result_url': f'/result/{job_id}'}
+    return JSONResponse(out)
 
 
 @app.post('/process_async_batch')
@@ -177,90 +343,237 @@ async def process_async_batch(
     background_tasks: BackgroundTasks,
     files: list[UploadFile] = File(...),
     action: str = Form(...),
+    proxy_analysis: bool = Form(False),
+    options: str = Form(""),
+    global_palette: bool = Form(False),
+    profile: bool = Form(False),
+    max_pixels: int | None = Form(None),
+    x_profile: str = Header(""),
 ):
     try:
-        tasks.parse_actions(action)
+        steps = tasks.parse_actions(action)
     except Exception as e:
         return Response(content=f"Invalid action: {e}", status_code=400)
+    try:
+        opts = tasks.parse_options(options)
+    except ValueError as e:
+        return Response(content=f"Invalid options: {e}", status_code=400)
+    if max_pixels is not None and max_pixels < 0:
+        return Response(content="Invalid max_pixels", status_code=400)
+    # 多页共用一个 denoise 调色板（与命令行 -g 相同，从上传的页面采样）
+    global_palette = global_palette and "denoise" in steps
 
     jobs = []
+    accepted = []
+    samples = []
     for up in files:
         data = await up.read()
-        nparr = np.frombuffer(data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+        try:
+            img, _ = await run_in_threadpool(tasks.decode_input, data, steps, max_pixels)
+            reason = "invalid image" if img is None else None
+        except ImageTooLarge as e:
+            img, reason = None, str(e)
         if img is None:
             jobs.append(
                 {
                     "filename": up.filename or "unknown",
                     "status": "rejected",
-                    "reason": "invalid image",
+                    "reason": reason,
                 }
             )
             continue
+        if global_palette:
+            samples.append(await run_in_threadpool(tasks.palette_samples, img, len(samples)))
+        del img
+
+        job = {
+            "filename": up.filename or "unknown",
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+        }
+        job["status_url"] = f"/status/{job['job_id']}"
+        job["result_url"] = f"/result/{job['job_id']}"
+        do_profile = tasks.should_profile(_profile_requested(profile, x_profile))
+        jobs.append(job)
+        accepted.append((job["job_id"], data, do_profile))
+
+    palette = await run_in_threadpool(tasks.build_batch_palette, samples) if global_palette else None
+    batch_id = uuid.uuid4().hex
+    await run_in_threadpool(tasks.STORE.put_batch, batch_id, [job_id for job_id, _, _ in accepted])
+    for job_id, data, do_profile in accepted:
+        await _submit_job(
+            background_tasks, job_id, data, action, proxy_analysis, opts, palette, do_profile, max_pixels
+        )
+    return JSONResponse(
+        {
+            "action": action,
+            "batch_id": batch_id,
+            "global_palette": palette is not None,
+            "jobs": jobs,
+        }
+    )
+
+
+@app.post('/process_tree')
+async def process_tree(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    tree: str = Form(...),
+    proxy_analysis: bool = Form(False),
+    options: str = Form(""),
+    max_pixels: int | None = Form(None),
+):
+    """Several pipelines on one upload, e.g.
+    ``trim|orientation -> {bleach, denoise, shadow|sharpen}`` (see
+    tasks.parse_tree): the image is decoded once, every shared prefix runs
+    once, and each leaf gets its own job id."""
+    try:
+        leaves = tasks.parse_tree(tree)
+    except ValueError as e:
+        return Response(content=f"Invalid tree: {e}", status_code=400)
+    try:
+        opts = tasks.parse_options(options)
+    except ValueError as e:
+        return Response(content=f"Invalid options: {e}", status_code=400)
+    if max_pixels is not None and max_pixels < 0:
+        return Response(content="Invalid max_pixels", status_code=400)
+
+    data = await file.read()
+    # only the header is read here; the job decodes
+    try:
+        header = await run_in_threadpool(check_header, data)
+    except ImageTooLarge as e:
+        return Response(content=str(e), status_code=413)
+    if header is None:
+        return Response(content="Invalid image", status_code=400)
 
+    jobs = []
+    for leaf in leaves:
         job_id = uuid.uuid4().hex
-        background_tasks.add_task(tasks.process_job_bg, job_id, data, action)
         jobs.append(
             {
-                "filename": up.filename or "unknown",
+                "pipeline": "|".join(leaf),
                 "job_id": job_id,
                 "status": "queued",
                 "status_url": f"/status/{job_id}",
                 "result_url": f"/result/{job_id}",
             }
         )
-    return JSONResponse({"action": action, "jobs": jobs})
+    # the leaves form a batch, so /status_batch can poll them together
+    tree_id = uuid.uuid4().hex
+    job_ids = [job["job_id"] for job in jobs]
+    await run_in_threadpool(tasks.STORE.put_batch, tree_id, job_ids)
+    await _submit_job(
+        background_tasks, tree_id, job_ids, data, leaves, proxy_analysis, opts, max_pixels,
+        func=tasks.process_tree_bg,
+    )
+    return JSONResponse({"tree": tree, "batch_id": tree_id, "jobs": jobs})
+
+
+def _job_status(job_id: str):
+    """(status payload, meta) of one job; unknown jobs are queued."""
+    status, meta = tasks.STORE.get_status((job_id or "").lower())
+    if status is None:
+        return {'id': job_id, 'status': 'queued'}, meta
+    out = {'id': job_id, 'status': status}
+    if "elapsed_ms" in meta:
+        out["elapsed_ms"] = meta.get("elapsed_ms")
+    if "error" in meta:
+        out["error"] = meta.get("error")
+    if "url" in meta.get("profile", {}):
+        out["profile_url"] = meta["profile"]["url"]
+    return out, meta
+
+
+# Handlers that only read from the store are plain functions: FastAPI runs
+# them on its thread pool, so disk access never blocks the event loop.
+@app.get('/status/{job_id}')
+def job_status(job_id: str):
+    out, _ = _job_status(job_id)
+    return JSONResponse(out)
 
 
-@app.get('/status/{job_id}')
-async def job_status(job_id: str):
-    status_path = os.path.join(RESULT_DIR, f'{job_id}.status')
-    result_path = os.path.join(RESULT_DIR, f'{job_id}.jpg')
-    meta = _load_job_meta(job_id)
-    if os.path.exists(status_path):
-        with open(status_path, 'r', encoding='utf-8') as f:
-            status = f.read().strip()
-        # Guard against race: mark finished only when status says finished
-        # and the final result file already exists.
-        if status == "finished" and not os.path.exists(result_path):
-            status = "processing"
-        out = {'id': job_id, 'status': status}
-        if "elapsed_ms" in meta:
-            out["elapsed_ms"] = meta.get("elapsed_ms")
-        if "error" in meta:
-            out["error"] = meta.get("error")
-        return JSONResponse(out)
-    if os.path.exists(result_path):
-        # Backward compatibility for legacy files without status sidecar.
-        out = {'id': job_id, 'status': 'finished'}
-        if "elapsed_ms" in meta:
-            out["elapsed_ms"] = meta.get("elapsed_ms")
-        if "error" in meta:
-            out["error"] = meta.get("error")
-        return JSONResponse(out)
-    return JSONResponse({'id': job_id, 'status': 'queued'})
+def _bulk_status(ids, since):
+    jobs = []
+    counts = {}
+    for job_id in ids:
+        out, meta = _job_status(job_id)
+        counts[out['status']] = counts.get(out['status'], 0) + 1
+        if since is None or meta.get("updated_at", 0) > since:
+            jobs.append(out)
+    return jobs, counts
+
+
+@app.post('/status_batch')
+async def batch_status(request: Request):
+    """Status of many jobs in one request.
+
+    Body: ``ids`` (list of job ids) and / or ``batch_id`` (from
+    /process_async_batch), optionally ``since``: the ``cursor`` of a previous
+    response, to get only the jobs that changed after it. ``counts`` always
+    covers all requested jobs.
+    """
+    try:
+        payload = await request.json()
+    except Exception:
+        payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
+
+    ids = [rid for rid in payload.get("ids") or [] if isinstance(rid, str)]
+    batch_id = payload.get("batch_id")
+    if batch_id:
+        batch = await run_in_threadpool(tasks.STORE.get_batch, str(batch_id).lower())
+        if batch is None:
+            return Response(content="Batch not found", status_code=404)
+        ids += batch
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_STATUS_IDS:
+        return Response(content=f"Too many ids (max {MAX_STATUS_IDS})", status_code=400)
+    since = payload.get("since")
+    if since is not None and not isinstance(since, (int, float)):
+        return Response(content="Invalid since", status_code=400)
+
+    # Jobs that change while the lookup runs are reported again next time,
+    # never skipped.
+    cursor = time.time() - STATUS_CURSOR_SLACK
+    jobs, counts = await run_in_threadpool(_bulk_status, ids, since)
+    return JSONResponse({"cursor": cursor, "total": len(ids), "counts": counts, "jobs": jobs})
 
 
 @app.get('/result/{job_id}')
-async def job_result(job_id: str):
-    result_path = os.path.join(RESULT_DIR, f'{job_id}.jpg')
-    if os.path.exists(result_path):
+def job_result(job_id: str):
+    ref = _result_ref(job_id)
+    if ref:
         # return as inline image
-        return FileResponse(result_path, media_type='image/jpeg')
+        return _blob_response(ref, 'image/jpeg')
     else:
         return Response(content='Result not ready', status_code=404)
 
 
 @app.get('/download/{job_id}')
-async def download_result(job_id: str):
+def download_result(job_id: str):
     """Download result as attachment for the given job_id."""
-    result_path = os.path.join(RESULT_DIR, f'{job_id}.jpg')
-    if os.path.exists(result_path):
-        return FileResponse(result_path, media_type='application/octet-stream', filename=f'{job_id}.jpg')
+    ref = _result_ref(job_id)
+    if ref:
+        return _blob_response(ref, 'application/octet-stream', filename=f'{job_id}.jpg')
     else:
         return Response(content='Result not ready', status_code=404)
 
 
+@app.get('/profile/{job_id}')
+def download_profile(job_id: str, format: str = "prof"):
+    """cProfile trace of a profiled job: raw pstats file, or format=text."""
+    if not re.fullmatch(r"[0-9a-fA-F]{32}", job_id):
+        return Response(content='Invalid id', status_code=400)
+    path = tasks.profile_path(job_id.lower())
+    if not os.path.exists(path):
+        return Response(content='Profile not found', status_code=404)
+    if format == "text":
+        return PlainTextResponse(tasks.profile_report(job_id.lower()))
+    return FileResponse(path, media_type='application/octet-stream', filename=f'{job_id.lower()}.prof')
+
+
 @app.post('/share')
 async def create_share_link(request: Request):
     try:
@@ -269,25 +582,23 @@ async def create_share_link(request: Request):
         payload = {}
 
     result_id = payload.get("result_id", "") if isinstance(payload, dict) else ""
-    result_path = _result_path_from_id(result_id)
-    if not result_path or not os.path.exists(result_path):
+    if not await run_in_threadpool(_result_ref, result_id):
         return Response(content="Result not found", status_code=404)
 
-    token = _create_share_token(result_id)
-    base = _build_share_base_url(request)
+    token = await run_in_threadpool(_create_share_token, result_id)
+    base = await run_in_threadpool(_build_share_base_url, request)
     share_url = f"{base}/share/{token}"
     return JSONResponse({"token": token, "share_url": share_url})
 
 
 @app.get('/share/{token}')
-async def shared_page(token: str):
+def shared_page(token: str):
     db = _load_share_db()
     result_id = db.get(token)
     if not result_id:
         return Response(content="Share link is invalid or expired", status_code=404)
 
-    result_path = _result_path_from_id(result_id)
-    if not result_path or not os.path.exists(result_path):
+    if not _result_ref(result_id):
         return Response(content="Shared result not found", status_code=404)
 
     html = f"""<!doctype html>
@@ -314,79 +625,54 @@ async def shared_page(token: str):
 
 
 @app.get('/share/{token}/image')
-async def shared_image(token: str):
+def shared_image(token: str):
     db = _load_share_db()
     result_id = db.get(token)
     if not result_id:
         return Response(content="Share link is invalid or expired", status_code=404)
 
-    result_path = _result_path_from_id(result_id)
-    if not result_path or not os.path.exists(result_path):
+    ref = _result_ref(result_id)
+    if not ref:
         return Response(content="Shared result not found", status_code=404)
 
-    return FileResponse(result_path, media_type='image/jpeg')
+    return _blob_response(ref, 'image/jpeg')
 
 
-@app.post('/download_all')
-async def download_all_results(request: Request):
-    """Package only current-session result ids provided by client."""
-    try:
-        payload = await request.json()
-    except Exception:
-        payload = {}
-
-    ids = payload.get("ids", []) if isinstance(payload, dict) else []
+def _zip_results(ids):
     picked = []
     seen = set()
     for rid in ids:
         if not isinstance(rid, str) or rid in seen:
             continue
         seen.add(rid)
-        p = _result_path_from_id(rid)
-        if p and os.path.exists(p):
-            picked.append((rid, p))
-
+        ref = _result_ref(rid)
+        if ref:
+            picked.append((rid, ref))
     if not picked:
-        return Response(content='No result files for this session', status_code=404)
+        return None
 
     mem = io.BytesIO()
     with zipfile.ZipFile(mem, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
-        for rid, p in picked:
-            zf.write(p, arcname=f'{rid}.jpg')
+        for rid, ref in picked:
+            if ref.data is not None:
+                zf.writestr(f'{rid}.jpg', ref.data)
+                continue
+            with open(ref.path, 'rb') as f:
+                f.seek(ref.offset)
+                zf.writestr(f'{rid}.jpg', f.read(ref.length))
     mem.seek(0)
-
-    headers = {'Content-Disposition': 'attachment; filename="results.zip"'}
-    return StreamingResponse(mem, media_type='application/zip', headers=headers)
+    return mem
 
 
-@app.post('/clear_results')
-async def clear_results(request: Request):
-    """Delete session result/status files provided by client ids."""
-    try:
-        payload = await request.json()
-    except Exception:
-        payload = {}
-
-    ids = payload.get("ids", []) if isinstance(payload, dict) else []
+def _clear_results(ids):
     removed = 0
     seen = set()
     for rid in ids:
         if not isinstance(rid, str) or rid in seen:
             continue
         seen.add(rid)
-        p = _result_path_from_id(rid)
-        if p and os.path.exists(p):
-            os.remove(p)
-            removed += 1
-        if re.fullmatch(r"[0-9a-fA-F]{32}", rid):
-            status_path = os.path.join(RESULT_DIR, f'{rid.lower()}.status')
-            if os.path.exists(status_path):
-                os.remove(status_path)
-                removed += 1
-            meta_path = os.path.join(RESULT_DIR, f'{rid.lower()}.meta.json')
-            if os.path.exists(meta_path):
-                os.remove(meta_path)
-                removed += 1
+        if _result_id(rid):
+            removed += tasks.STORE.delete(_result_id(rid))
 
     # Remove share entries pointing to deleted results.
     db = _load_share_db()
@@ -395,5 +681,35 @@ async def clear_results(request: Request):
         filtered = {k: v for k, v in db.items() if v not in deleted_ids}
         if filtered != db:
             _save_share_db(filtered)
+    return removed
+
+
+@app.post('/download_all')
+async def download_all_results(request: Request):
+    """Package only current-session result ids provided by client."""
+    try:
+        payload = await request.json()
+    except Exception:
+        payload = {}
+
+    ids = payload.get("ids", []) if isinstance(payload, dict) else []
+    mem = await run_in_threadpool(_zip_results, ids)
+    if mem is None:
+        return Response(content='No result files for this session', status_code=404)
+
+    headers = {'Content-Disposition': 'attachment; filename="results.zip"'}
+    return StreamingResponse(mem, media_type='application/zip', headers=headers)
+
+
+@app.post('/clear_results')
+async def clear_results(request: Request):
+    """Delete session result/status files provided by client ids."""
+    try:
+        payload = await request.json()
+    except Exception:
+        payload = {}
 
+    ids = payload.get("ids", []) if isinstance(payload, dict) else []
+    removed = await run_in_threadpool(_clear_results, ids)
     return JSONResponse({'removed': removed})
+
@@ -0,0 +1,224 @@
+"""Offline batch processing without the web server.
+
+Runs a pipeline over image files, directories or globs on a pool of worker
+processes. Each worker loads the models once (by importing web.tasks) and
+then processes files by path, so images never travel through HTTP or
+between processes. Outputs are written atomically; files whose output
+already exists are skipped, so an interrupted run can simply be restarted.
+
+    python -m web.batch scans/ "archive/*.png" -a "trim|orientation|shadow" -o out/
+    python -m web.batch scans/ -a bleach -o out/ --options '{"bleach": {"window_size": 25}}' -j 4
+"""
+import glob
+import multiprocessing as mp
+import os
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+_tasks = None
+
+
+def _init_worker(threads):
+    # Models are loaded on import, once per worker process.
+    global _tasks
+    import cv2
+    cv2.setNumThreads(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from web import tasks
+    # every file is new: no pipeline prefix to reuse, so skip the copies
+    tasks.STEP_CACHE = None
+    _tasks = tasks
+
+
+def _parse_options(options):
+    # runs in a worker: only the workers import web.tasks
+    return _tasks.parse_options(options)
+
+
+def parse_steps(action):
+    """Check the step names of ``action`` against the planner's step table,
+    so that the parent process never imports web.tasks (and its models)."""
+    from web.pipeline import STEP_SPECS
+    steps = [a.strip().lower() for a in action.replace(',', '|').split('|') if a.strip()]
+    if not steps:
+        raise ValueError('Action is required')
+    invalid = [a for a in steps if a not in STEP_SPECS]
+    if invalid:
+        raise ValueError('Unknown action(s): {}'.format(', '.join(invalid)))
+    return steps
+
+
+def _process_file(src, dst, action, proxy_analysis, options, max_pixels=None):
+    t0 = time.perf_counter()
+    with open(src, 'rb') as f:
+        data = f.read()
+    out = _tasks.process_image_bytes(data, action, proxy_analysis, options,
+                                     ext=os.path.splitext(dst)[1], max_pixels=max_pixels)
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp = dst + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(out)
+    os.replace(tmp, dst)
+    return len(data), time.perf_counter() - t0
+
+
+def collect_inputs(inputs, recursive=False):
+    """(source path, output path relative to the output dir) for every image.
+
+    Directories keep their inner structure; files and glob matches are
+    placed by file name. Each group is ordered by the trailing number in the
+    file name (see HandwritingDenoisingBeautifying.get_filenames).
+
+    Outputs are named by the input name without its extension, so raises
+    ValueError if two inputs would write the same output (page1.jpg and
+    page1.png, or two scan_001.jpg from different globs).
+    """
+    from function_method.HandwritingDenoisingBeautifying import get_filenames
+
+    def ordered(paths):
+        paths = [p for p in paths if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTS)]
+        return get_filenames(Namespace(filenames=paths, sort_numerically=True))
+
+    found, seen = [], set()
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, '**', '*') if recursive else os.path.join(item, '*')
+            pairs = [(p, os.path.relpath(p, item)) for p in ordered(glob.glob(pattern, recursive=recursive))]
+        else:
+            pairs = [(p, os.path.basename(p)) for p in ordered(glob.glob(item) or [item])]
+            if not pairs:
+                sys.stderr.write('warning: no images match {}\n'.format(item))
+        for src, rel in pairs:
+            key = os.path.abspath(src)
+            if key not in seen:
+                seen.add(key)
+                found.append((src, rel))
+
+    outputs = {}
+    for src, rel in found:
+        outputs.setdefault(output_key(rel), []).append(src)
+    clashes = [srcs for srcs in outputs.values() if len(srcs) > 1]
+    if clashes:
+        raise ValueError('inputs with the same output name: {}'.format(
+            '; '.join(', '.join(srcs) for srcs in clashes)))
+    return found
+
+
+def output_key(rel):
+    """What two inputs share when they map to the same output file."""
+    return os.path.normcase(os.path.normpath(os.path.splitext(rel)[0]))
+
+
+def _fmt_eta(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress:
+    """One status line on stderr: done / total, files/s, MB/s and ETA."""
+
+    def __init__(self, total):
+        self.total, self.done, self.failed, self.bytes = total, 0, 0, 0
+        self.t0 = time.perf_counter()
+        self.last = 0.0
+
+    def update(self, nbytes=0, failed=False):
+        self.done += 1
+        self.failed += int(failed)
+        self.bytes += nbytes
+        now = time.perf_counter()
+        if now - self.last < 0.5 and self.done < self.total:
+            return
+        self.last = now
+        elapsed = max(now - self.t0, 1e-9)
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if rate else 0
+        sys.stderr.write('\r{}/{} files  {:.2f} files/s  {:.1f} MB/s  failed {}  ETA {}   '.format(
+            self.done, self.total, rate, self.bytes / elapsed / 2 ** 20, self.failed, _fmt_eta(eta)))
+        sys.stderr.flush()
+
+
+def main():
+    parser = ArgumentParser(description='process images offline with a pipeline')
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-a', '--action', required=True, help='pipeline, e.g. "trim|orientation|shadow"')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('-f', '--format', default='jpg', choices=['jpg', 'png'], help='output format')
+    parser.add_argument('-j', '--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='worker processes (each loads its own models)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='OpenCV / torch threads per worker (default: cpus / workers)')
+    parser.add_argument('--options', default='', help='per-action options as JSON, as the web API takes')
+    parser.add_argument('--proxy-analysis', action='store_true', help='take geometric decisions on a proxy')
+    parser.add_argument('--max-pixels', type=int, default=None,
+                        help='pixel budget: decode larger inputs smaller (default: INPUT_PIXEL_BUDGET, 0 = off)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='descend into subdirectories')
+    parser.add_argument('--overwrite', action='store_true', help='reprocess files whose output exists')
+    args = parser.parse_args()
+
+    try:
+        parse_steps(args.action)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        inputs = collect_inputs(args.inputs, args.recursive)
+    except ValueError as e:
+        parser.error(str(e))
+    jobs, skipped = [], 0
+    for src, rel in inputs:
+        dst = os.path.join(args.output, os.path.splitext(rel)[0] + '.' + args.format)
+        if not args.overwrite and os.path.exists(dst):
+            skipped += 1
+            continue
+        jobs.append((src, dst))
+    print('{} to process, {} already done, {} worker(s)'.format(len(jobs), skipped, args.workers))
+    if not jobs:
+        return
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    progress = Progress(len(jobs))
+    failures = []
+    # spawn: workers import the models themselves instead of forking a
+    # process that already runs torch / OpenCV threads
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=mp.get_context('spawn'),
+                             initializer=_init_worker, initargs=(threads,)) as pool:
+        try:
+            options = pool.submit(_parse_options, args.options).result()
+        except ValueError as e:
+            parser.error(str(e))
+        futures = {pool.submit(_process_file, src, dst, args.action, args.proxy_analysis, options,
+                               args.max_pixels): src
+                   for src, dst in jobs}
+        try:
+            for future in as_completed(futures):
+                try:
+                    nbytes, _ = future.result()
+                    progress.update(nbytes)
+                except Exception as e:
+                    failures.append((futures[future], e))
+                    progress.update(failed=True)
+        except KeyboardInterrupt:
+            # finished outputs are complete files; rerun to resume
+            for future in futures:
+                future.cancel()
+            raise
+    sys.stderr.write('\n')
+    for src, e in failures:
+        print('failed: {}: {}'.format(src, e))
+    elapsed = time.perf_counter() - progress.t0
+    print('done: {} ok, {} failed in {:.1f} s'.format(len(jobs) - len(failures), len(failures), elapsed))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
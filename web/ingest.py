@@ -0,0 +1,123 @@
+"""Image decoding with size limits and a pixel budget.
+
+The header is read first (Pillow only parses it), so images over the hard
+limits are rejected before any pixel is decoded: a few kB of compressed
+data can otherwise expand to gigabytes (decompression bomb). Data whose
+format Pillow cannot identify is not decoded at all, since its size cannot
+be checked first.
+
+Images over the pixel budget are decoded smaller. JPEGs use libjpeg's DCT
+scaling (cv2.IMREAD_REDUCED_*, 1/2, 1/4 or 1/8) down to the smallest scale
+that still meets the budget, which is much cheaper than a full decode; the
+rest of the way, and other formats, are shrunk with INTER_AREA.
+
+    INPUT_MAX_PIXELS   hard limit on width * height (default 100 MP)
+    INPUT_MAX_SIDE     hard limit on the longer side (default 30000)
+    INPUT_PIXEL_BUDGET pixel budget, 0 = decode at full size (default)
+"""
+import io
+import os
+import warnings
+
+import cv2
+import numpy as np
+from PIL import Image
+
+MAX_INPUT_PIXELS = int(os.getenv('INPUT_MAX_PIXELS', str(100_000_000)))
+MAX_INPUT_SIDE = int(os.getenv('INPUT_MAX_SIDE', '30000'))
+PIXEL_BUDGET = int(os.getenv('INPUT_PIXEL_BUDGET', '0'))
+
+_REDUCED = {
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def image_header(data):
+    """(width, height, format, mode) from the header, or None if Pillow
+    does not know the format."""
+    try:
+        with warnings.catch_warnings():
+            # the limits are checked by the caller
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            im = Image.open(io.BytesIO(data))
+        return im.size[0], im.size[1], im.format, im.mode
+    except Image.DecompressionBombError:
+        # only raised far above Pillow's own limit; the size is not exposed
+        raise ImageTooLarge('Image too large')
+    except Exception:
+        return None
+
+
+def check_limits(w, h, max_pixels=None, max_side=None):
+    max_pixels = MAX_INPUT_PIXELS if max_pixels is None else max_pixels
+    max_side = MAX_INPUT_SIDE if max_side is None else max_side
+    if max_pixels and w * h > max_pixels:
+        raise ImageTooLarge(f'Image too large: {w}x{h} is over {max_pixels} pixels')
+    if max_side and max(w, h) > max_side:
+        raise ImageTooLarge(f'Image too large: {w}x{h}, longer side is over {max_side}')
+
+
+def check_header(data):
+    """The header (see image_header), or None if the format is not
+    identified. Raises ImageTooLarge if it announces an image over the hard
+    limits; nothing is decoded."""
+    header = image_header(data)
+    if header is not None:
+        check_limits(header[0], header[1])
+    return header
+
+
+def reduction_factor(w, h, budget):
+    """Largest JPEG scale denominator (1, 2, 4 or 8) that still leaves at
+    least ``budget`` pixels; fit_budget takes care of the rest."""
+    factor = 1
+    if budget:
+        for f in (2, 4, 8):
+            if -(-w // f) * -(-h // f) >= budget:
+                factor = f
+    return factor
+
+
+def fit_budget(img, budget):
+    h, w = img.shape[:2]
+    if not budget or w * h <= budget:
+        return img
+    scale = (budget / float(w * h)) ** 0.5
+    size = (max(1, int(w * scale)), max(1, int(h * scale)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def decode_image(data, pixel_budget=None, full_res=False):
+    """Decode ``data`` like cv2.imdecode(..., IMREAD_UNCHANGED), within the
+    hard limits and, unless ``full_res``, within ``pixel_budget`` (default
+    INPUT_PIXEL_BUDGET).
+
+    Returns (image, info); image is None if ``data`` is not an image or its
+    format is not identified from the header. info holds the original and
+    the decoded size. Raises ImageTooLarge.
+    """
+    budget = 0 if full_res else (PIXEL_BUDGET if pixel_budget is None else pixel_budget)
+    header = image_header(data)
+    if header is None:
+        return None, {}
+    w, h, fmt, mode = header
+    check_limits(w, h)
+    buf = np.frombuffer(data, np.uint8)
+    img = None
+    factor = reduction_factor(w, h, budget)
+    if fmt == 'JPEG' and factor > 1 and mode in ('L', 'RGB', 'YCbCr'):
+        color, gray = _REDUCED[factor]
+        # IMREAD_UNCHANGED ignores EXIF orientation; so must this
+        img = cv2.imdecode(buf, (gray if mode == 'L' else color) | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        img = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            return None, {}
+    img = fit_budget(img, budget)
+    return img, {'size': [w, h], 'decoded': [img.shape[1], img.shape[0]]}
@@ -0,0 +1,51 @@
+"""Where async jobs run, chosen with QUEUE_BACKEND:
+
+- ``inprocess`` (default): in the web server process after the response is
+  sent (FastAPI BackgroundTasks), as before.
+- ``rq``: enqueued on Redis (REDIS_URL, queue RQ_QUEUE) and run by RQ
+  workers on any host (``python -m web.worker``). Workers write status and
+  results to the result store, so it must be shared: RESULT_STORE=redis,
+  or a results folder every host mounts.
+"""
+import os
+
+from web.storage import redis_connection
+
+QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'inprocess')
+RQ_QUEUE = os.getenv('RQ_QUEUE', 'doc-image')
+RQ_JOB_TIMEOUT = int(os.getenv('RQ_JOB_TIMEOUT', '600'))
+
+
+class InProcessQueue:
+    name = 'inprocess'
+
+    def submit(self, background_tasks, job_id, func, *args):
+        background_tasks.add_task(func, job_id, *args)
+
+
+class RQQueue:
+    name = 'rq'
+
+    def __init__(self, connection, queue_name=RQ_QUEUE, timeout=RQ_JOB_TIMEOUT):
+        from rq import Queue
+        self.queue = Queue(queue_name, connection=connection)
+        self.timeout = timeout
+
+    def submit(self, background_tasks, job_id, func, *args):
+        # the job keeps our id; its return value is not needed (the job
+        # writes to the result store)
+        self.queue.enqueue(func, job_id, *args, job_id=job_id, job_timeout=self.timeout,
+                           result_ttl=0, failure_ttl=24 * 3600)
+
+    def depth(self):
+        return len(self.queue)
+
+
+def open_queue(kind=None, connection=None):
+    """Queue for ``kind`` (default QUEUE_BACKEND)."""
+    kind = (kind or QUEUE_BACKEND or 'inprocess').strip().lower()
+    if kind == 'inprocess':
+        return InProcessQueue()
+    if kind == 'rq':
+        return RQQueue(connection or redis_connection())
+    raise ValueError('Unknown QUEUE_BACKEND: {}'.format(kind))
@@ -0,0 +1,317 @@
+"""Load generator for the HTTP API.
+
+Drives /process, /process_async and /process_async_batch of a running
+server with a mix of images and pipelines and reports throughput, latency
+to finished (p50/p95/p99), error rates and how the job queue behaves over
+time. Latency is measured from a request's scheduled arrival, so time spent
+waiting for a free concurrency slot on the client counts too.
+
+Start a server (uvicorn web.app:app) and run from the project root, e.g.
+
+    python web/loadtest.py --endpoints process_async=3 process=1 \\
+        --images test/阴影.jpg=2 test/笔记1.jpg --pipelines bleach shadow "trim|orientation" \\
+        --rate 2 --concurrency 16 --duration 60 --json load.json
+
+Without --rate the generator runs closed-loop: --concurrency clients each
+send their next request as soon as the previous one has finished.
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+ENDPOINTS = ('process', 'process_async', 'process_async_batch')
+# server-side states reported by /status; "error" is a failed job
+DONE_STATES = ('finished', 'error')
+
+_local = threading.local()
+
+
+def _session():
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def parse_weighted(items):
+    """["a=3", "b"] -> (["a", "b"], [3.0, 1.0]); pipelines keep their "|"."""
+    names, weights = [], []
+    for item in items:
+        name, sep, weight = item.rpartition('=')
+        if not sep:
+            name, weight = item, '1'
+        names.append(name)
+        weights.append(float(weight))
+    return names, weights
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.base = args.url.rstrip('/')
+        self.rng = random.Random(args.seed)
+        self.endpoints, self.endpoint_weights = parse_weighted(args.endpoints)
+        self.pipelines, self.pipeline_weights = parse_weighted(args.pipelines)
+        paths, self.image_weights = parse_weighted(args.images)
+        self.images = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.images.append((os.path.basename(path), f.read()))
+        for endpoint in self.endpoints:
+            if endpoint not in ENDPOINTS:
+                raise ValueError('unknown endpoint: %s' % endpoint)
+        # one record per job: endpoint, action, image, arrive, sent, accepted, done, state, error
+        self.records = []
+        self.server_states = {}
+        self.waiting = 0
+        self.in_flight = 0
+        self.loop_lag = None
+        self.executor = ThreadPoolExecutor(max_workers=args.concurrency + 4)
+
+    def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    def _pick(self):
+        endpoint = self.rng.choices(self.endpoints, self.endpoint_weights)[0]
+        action = self.rng.choices(self.pipelines, self.pipeline_weights)[0]
+        n = self.args.batch_size if endpoint == 'process_async_batch' else 1
+        images = self.rng.choices(self.images, self.image_weights, k=n)
+        return endpoint, action, images
+
+    def _post(self, endpoint, action, images):
+        files = [('files' if endpoint == 'process_async_batch' else 'file', (name, data))
+                 for name, data in images]
+        return _session().post('%s/%s' % (self.base, endpoint), files=files,
+                               data={'action': action}, timeout=self.args.timeout)
+
+    async def _poll(self, rec, job_id):
+        deadline = rec['arrive'] + self.args.timeout
+        while time.perf_counter() < deadline:
+            try:
+                r = await self._call(_session().get, '%s/status/%s' % (self.base, job_id), timeout=10)
+                state = r.json().get('status', 'unknown') if r.status_code == 200 else 'http_%d' % r.status_code
+            except (requests.RequestException, ValueError) as e:
+                state, rec['error'] = 'unknown', str(e)
+            self.server_states[job_id] = state
+            if state in DONE_STATES:
+                rec['state'] = 'finished' if state == 'finished' else 'failed'
+                rec['done'] = time.perf_counter()
+                self.server_states.pop(job_id, None)
+                return
+            await asyncio.sleep(self.args.poll_interval)
+        rec['state'] = 'timeout'
+        self.server_states.pop(job_id, None)
+
+    async def one(self, slots, arrive):
+        endpoint, action, images = self._pick()
+        recs = [{'endpoint': endpoint, 'action': action, 'image': name, 'arrive': arrive,
+                 'sent': None, 'accepted': None, 'done': None, 'state': None, 'error': None}
+                for name, _ in images]
+        self.records.extend(recs)
+        self.waiting += 1
+        async with slots:
+            self.waiting -= 1
+            self.in_flight += 1
+            try:
+                await self._run(endpoint, action, images, recs)
+            finally:
+                self.in_flight -= 1
+
+    async def _run(self, endpoint, action, images, recs):
+        sent = time.perf_counter()
+        for rec in recs:
+            rec['sent'] = sent
+        try:
+            r = await self._call(self._post, endpoint, action, images)
+        except requests.RequestException as e:
+            for rec in recs:
+                rec['state'], rec['error'] = 'http_error', type(e).__name__
+            return
+        now = time.perf_counter()
+        if r.status_code != 200:
+            for rec in recs:
+                rec['state'], rec['error'] = 'http_%d' % r.status_code, r.text[:200]
+            return
+        for rec in recs:
+            rec['accepted'] = now
+        if endpoint == 'process':
+            recs[0]['state'], recs[0]['done'] = 'finished', now
+            return
+        if endpoint == 'process_async':
+            jobs = [r.json()]
+        else:
+            jobs = r.json().get('jobs', [])
+        polls = []
+        for rec, job in zip(recs, jobs):
+            if 'job_id' not in job:
+                rec['state'], rec['error'] = 'rejected', job.get('reason')
+                continue
+            polls.append(self._poll(rec, job['job_id']))
+        await asyncio.gather(*polls)
+
+    async def monitor(self, t0, stop):
+        """Print and keep one sample of the queue every --interval seconds."""
+        self.samples = []
+        print('{:>7}{:>8}{:>9}{:>8}{:>8}{:>11}{:>9}{:>10}'.format(
+            't s', 'waiting', 'inflight', 'queued', 'running', 'finished/s', 'errors', 'p95 s'))
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), self.args.interval)
+            except asyncio.TimeoutError:
+                pass
+            now = time.perf_counter()
+            states = Counter(self.server_states.values())
+            window = [r for r in self.records if r['done'] and r['done'] > now - self.args.interval]
+            done = [r for r in self.records if r['state'] is not None]
+            errors = sum(1 for r in done if r['state'] != 'finished')
+            lat = [r['done'] - r['arrive'] for r in window]
+            sample = {
+                't': round(now - t0, 2),
+                'waiting': self.waiting,
+                'in_flight': self.in_flight,
+                'server_queued': states.get('queued', 0),
+                'server_processing': states.get('processing', 0),
+                'finished_per_s': round(len(window) / self.args.interval, 3),
+                'errors': errors,
+                'p95_s': round(float(np.percentile(lat, 95)), 3) if lat else None,
+            }
+            self.samples.append(sample)
+            print('{t:>7.1f}{waiting:>8}{in_flight:>9}{server_queued:>8}{server_processing:>8}'
+                  '{finished_per_s:>11.2f}{errors:>9}{p95:>10}'.format(
+                      p95='-' if sample['p95_s'] is None else '%.3f' % sample['p95_s'], **sample))
+
+    def _loop_lag(self, reset=False):
+        # servers without /metrics/loop_lag report None
+        try:
+            r = _session().get('%s/metrics/loop_lag' % self.base, params={'reset': str(reset).lower()}, timeout=10)
+            lag = r.json() if r.status_code == 200 else None
+            return lag if isinstance(lag, dict) and 'max_ms' in lag else None
+        except (requests.RequestException, ValueError):
+            return None
+
+    async def run(self):
+        args = self.args
+        await self._call(self._loop_lag, True)
+        slots = asyncio.Semaphore(args.concurrency)
+        stop = asyncio.Event()
+        t0 = time.perf_counter()
+        monitor = asyncio.ensure_future(self.monitor(t0, stop))
+        tasks = []
+        end = t0 + args.duration
+        if args.rate > 0:
+            # open loop: Poisson arrivals, independent of how fast the server is
+            arrival = t0
+            while arrival < end and (not args.requests or len(tasks) < args.requests):
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.ensure_future(self.one(slots, arrival)))
+                arrival += self.rng.expovariate(args.rate)
+        else:
+            # closed loop: each client sends again once its request is done
+            count = [0]
+
+            async def client():
+                while time.perf_counter() < end and (not args.requests or count[0] < args.requests):
+                    count[0] += 1
+                    await self.one(slots, time.perf_counter())
+            tasks = [asyncio.ensure_future(client()) for _ in range(args.concurrency)]
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        await monitor
+        self.loop_lag = await self._call(self._loop_lag)
+        self.executor.shutdown(wait=False)
+        return self.summary(elapsed)
+
+    def summary(self, elapsed):
+        def block(records):
+            finished = [r for r in records if r['state'] == 'finished']
+            lat = [r['done'] - r['arrive'] for r in finished]
+            pct = {'p%d' % p: round(float(np.percentile(lat, p)), 3) if lat else None
+                   for p in (50, 95, 99)}
+            accept = [r['accepted'] - r['arrive'] for r in records if r['accepted']]
+            return dict(
+                jobs=len(records),
+                finished=len(finished),
+                throughput_per_s=round(len(finished) / elapsed, 3) if elapsed else None,
+                latency_s=pct,
+                accept_latency_p95_s=round(float(np.percentile(accept, 95)), 3) if accept else None,
+                error_rate=round(1 - len(finished) / float(len(records)), 4) if records else None,
+                errors=dict(Counter(r['state'] for r in records if r['state'] != 'finished')),
+            )
+
+        by_endpoint = {e: block([r for r in self.records if r['endpoint'] == e]) for e in self.endpoints}
+        by_action = {a: block([r for r in self.records if r['action'] == a]) for a in self.pipelines}
+        return {
+            'config': {k: v for k, v in vars(self.args).items() if k != 'json'},
+            'elapsed_s': round(elapsed, 2),
+            'total': block(self.records),
+            'by_endpoint': by_endpoint,
+            'by_action': by_action,
+            'server_loop_lag': self.loop_lag,
+            'timeline': self.samples,
+        }
+
+
+def print_summary(report):
+    print('\nelapsed {:.1f} s'.format(report['elapsed_s']))
+    print('{:<24}{:>7}{:>9}{:>9}{:>8}{:>8}{:>8}{:>8}'.format(
+        '', 'jobs', 'done', 'jobs/s', 'p50 s', 'p95 s', 'p99 s', 'errors'))
+    rows = [('total', report['total'])]
+    rows += sorted(report['by_endpoint'].items()) + sorted(report['by_action'].items())
+    for name, b in rows:
+        lat = b['latency_s']
+        print('{:<24}{:>7}{:>9}{:>9}{:>8}{:>8}{:>8}{:>7.1%}'.format(
+            name[:24], b['jobs'], b['finished'], b['throughput_per_s'],
+            *['-' if lat[p] is None else '%.3f' % lat[p] for p in ('p50', 'p95', 'p99')],
+            b['error_rate'] or 0.0))
+    if report['total']['errors']:
+        print('errors: ' + ', '.join('%s=%d' % kv for kv in report['total']['errors'].items()))
+    lag = report['server_loop_lag']
+    if lag:
+        print('server event loop: max stall {} ms, {} stall(s) >= {} ms'.format(
+            lag['max_ms'], lag['stalls'], lag['warn_ms']))
+
+
+def main():
+    parser = ArgumentParser(description='load test the image API')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--endpoints', nargs='+', default=['process_async'],
+                        help='endpoint mix as name[=weight], from %s' % ', '.join(ENDPOINTS))
+    parser.add_argument('--images', nargs='+', default=[os.path.join('test', '阴影.jpg')],
+                        help='image mix as path[=weight]')
+    parser.add_argument('--pipelines', nargs='+', default=['bleach'],
+                        help='pipeline mix as action[=weight], e.g. "trim|orientation=2"')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='max requests (or jobs being polled) in flight')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='mean arrivals per second (Poisson); 0 runs closed-loop')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of arrivals')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests (0: no limit)')
+    parser.add_argument('--batch-size', type=int, default=4, help='files per /process_async_batch request')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='seconds between /status polls')
+    parser.add_argument('--interval', type=float, default=5.0, help='seconds between timeline samples')
+    parser.add_argument('--timeout', type=float, default=300.0, help='per-job timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='write the report to this file')
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadTest(args).run())
+    print_summary(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Event-loop lag monitor.
+
+A task sleeps for ``interval`` seconds in a loop and records how much later
+than asked it woke up. Anything that blocks the event loop (CPU work or
+disk I/O in an ``async def`` handler) shows up as lag; the maximum is
+exported at /metrics/loop_lag so that regressions are visible.
+"""
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+LAG_WARN_MS = float(os.getenv('LOOP_LAG_WARN_MS', '100'))
+
+
+class LoopLagMonitor:
+    def __init__(self, interval=0.05, warn_ms=LAG_WARN_MS):
+        self.interval = interval
+        self.warn_ms = warn_ms
+        self._task = None
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.samples = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+        self.max_at = None
+        self.stalls = 0
+
+    def record(self, lag_ms):
+        self.samples += 1
+        self.total_ms += lag_ms
+        self.last_ms = lag_ms
+        if lag_ms > self.max_ms:
+            self.max_ms, self.max_at = lag_ms, time.time()
+        if lag_ms >= self.warn_ms:
+            self.stalls += 1
+            logger.warning('event loop blocked for %.0f ms', lag_ms)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, (loop.time() - t0 - self.interval) * 1000))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self, reset=False):
+        out = {
+            'since': self.since,
+            'samples': self.samples,
+            'interval_ms': self.interval * 1000,
+            'last_ms': round(self.last_ms, 1),
+            'mean_ms': round(self.total_ms / self.samples, 2) if self.samples else 0.0,
+            'max_ms': round(self.max_ms, 1),
+            'max_at': self.max_at,
+            'warn_ms': self.warn_ms,
+            'stalls': self.stalls,
+        }
+        if reset:
+            self.reset()
+        return out
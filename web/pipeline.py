@@ -0,0 +1,339 @@
+"""Pipeline planner: tracks the format of the intermediate image between steps.
+
+Every step declares the dtype, channel count and colour order it needs and
+what it produces. ``plan_pipeline`` walks the step list once, inserts only the
+conversions required to get from one step's output to the next step's input,
+and ``run_plan`` executes the result while counting copies/allocations.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+
+# Formats are plain tuples: (order, dtype, channels)
+#   order: "BGR", "RGB" or "GRAY"
+#   dtype: numpy dtype name, e.g. "uint8"
+#   channels: 1, 3 or 4
+
+# order=None means the step is order-agnostic (pure per-channel maths) and
+# returns the image in whatever order it received.
+STEP_SPECS = {
+    "bleach": {"order": "BGR", "channels": (1, 3, 4), "out": ("GRAY", 1)},
+    "orientation": {"order": None, "channels": (1, 3, 4), "out": None},
+    "sharpen": {"order": "BGR", "channels": (3,), "out": None},
+    "denoise": {"order": None, "channels": (3,), "out": None},
+    "shadow": {"order": None, "channels": (3,), "out": None},
+    "dewarp": {"order": "BGR", "channels": (3,), "out": None},
+    "trim": {"order": "BGR", "channels": (3,), "out": None},
+}
+
+# What cv2.imencode expects at the end of a pipeline.
+ENCODE_SPEC = {"order": "BGR", "channels": (1, 3), "out": None}
+
+
+def image_format(img):
+    """Describe an ndarray as an (order, dtype, channels) tuple.
+
+    cv2.imdecode always yields BGR(A) for colour images.
+    """
+    if img.ndim == 2:
+        return ("GRAY", img.dtype.name, 1)
+    channels = img.shape[2]
+    if channels == 1:
+        return ("GRAY", img.dtype.name, 1)
+    return ("BGR", img.dtype.name, channels)
+
+
+def _to_uint8(img):
+    if img.dtype == np.uint16:
+        return (img >> 8).astype(np.uint8)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def _drop_alpha(img):
+    # Order-preserving: BGRA -> BGR and RGBA -> RGB are the same operation.
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+
+
+def _gray_to_color(img):
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+
+def _swap_rb(img):
+    # cvtColor writes a contiguous buffer instead of a negative-stride view.
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+CONVERSIONS = {
+    "to_uint8": _to_uint8,
+    "drop_alpha": _drop_alpha,
+    "gray_to_color": _gray_to_color,
+    "swap_rb": _swap_rb,
+}
+
+
+def _conversions_for(fmt, spec):
+    """Return (conversion names, resulting format) to satisfy ``spec``."""
+    order, dtype, channels = fmt
+    ops = []
+    if dtype != "uint8":
+        ops.append("to_uint8")
+        dtype = "uint8"
+    wanted = spec["channels"]
+    if channels not in wanted:
+        if channels == 4 and 3 in wanted:
+            ops.append("drop_alpha")
+            channels = 3
+        elif channels == 1 and 3 in wanted:
+            ops.append("gray_to_color")
+            order, channels = "BGR", 3
+        else:
+            raise ValueError(f"Cannot convert {channels}-channel image to {wanted}")
+    if spec["order"] is not None and order not in ("GRAY", spec["order"]):
+        ops.append("swap_rb")
+        order = spec["order"]
+    return ops, (order, dtype, channels)
+
+
+def convert_for_step(img, step):
+    """Convert ``img`` to the input format of ``step`` without running it."""
+    ops, _ = _conversions_for(image_format(img), STEP_SPECS[step])
+    for op in ops:
+        img = CONVERSIONS[op](img)
+    return img
+
+
+def _output_format(fmt, spec):
+    if spec["out"] is None:
+        return fmt
+    order, channels = spec["out"]
+    return (order, "uint8", channels)
+
+
+def plan_pipeline(steps, fmt, target=ENCODE_SPEC):
+    """Build an execution plan for ``steps`` starting from format ``fmt``.
+
+    The plan is a list of ("convert", name) and ("step", name) entries and
+    ends with the conversions needed to reach ``target`` (JPEG encoding by
+    default; pass None to leave the last step's output untouched).
+    """
+    plan = []
+    for step in steps:
+        spec = STEP_SPECS[step]
+        ops, fmt = _conversions_for(fmt, spec)
+        plan.extend(("convert", op) for op in ops)
+        plan.append(("step", step))
+        fmt = _output_format(fmt, spec)
+    if target is not None:
+        ops, fmt = _conversions_for(fmt, target)
+        plan.extend(("convert", op) for op in ops)
+    return plan, fmt
+
+
+def new_stats():
+    return {"allocations": 0, "copies": 0, "copy_bytes": 0, "conversions": [], "cached_steps": 0}
+
+
+def run_plan(img, plan, run_step, stats=None, run_geometry=None, checkpoint=None):
+    """Execute ``plan`` on ``img``; ``run_step(img, name)`` runs one action
+    and ``run_geometry(img, steps)`` a fused geometric run (proxy mode).
+
+    ``stats`` (see ``new_stats``) is updated in place with the number of
+    conversion copies, their size, and every fresh buffer produced by a step.
+    Step outputs that come back as non-contiguous views are made contiguous
+    once here, instead of being copied again by every later OpenCV call.
+    ``checkpoint(i, out)`` is called with the output of every step entry
+    (``i`` indexes ``plan``), e.g. to cache intermediates.
+    """
+    if stats is None:
+        stats = new_stats()
+    out = img
+    for index, (kind, name) in enumerate(plan):
+        if kind == "convert":
+            out = CONVERSIONS[name](out)
+            stats["conversions"].append(name)
+            stats["copies"] += 1
+            stats["copy_bytes"] += out.nbytes
+            stats["allocations"] += 1
+            continue
+        prev = out
+        if kind == "geometry":
+            out = run_geometry(out, name)
+        else:
+            out = run_step(out, name)
+        if not np.shares_memory(out, prev):
+            stats["allocations"] += 1
+        if not out.flags.c_contiguous:
+            out = np.ascontiguousarray(out)
+            stats["conversions"].append("contiguous")
+            stats["copies"] += 1
+            stats["copy_bytes"] += out.nbytes
+            stats["allocations"] += 1
+        if checkpoint is not None:
+            checkpoint(index, out)
+    return out, stats
+
+
+class StepCache:
+    """Intermediate images by key, least recently used first out once
+    ``max_bytes`` is exceeded.
+
+    Arrays are copied in and out, so steps that work in place can neither
+    change a cached entry nor be handed one that someone else changes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            img = self._items.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+        return img.copy()
+
+    def put(self, key, img):
+        if img.nbytes > self.max_bytes:
+            return
+        img = img.copy()
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._items[key] = img
+            self.nbytes += img.nbytes
+            while self.nbytes > self.max_bytes:
+                _, dropped = self._items.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+
+    def info(self):
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# ---------------------------------------------------------------------------
+# Proxy-resolution geometry
+#
+# Geometric steps (trim, orientation, dewarp) only need a small image to make
+# their decision. In proxy mode a run of consecutive geometric steps becomes a
+# single ("geometry", steps) entry: decisions are taken on one shared
+# downscaled proxy, turned into backward maps at full resolution and applied
+# to the full image with a single remap.
+
+def fuse_geometry(plan, geometric):
+    """Collapse runs of geometric steps in ``plan`` into ("geometry", steps).
+
+    Conversions are per-pixel, so the ones inside a run are hoisted in front
+    of it; they commute with any remap.
+    """
+    fused = []
+    i = 0
+    while i < len(plan):
+        j, run_end, steps = i, i, []
+        while j < len(plan) and (plan[j][0] == "convert" or plan[j][1] in geometric):
+            if plan[j][0] == "step":
+                steps.append(plan[j][1])
+                run_end = j + 1
+            j += 1
+        if steps:
+            fused.extend(e for e in plan[i:run_end] if e[0] == "convert")
+            fused.append(("geometry", tuple(steps)))
+            i = run_end
+        else:
+            fused.append(plan[i])
+            i += 1
+    return fused
+
+
+def make_proxy(img, max_side):
+    """Downscale ``img`` so its longer side is at most ``max_side``.
+
+    Returns (proxy, scale) with proxy ~= img * scale; small images are
+    returned as-is with scale 1.0.
+    """
+    h, w = img.shape[:2]
+    if max(h, w) <= max_side:
+        return img, 1.0
+    scale = max_side / float(max(h, w))
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA), scale
+
+
+def perspective_transform(m_inv, in_size, size, fill):
+    """Backward 3x3 matrix (output -> input pixel) with sizes as (w, h)."""
+    return {"kind": "perspective", "m": np.asarray(m_inv, dtype=np.float64),
+            "in_size": tuple(in_size), "size": tuple(size), "fill": fill}
+
+
+def grid_transform(bm, in_size, fill):
+    """Backward map of normalized [-1, 1] source coordinates (grid_sample
+    convention, align_corners=False), stretched over the whole output."""
+    return {"kind": "grid", "bm": np.ascontiguousarray(bm, dtype=np.float32),
+            "in_size": tuple(in_size), "size": tuple(in_size), "fill": fill}
+
+
+def _backward(t, mx, my):
+    if t["kind"] == "perspective":
+        # python floats keep the maps in float32
+        (a, b, c), (d, e, f), (g, h, i) = t["m"].tolist()
+        den = g * mx + h * my + i
+        return (a * mx + b * my + c) / den, (d * mx + e * my + f) / den
+    bm = t["bm"]
+    w, h = t["size"]
+    bh, bw = bm.shape[:2]
+    # same sampling as cv2.resize(bm, (w, h)) followed by grid_sample
+    sx = ((mx + 0.5) * (bw / w) - 0.5).astype(np.float32)
+    sy = ((my + 0.5) * (bh / h) - 0.5).astype(np.float32)
+    g = cv2.remap(bm, sx, sy, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    in_w, in_h = t["in_size"]
+    return ((g[:, :, 0] + 1) * in_w - 1) / 2, ((g[:, :, 1] + 1) * in_h - 1) / 2
+
+
+def apply_geometry(img, transforms, band_pixels=1 << 20):
+    """Apply a chain of backward transforms to ``img`` with one remap.
+
+    The output is produced in row bands of about ``band_pixels`` pixels so
+    the coordinate maps never exist at full size. A pixel that falls outside
+    a step's input takes that step's fill value, as it would have when the
+    steps ran one after another.
+    """
+    out_w, out_h = transforms[-1]["size"]
+    out = np.empty((out_h, out_w) + img.shape[2:], dtype=img.dtype)
+    xs = np.arange(out_w, dtype=np.float32)
+    rows = max(1, band_pixels // max(out_w, 1))
+    for y0 in range(0, out_h, rows):
+        y1 = min(out_h, y0 + rows)
+        mx = np.repeat(xs[None, :], y1 - y0, axis=0)
+        my = np.repeat(np.arange(y0, y1, dtype=np.float32)[:, None], out_w, axis=1)
+        fill = np.full(mx.shape, -1, dtype=np.int16)
+        for t in reversed(transforms):
+            mx, my = _backward(t, mx, my)
+            in_w, in_h = t["in_size"]
+            outside = (mx < -0.5) | (my < -0.5) | (mx > in_w - 0.5) | (my > in_h - 0.5)
+            fill[outside & (fill < 0)] = t["fill"]
+        band = cv2.remap(img, mx.astype(np.float32), my.astype(np.float32),
+                         cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        mask = fill >= 0
+        if mask.any():
+            values = fill[mask].astype(img.dtype)
+            band[mask] = values if band.ndim == 2 else values[:, None]
+        out[y0:y1] = band
+    return out
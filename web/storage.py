@@ -0,0 +1,446 @@
+"""Result storage for the web service.
+
+A job has a result image, a status and a meta dict (plus an optional
+cProfile trace). The layout is chosen with the RESULT_STORE environment
+variable:
+
+- ``flat`` (default): <id>.jpg, <id>.status and <id>.meta.json side by side
+  in web/results, as before.
+- ``sharded``: the same files under web/results/<id[:2]>/<id[2:4]>/, so no
+  directory holds more than a few hundred entries.
+- ``pack``: result images are appended to pack files and status / meta to
+  an append-only index log; a job costs no inode at all.
+- ``redis``: everything in Redis (REDIS_URL), shared by the web server and
+  RQ workers on other hosts (see web.jobqueue); entries expire after
+  RESULT_TTL seconds.
+
+Readers get a BlobRef (path, offset, length) and serve the bytes straight
+from the file; the Redis store hands the bytes over in ``data``. Commits stay atomic: files are written to a temp name and
+renamed; in a pack the blob is written first and the index record that
+points at it is the commit, so a crash can leave unreferenced bytes in a
+pack but never a half-written result. Space of deleted results in packs is
+given back by ``python -m web.storage compact`` (with the service stopped).
+"""
+import json
+import os
+import re
+import threading
+import uuid
+from argparse import ArgumentParser
+from collections import namedtuple
+
+BlobRef = namedtuple('BlobRef', 'path offset length data', defaults=(None,))
+
+_APPEND_FLAGS = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+
+PACK_MAX_BYTES = 256 * 2 ** 20
+INDEX_NAME = 'index.log'
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+RESULT_TTL = int(os.getenv('RESULT_TTL', str(7 * 24 * 3600)))
+
+_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+
+def _valid_id(job_id):
+    return isinstance(job_id, str) and _ID_RE.fullmatch(job_id) is not None
+
+
+def _write_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class FileStore:
+    """One file per item, flat or sharded into <id[:2]>/<id[2:4]>/."""
+
+    def __init__(self, root, shard=False):
+        self.root = root
+        self.shard = shard
+        os.makedirs(root, exist_ok=True)
+
+    def _dir(self, job_id):
+        if self.shard:
+            return os.path.join(self.root, job_id[:2], job_id[2:4])
+        return self.root
+
+    def path(self, job_id, suffix, create=False):
+        folder = self._dir(job_id)
+        if create:
+            os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, job_id + suffix)
+
+    def profile_path(self, job_id, create=False):
+        return self.path(job_id, '.prof', create)
+
+    def put_result(self, job_id, data):
+        _write_atomic(self.path(job_id, '.jpg', create=True), data)
+
+    def put_status(self, job_id, status, meta):
+        _write_atomic(self.path(job_id, '.status', create=True), status.encode('utf-8'))
+        _write_atomic(self.path(job_id, '.meta.json'), json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+
+    def commit(self, job_id, data, meta):
+        """Store the result and mark the job finished."""
+        self.put_result(job_id, data)
+        self.put_status(job_id, 'finished', meta)
+
+    def put_batch(self, batch_id, job_ids):
+        _write_atomic(self.path(batch_id, '.batch.json', create=True), json.dumps(job_ids).encode('utf-8'))
+
+    def get_batch(self, batch_id):
+        """Job ids of a batch, or None."""
+        if not _valid_id(batch_id):
+            return None
+        try:
+            with open(self.path(batch_id, '.batch.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def result_ref(self, job_id):
+        if not _valid_id(job_id):
+            return None
+        p = self.path(job_id, '.jpg')
+        try:
+            return BlobRef(p, 0, os.path.getsize(p))
+        except OSError:
+            return None
+
+    def read_result(self, job_id):
+        ref = self.result_ref(job_id)
+        if ref is None:
+            return None
+        with open(ref.path, 'rb') as f:
+            return f.read()
+
+    def get_meta(self, job_id):
+        if not _valid_id(job_id):
+            return {}
+        try:
+            with open(self.path(job_id, '.meta.json'), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def get_status(self, job_id):
+        """(status, meta); status is None for unknown jobs."""
+        if not _valid_id(job_id):
+            return None, {}
+        has_result = os.path.exists(self.path(job_id, '.jpg'))
+        try:
+            with open(self.path(job_id, '.status'), 'r', encoding='utf-8') as f:
+                status = f.read().strip()
+        except OSError:
+            # legacy results without a status sidecar
+            status = 'finished' if has_result else None
+        # Guard against race: finished only once the result file exists.
+        if status == 'finished' and not has_result:
+            status = 'processing'
+        return status, self.get_meta(job_id) if status else {}
+
+    def delete(self, job_id):
+        """Remove everything stored for ``job_id``; returns the item count."""
+        if not _valid_id(job_id):
+            return 0
+        removed = 0
+        for suffix in ('.jpg', '.status', '.meta.json', '.prof', '.batch.json'):
+            p = self.path(job_id, suffix)
+            if os.path.exists(p):
+                os.remove(p)
+                removed += 1
+        return removed
+
+
+class PackStore:
+    """Result blobs in append-only pack files, status and meta in an index.
+
+    Every process appends to a pack of its own (pack-<random>.dat), so the
+    offset of a blob is known without locking other writers out. The index
+    is a log of JSON lines, each written with a single O_APPEND write; the
+    last record of an id wins. Other processes' records are picked up by
+    reading the new tail of the log on access.
+    """
+
+    def __init__(self, root, max_pack_bytes=PACK_MAX_BYTES):
+        self.root = root
+        self.dir = os.path.join(root, 'packs')
+        self.index_path = os.path.join(self.dir, INDEX_NAME)
+        self.max_pack_bytes = max_pack_bytes
+        self.entries = {}
+        self._index_pos = 0
+        self._pack = None  # (path, fd, size) of the pack this process writes
+        self._lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+        self._index_fd = os.open(self.index_path, _APPEND_FLAGS, 0o644)
+        # a record torn by a crash must not swallow the next one
+        size = os.fstat(self._index_fd).st_size
+        if size:
+            with open(self.index_path, 'rb') as f:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    os.write(self._index_fd, b'\n')
+        self._refresh()
+
+    def _refresh(self):
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_pos)
+            tail = f.read()
+        end = tail.rfind(b'\n') + 1
+        for line in tail[:end].splitlines():
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec.get('deleted'):
+                self.entries.pop(rec['id'], None)
+            else:
+                entry = self.entries.setdefault(rec['id'], {})
+                entry.update({k: v for k, v in rec.items() if k != 'id'})
+        self._index_pos += end
+
+    def _append_index(self, rec):
+        line = json.dumps(rec, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._lock:
+            _write_all(self._index_fd, line)
+            self._refresh()
+
+    def _append_blob(self, data):
+        with self._lock:
+            if self._pack is None or self._pack[2] >= self.max_pack_bytes:
+                if self._pack is not None:
+                    os.close(self._pack[1])
+                path = os.path.join(self.dir, 'pack-%s.dat' % uuid.uuid4().hex[:12])
+                self._pack = (path, os.open(path, _APPEND_FLAGS, 0o644), 0)
+            path, fd, offset = self._pack
+            _write_all(fd, data)
+            self._pack = (path, fd, offset + len(data))
+        return [os.path.basename(path), offset, len(data)]
+
+    def _entry(self, job_id):
+        if not _valid_id(job_id):
+            return None
+        with self._lock:
+            self._refresh()
+        return self.entries.get(job_id)
+
+    def profile_path(self, job_id, create=False):
+        folder = os.path.join(self.root, 'profiles', job_id[:2])
+        if create:
+            os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, job_id + '.prof')
+
+    def put_result(self, job_id, data):
+        self._append_index({'id': job_id, 'blob': self._append_blob(data)})
+
+    def put_status(self, job_id, status, meta):
+        self._append_index({'id': job_id, 'status': status, 'meta': meta})
+
+    def commit(self, job_id, data, meta):
+        # one record: the result becomes visible together with "finished"
+        self._append_index({'id': job_id, 'blob': self._append_blob(data), 'status': 'finished', 'meta': meta})
+
+    def put_batch(self, batch_id, job_ids):
+        self._append_index({'id': batch_id, 'jobs': job_ids})
+
+    def get_batch(self, batch_id):
+        entry = self._entry(batch_id)
+        return entry.get('jobs') if entry else None
+
+    def result_ref(self, job_id):
+        entry = self._entry(job_id)
+        if not entry or 'blob' not in entry:
+            return None
+        name, offset, length = entry['blob']
+        return BlobRef(os.path.join(self.dir, name), offset, length)
+
+    def read_result(self, job_id):
+        ref = self.result_ref(job_id)
+        if ref is None:
+            return None
+        with open(ref.path, 'rb') as f:
+            f.seek(ref.offset)
+            return f.read(ref.length)
+
+    def get_meta(self, job_id):
+        entry = self._entry(job_id)
+        return dict(entry.get('meta') or {}) if entry else {}
+
+    def get_status(self, job_id):
+        entry = self._entry(job_id)
+        if not entry:
+            return None, {}
+        status = entry.get('status') or ('finished' if 'blob' in entry else None)
+        if status == 'finished' and 'blob' not in entry:
+            status = 'processing'
+        return status, dict(entry.get('meta') or {})
+
+    def delete(self, job_id):
+        entry = self._entry(job_id)
+        removed = 0
+        if entry:
+            self._append_index({'id': job_id, 'deleted': True})
+            removed = 1
+        p = self.profile_path(job_id)
+        if os.path.exists(p):
+            os.remove(p)
+            removed += 1
+        return removed
+
+    def compact(self):
+        """Copy live blobs into new packs and rewrite the index without
+        superseded or deleted records. Run with no other process using the
+        store."""
+        with self._lock:
+            self._refresh()
+        old_packs = {name for name in os.listdir(self.dir) if name.startswith('pack-') and name.endswith('.dat')}
+        if self._pack is not None:
+            os.close(self._pack[1])
+            self._pack = None
+        records = []
+        for job_id, entry in self.entries.items():
+            rec = dict(entry, id=job_id)
+            if 'blob' in entry:
+                rec['blob'] = self._append_blob(self.read_result(job_id))
+            records.append(rec)
+        if self._pack is not None:
+            os.fsync(self._pack[1])
+            os.close(self._pack[1])
+        lines = b''.join(json.dumps(r, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+                         for r in records)
+        os.close(self._index_fd)
+        _write_atomic(self.index_path, lines)
+        for name in old_packs:
+            os.remove(os.path.join(self.dir, name))
+        self.__init__(self.root, self.max_pack_bytes)
+        return len(records)
+
+
+class RedisStore:
+    """Results, status and meta in one Redis hash per job.
+
+    A finished job is written in one MULTI / EXEC transaction, so readers
+    on any host see the result and "finished" together. Profiles stay in
+    files under ``root`` on the host that ran the job.
+    """
+
+    def __init__(self, connection, root, prefix='docimg:', ttl=RESULT_TTL):
+        self.redis = connection
+        self.root = root
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, job_id):
+        return self.prefix + 'job:' + job_id
+
+    def _write(self, job_id, fields):
+        key = self._key(job_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(key, mapping=fields)
+        if self.ttl:
+            pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def profile_path(self, job_id, create=False):
+        folder = os.path.join(self.root, 'profiles', job_id[:2])
+        if create:
+            os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, job_id + '.prof')
+
+    def put_result(self, job_id, data):
+        self._write(job_id, {'result': bytes(data)})
+
+    def put_status(self, job_id, status, meta):
+        self._write(job_id, {'status': status, 'meta': json.dumps(meta, ensure_ascii=False)})
+
+    def commit(self, job_id, data, meta):
+        self._write(job_id, {'result': bytes(data), 'status': 'finished',
+                             'meta': json.dumps(meta, ensure_ascii=False)})
+
+    def put_batch(self, batch_id, job_ids):
+        self.redis.set(self.prefix + 'batch:' + batch_id, json.dumps(job_ids), ex=self.ttl or None)
+
+    def get_batch(self, batch_id):
+        if not _valid_id(batch_id):
+            return None
+        raw = self.redis.get(self.prefix + 'batch:' + batch_id)
+        return json.loads(raw) if raw is not None else None
+
+    def result_ref(self, job_id):
+        data = self.read_result(job_id)
+        return BlobRef(None, 0, len(data), data) if data is not None else None
+
+    def read_result(self, job_id):
+        if not _valid_id(job_id):
+            return None
+        return self.redis.hget(self._key(job_id), 'result')
+
+    def get_meta(self, job_id):
+        return self.get_status(job_id)[1]
+
+    def get_status(self, job_id):
+        if not _valid_id(job_id):
+            return None, {}
+        status, meta, has_result = self.redis.pipeline().hget(self._key(job_id), 'status').hget(
+            self._key(job_id), 'meta').hexists(self._key(job_id), 'result').execute()
+        status = status.decode('utf-8') if status else ('finished' if has_result else None)
+        if status == 'finished' and not has_result:
+            status = 'processing'
+        try:
+            meta = json.loads(meta) if meta else {}
+        except ValueError:
+            meta = {}
+        return status, meta if isinstance(meta, dict) else {}
+
+    def delete(self, job_id):
+        if not _valid_id(job_id):
+            return 0
+        removed = self.redis.delete(self._key(job_id), self.prefix + 'batch:' + job_id)
+        p = self.profile_path(job_id)
+        if os.path.exists(p):
+            os.remove(p)
+            removed += 1
+        return removed
+
+
+def redis_connection(url=None):
+    from redis import Redis
+    return Redis.from_url(url or REDIS_URL)
+
+
+def open_store(root, kind=None):
+    """Store for ``root``; ``kind`` defaults to the RESULT_STORE variable."""
+    kind = (kind or os.getenv('RESULT_STORE', '') or 'flat').strip().lower()
+    if kind == 'flat':
+        return FileStore(root)
+    if kind == 'sharded':
+        return FileStore(root, shard=True)
+    if kind == 'pack':
+        return PackStore(root)
+    if kind == 'redis':
+        return RedisStore(redis_connection(), root)
+    raise ValueError('Unknown RESULT_STORE: {}'.format(kind))
+
+
+def main():
+    parser = ArgumentParser(description='maintain the packed result store')
+    parser.add_argument('command', choices=['compact'], help='compact: drop deleted and superseded data')
+    parser.add_argument('--root', default=os.path.join('web', 'results'), help='results folder')
+    args = parser.parse_args()
+    store = PackStore(args.root)
+    before = sum(os.path.getsize(os.path.join(store.dir, n)) for n in os.listdir(store.dir))
+    kept = store.compact()
+    after = sum(os.path.getsize(os.path.join(store.dir, n)) for n in os.listdir(store.dir))
+    print('{} jobs kept, {:.1f} MB -> {:.1f} MB'.format(kept, before / 2 ** 20, after / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,20 +3,55 @@ import numpy as np
 import cv2
 import time
 import json
+import io
+import random
+import threading
+import cProfile
+import hashlib
+import pstats
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from rq import get_current_job
 
 # Import existing processing functions
 from function_method.DocBleach import sauvola_threshold
-from function_method.TextOrientationCorrection import eval_angle
-from function_method.HandwritingDenoisingBeautifying import docscan_main, get_argument_parser
+from function_method.TextOrientationCorrection import eval_angle, estimate_angle, rotation_matrix
+from function_method.HandwritingDenoisingBeautifying import (
+    docscan_main,
+    get_argument_parser,
+    get_palette_fast,
+    merge_page_samples,
+    sample_pixels_seeded,
+)
 from function_method.DocShadowRemoval import removeShadow
-from function_method.DocSharpening import doc_sharpening_pred, img_enh
-from function_method.DocTrimmingEnhancement import doc_trimming_enhancement_pred
-from function_method.document_image_dewarping.correct import dewarping_pred
+from function_method.DocSharpening import MAX_OUTPUT_PIXELS, doc_sharpening_pred
+from function_method.DocTrimmingEnhancement import (
+    doc_trimming_enhancement_corners,
+    doc_trimming_enhancement_pred,
+    perspective_from_corners,
+)
+from function_method.document_image_dewarping.correct import bm_to_numpy, dewarping_pred, predict_bm
+from web.ingest import decode_image
+from web.storage import open_store
+from web.pipeline import (
+    apply_geometry,
+    convert_for_step,
+    fuse_geometry,
+    grid_transform,
+    image_format,
+    make_proxy,
+    new_stats,
+    perspective_transform,
+    plan_pipeline,
+    run_plan,
+    StepCache,
+)
 
 
 RESULT_DIR = os.path.join('web', 'results')
 os.makedirs(RESULT_DIR, exist_ok=True)
+# results, status and meta of async jobs (layout from RESULT_STORE)
+STORE = open_store(RESULT_DIR)
 
 SUPPORTED_ACTIONS = (
     "bleach",
@@ -27,6 +62,61 @@ SUPPORTED_ACTIONS = (
     "dewarp",
     "trim",
 )
+# steps whose result depends on the input resolution: no pixel budget
+FULL_RES_ACTIONS = ("sharpen",)
+
+
+# Steps whose work is a geometric decision; proxy mode takes the decision on
+# a downscaled copy and warps the full-resolution image once.
+GEOMETRIC_ACTIONS = ("trim", "orientation", "dewarp")
+ORIENTATION_RANGE = [-30, 30]
+PROXY_MAX_SIDE = int(os.getenv("PROXY_MAX_SIDE", "1200"))
+
+# Percentage of jobs profiled without being asked for (0 disables sampling)
+PROFILE_SAMPLE_PERCENT = float(os.getenv("PROFILE_SAMPLE_PERCENT", "0"))
+# cProfile can only run one profile at a time per interpreter
+_profile_lock = threading.Lock()
+
+# Preview mode of /process: the pipeline runs on a proxy sized so that it
+# takes about PREVIEW_TARGET_MS, between PREVIEW_MIN_PIXELS and PREVIEW_PIXELS
+PREVIEW_TARGET_MS = float(os.getenv("PREVIEW_TARGET_MS", "500"))
+PREVIEW_PIXELS = int(os.getenv("PREVIEW_PIXELS", str(1_000_000)))
+PREVIEW_MIN_PIXELS = 250_000
+# action -> seconds per pixel, smoothed over previous previews; previews run
+# on threadpool workers, so reads and updates hold _preview_lock
+_preview_rates = {}
+_preview_lock = threading.Lock()
+
+# Intermediate results by input hash + pipeline prefix, so that trying
+# "trim|orientation|bleach" after "trim|orientation|denoise" only runs bleach.
+# Off by default: every cached run hashes its input and copies each step
+# output, which only pays off when the same images are processed again.
+STEP_CACHE_MB = int(os.getenv("STEP_CACHE_MB", "0"))
+STEP_CACHE = StepCache(STEP_CACHE_MB << 20) if STEP_CACHE_MB > 0 else None
+# most leaves one pipeline tree (see parse_tree) may fan out to
+MAX_TREE_LEAVES = int(os.getenv("MAX_TREE_LEAVES", "16"))
+
+# Tunable parameters per action: name -> (type, default, minimum, maximum or None)
+ACTION_OPTIONS = {
+    # the window bounds the padded integral images Sauvola allocates
+    "bleach": {
+        "window_size": (int, 15, 1, 255),
+        "k": (float, 0.2, 0.0, None),
+        "r": (float, 128.0, 1.0, None),
+    },
+    # 0 estimates the background at full resolution
+    "shadow": {
+        "bg_max_side": (int, 0, 0, None),
+    },
+    # Upscale is x3 unless dpi/target_dpi ask otherwise; the output-pixel cap
+    # (at most MAX_OUTPUT_PIXELS) falls back to a smaller scale or skips the
+    # upscale.
+    "sharpen": {
+        "max_output_pixels": (int, MAX_OUTPUT_PIXELS, 1, MAX_OUTPUT_PIXELS),
+        "dpi": (int, 0, 0, None),
+        "target_dpi": (int, 0, 0, None),
+    },
+}
 
 
 def get_supported_actions():
@@ -46,30 +136,285 @@ def parse_actions(action: str):
     return steps
 
 
-def process_image_bytes(data: bytes, action: str) -> bytes:
-    """Synchronous helper that returns JPEG bytes (used by /process)."""
-    nparr = np.frombuffer(data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+def _split_branches(text: str):
+    """Split ``text`` on the commas outside braces."""
+    parts, depth, start = [], 0, 0
+    for i, ch in enumerate(text):
+        if ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth < 0:
+                raise ValueError("Unbalanced braces in pipeline tree")
+        elif ch == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    if depth:
+        raise ValueError("Unbalanced braces in pipeline tree")
+    parts.append(text[start:])
+    return parts
+
+
+def _tree_leaves(text: str):
+    text = text.strip()
+    head, sep, tail = text.partition("->")
+    if not sep and text.startswith("{"):
+        head, tail = "", text
+    elif not sep:
+        if "{" in text or "}" in text:
+            raise ValueError(f"Expected '->' before the branches in: {text}")
+        return [parse_actions(text)]
+    if "{" in head or "}" in head:
+        raise ValueError(f"Expected '->' before the branches in: {head.strip()}")
+    prefix = parse_actions(head) if head.strip() else []
+    tail = tail.strip()
+    if tail.startswith("{"):
+        if len(_split_branches(tail)) != 1 or not tail.endswith("}"):
+            raise ValueError(f"Unexpected text after the branches in: {tail}")
+        branches = _split_branches(tail[1:-1])
+    else:
+        branches = [tail]
+    return [prefix + leaf for branch in branches for leaf in _tree_leaves(branch)]
+
+
+def parse_tree(spec: str):
+    """Leaf pipelines of a pipeline tree, as step lists.
+
+    ``trim|orientation -> {bleach, denoise, shadow|sharpen}`` runs
+    ``trim|orientation`` once and fans out to three leaves; branches may
+    nest (``trim -> {orientation -> {bleach, denoise}, sharpen}``) and
+    ``{bleach, denoise}`` fans out straight from the input. A spec without
+    ``->`` or braces is a single pipeline, as parse_actions reads it;
+    inside braces commas separate branches, not steps.
+    Duplicate leaves are dropped.
+    """
+    if not isinstance(spec, str):
+        raise ValueError("Pipeline tree must be a string")
+    leaves = []
+    for leaf in _tree_leaves(spec):
+        if leaf not in leaves:
+            leaves.append(leaf)
+    if len(leaves) > MAX_TREE_LEAVES:
+        raise ValueError(f"Too many pipelines in tree: {len(leaves)} (max {MAX_TREE_LEAVES})")
+    return leaves
+
+
+def get_action_options():
+    return {
+        action: {name: default for name, (_, default, _, _) in params.items()}
+        for action, params in ACTION_OPTIONS.items()
+    }
+
+
+def parse_options(options):
+    """Validate per-action options, e.g. {"bleach": {"window_size": 25}}.
+
+    Accepts a dict, a JSON string, or None/"" for no options.
+    """
+    if options is None or options == "":
+        return {}
+    if isinstance(options, str):
+        try:
+            options = json.loads(options)
+        except ValueError:
+            raise ValueError("Options must be a JSON object")
+    if not isinstance(options, dict):
+        raise ValueError("Options must be a JSON object")
+    parsed = {}
+    for action, params in options.items():
+        if action not in ACTION_OPTIONS:
+            raise ValueError(f"Action has no options: {action}")
+        if not isinstance(params, dict):
+            raise ValueError(f"Options for {action} must be an object")
+        parsed[action] = {}
+        for name, value in params.items():
+            if name not in ACTION_OPTIONS[action]:
+                raise ValueError(f"Unknown option for {action}: {name}")
+            typ, _, minimum, maximum = ACTION_OPTIONS[action][name]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"Option {action}.{name} must be a number")
+            if typ is int and value != int(value):
+                raise ValueError(f"Option {action}.{name} must be an integer")
+            value = typ(value)
+            if not value >= minimum:
+                raise ValueError(f"Option {action}.{name} must be >= {minimum}")
+            if maximum is not None and not value <= maximum:
+                raise ValueError(f"Option {action}.{name} must be <= {maximum}")
+            parsed[action][name] = value
+    return parsed
+
+
+def _denoise_options():
+    return get_argument_parser().parse_args([])
+
+
+def palette_samples(img, index: int = 0):
+    """Denoise palette samples of one page of a batch (seeded by its index)."""
+    options = _denoise_options()
+    rng = np.random.default_rng([options.seed, index])
+    return sample_pixels_seeded(convert_for_step(img, "denoise"), options, rng)
+
+
+def build_batch_palette(page_samples):
+    """One denoise palette for a whole batch, as a JSON-friendly list.
+
+    Like the CLI's -g option the samples come from the pages as uploaded,
+    so colours match exactly when only geometric steps precede denoise.
+    """
+    if not page_samples:
+        return None
+    options = _denoise_options()
+    rng = np.random.default_rng(options.seed)
+    return get_palette_fast(merge_page_samples(page_samples), options, rng).tolist()
+
+
+def should_profile(requested: bool = False):
+    """"requested" when the client asked for a profile, "sampled" for a
+    sample of all jobs (PROFILE_SAMPLE_PERCENT), None for no profile.
+
+    Requested profiles wait while another job is being profiled; sampled
+    ones are skipped instead.
+    """
+    if requested:
+        return "requested"
+    return "sampled" if random.random() * 100 < PROFILE_SAMPLE_PERCENT else None
+
+
+def profile_path(job_id: str):
+    return STORE.profile_path(job_id)
+
+
+def _profiled_dispatch(job_id, img, *args, wait=False, **kwargs):
+    """Run _dispatch_image under cProfile and save <job_id>.prof next to the
+    meta. Returns (out, summary). While another job is being profiled this
+    waits for it with ``wait``, otherwise it runs unprofiled and summary is
+    None. Work done on worker threads (tiles, bands) shows up as time spent
+    waiting for the pool."""
+    if not _profile_lock.acquire(blocking=wait):
+        return _dispatch_image(img, *args, **kwargs), None
+    try:
+        prof = cProfile.Profile()
+        try:
+            out = prof.runcall(_dispatch_image, img, *args, **kwargs)
+        finally:
+            path = STORE.profile_path(job_id, create=True)
+            prof.dump_stats(path + '.tmp')
+            os.replace(path + '.tmp', path)
+    finally:
+        _profile_lock.release()
+    return out, profile_summary(job_id)
+
+
+def profile_summary(job_id: str, limit: int = 10):
+    """Top functions of a saved profile by cumulative time."""
+    stats = pstats.Stats(profile_path(job_id))
+    rows = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:limit]
+    return {
+        "url": f"/profile/{job_id}",
+        "total_ms": int(stats.total_tt * 1000),
+        "top": [
+            {
+                "function": f"{os.path.basename(fn)}:{line}({name})",
+                "calls": nc,
+                "tottime_ms": round(tt * 1000, 1),
+                "cumtime_ms": round(ct * 1000, 1),
+            }
+            for (fn, line, name), (_, nc, tt, ct, _) in rows
+        ],
+    }
+
+
+def profile_report(job_id: str, limit: int = 50) -> str:
+    """pstats text report of a saved profile, sorted by cumulative time."""
+    stream = io.StringIO()
+    stats = pstats.Stats(profile_path(job_id), stream=stream)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return stream.getvalue()
+
+
+def decode_input(data: bytes, steps, max_pixels=None):
+    """Decode an upload for ``steps`` within the input limits (see
+    web.ingest); the pixel budget ``max_pixels`` (default
+    INPUT_PIXEL_BUDGET) only applies if no step needs full resolution.
+    Returns (image or None, info); raises ingest.ImageTooLarge."""
+    full_res = any(step in FULL_RES_ACTIONS for step in steps)
+    return decode_image(data, max_pixels, full_res)
+
+
+def process_image_bytes(
+    data: bytes,
+    action: str,
+    proxy_analysis: bool = False,
+    options=None,
+    profile_id=None,
+    ext: str = '.jpg',
+    max_pixels=None,
+    profile_wait: bool = True,
+) -> bytes:
+    """Synchronous helper that returns JPEG bytes (used by /process).
+
+    ``data`` is an encoded image (decoded with ``decode_input`` and
+    ``max_pixels``), or one the caller already decoded. With ``profile_id``
+    the dispatch is profiled into <profile_id>.prof (waiting for a profile
+    in progress unless ``profile_wait`` is false); ``ext`` picks another
+    cv2.imencode format (e.g. '.png').
+    """
+    if isinstance(data, np.ndarray):
+        img = data
+    else:
+        img, _ = decode_input(data, parse_actions(action), max_pixels)
     if img is None:
         raise ValueError('Invalid image')
 
-    out = _dispatch_image(img, action)
-    # encode to jpg bytes
-    if len(out.shape) == 2:
-        ok, buf = cv2.imencode('.jpg', out)
+    if profile_id:
+        out, _ = _profiled_dispatch(profile_id, img, action, proxy_analysis=proxy_analysis, options=options,
+                                    wait=profile_wait)
     else:
-        ok, buf = cv2.imencode('.jpg', out[:, :, ::-1])
+        out = _dispatch_image(img, action, proxy_analysis=proxy_analysis, options=options)
+    # encode to jpg bytes (the planner already delivers BGR / gray uint8)
+    ok, buf = cv2.imencode(ext, out)
     if not ok:
         raise RuntimeError('Failed to encode image')
     return buf.tobytes()
 
 
+def preview_budget(action: str) -> int:
+    """Proxy size in pixels expected to run ``action`` within
+    PREVIEW_TARGET_MS, from the speed of earlier previews."""
+    with _preview_lock:
+        rate = _preview_rates.get(action)
+    if not rate:
+        return PREVIEW_PIXELS
+    return int(min(PREVIEW_PIXELS, max(PREVIEW_MIN_PIXELS, PREVIEW_TARGET_MS / 1000.0 / rate)))
+
+
+def process_preview(data: bytes, action: str, proxy_analysis: bool = False, options=None):
+    """Run ``action`` on a downscaled proxy of ``data`` for a quick preview.
+
+    Returns (JPEG bytes, info) with the original and proxy size, or
+    (None, {}) if ``data`` is not an image. Steps that otherwise need full
+    resolution run on the proxy too; the full result comes from the job.
+    """
+    img, info = decode_image(data, preview_budget(action))
+    if img is None:
+        return None, {}
+    t0 = time.perf_counter()
+    out = _dispatch_image(img, action, proxy_analysis=proxy_analysis, options=options)
+    rate = (time.perf_counter() - t0) / float(img.shape[0] * img.shape[1])
+    with _preview_lock:
+        prev = _preview_rates.get(action)
+        _preview_rates[action] = rate if prev is None else 0.7 * prev + 0.3 * rate
+    ok, buf = cv2.imencode('.jpg', out)
+    if not ok:
+        raise RuntimeError('Failed to encode image')
+    return buf.tobytes(), info
+
+
 def process_job(data: bytes, action: str):
     """Legacy RQ-compatible job (keeps behavior similar to BG job)."""
     # For compatibility, generate an id
     job_id = None
-    nparr = np.frombuffer(data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+    img, _ = decode_input(data, parse_actions(action))
     if img is None:
         raise ValueError('Invalid image')
 
@@ -77,104 +422,435 @@ def process_job(data: bytes, action: str):
 
     # write JPEG to disk
     result_path = os.path.join(RESULT_DIR, f'{job_id or "unknown"}.jpg')
-    if len(out.shape) == 2:
-        cv2.imwrite(result_path, out)
-    else:
-        cv2.imwrite(result_path, out[:, :, ::-1])
+    cv2.imwrite(result_path, out)
     return {'result_path': result_path}
 
 
-def _dispatch_image(img, action: str):
-    out = img
-    for step in parse_actions(action):
-        out = _dispatch_single(out, step)
-    return out
+class Pipeline:
+    """A pipeline compiled once from an action list, for in-process use.
+
+    ``actions`` is a list of steps or an action string ("trim|orientation").
+    Actions and options are validated here; execution plans are built once
+    per input format (see pipeline.plan_pipeline) and reused.
+
+    ``run`` takes an ndarray (BGR / gray, as cv2 decodes) or encoded bytes
+    and returns a BGR or gray uint8 array, or encoded bytes when ``encode``
+    is set (e.g. '.png'). Bytes are decoded within ``max_pixels`` (see
+    decode_input). ``map`` streams an iterable through a thread pool.
+
+    Step outputs go to ``cache`` (a pipeline.StepCache; True for the shared
+    STEP_CACHE, False for none) and a later run on the same input resumes
+    after the longest pipeline prefix found there.
+    """
+
+    def __init__(self, actions, options=None, proxy_analysis: bool = False, palette=None, encode=None,
+                 max_pixels=None, cache=True):
+        if not isinstance(actions, str):
+            actions = "|".join(actions)
+        self.steps = parse_actions(actions)
+        self.options = parse_options(options)
+        self.proxy_analysis = proxy_analysis
+        self.palette = palette
+        self.encode = encode
+        self.max_pixels = max_pixels
+        self.cache = cache
+        self._plans = {}
 
+    def __repr__(self):
+        return f"Pipeline({'|'.join(self.steps)!r})"
 
-def _dispatch_single(img, action: str):
-    # Reuse existing functions; ensure channels where needed.
+    def _plan(self, fmt):
+        plan = self._plans.get(fmt)
+        if plan is None:
+            plan, _ = plan_pipeline(self.steps, fmt)
+            if self.proxy_analysis:
+                plan = fuse_geometry(plan, GEOMETRIC_ACTIONS)
+            self._plans[fmt] = plan
+        return plan
+
+    def _run_step(self, im, step):
+        return _dispatch_single(im, step, self.options.get(step), self.palette)
+
+    def _prefix_keys(self, plan, image=None):
+        """{plan index: cache key} after every step entry of ``plan``: the
+        input hash (if ``image`` is given) plus the plan prefix with the
+        options (and palette) of its steps."""
+        h = hashlib.blake2b(digest_size=16)
+        if image is not None:
+            h.update(repr((image.shape, image.dtype.str)).encode())
+            h.update(np.ascontiguousarray(image).data)
+        keys = {}
+        for i, (kind, name) in enumerate(plan):
+            h.update(repr((kind, name)).encode())
+            if kind == "convert":
+                continue
+            for step in ([name] if kind == "step" else name):
+                h.update(json.dumps(self.options.get(step), sort_keys=True).encode())
+                if step == "denoise" and self.palette is not None:
+                    h.update(json.dumps(self.palette).encode())
+            keys[i] = h.hexdigest()
+        return keys
+
+    def run(self, image, stats=None):
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            image, _ = decode_input(bytes(image), self.steps, self.max_pixels)
+            if image is None:
+                raise ValueError('Invalid image')
+        plan = self._plan(image_format(image))
+        cache = STEP_CACHE if self.cache is True else self.cache
+        keys = self._prefix_keys(plan, image) if cache else None
+        return self._run(image, plan, stats, cache, keys)
+
+    __call__ = run
+
+    def _run(self, image, plan, stats, cache, keys):
+        start, checkpoint = 0, None
+        if cache:
+            if stats is None:
+                stats = new_stats()
+            # resume after the longest prefix already computed
+            for i in sorted(keys, reverse=True):
+                hit = cache.get(keys[i])
+                if hit is not None:
+                    image, start = hit, i + 1
+                    stats["cached_steps"] = sum(1 for kind, _ in plan[:start] if kind != "convert")
+                    break
+
+            def checkpoint(i, out):
+                cache.put(keys[start + i], out)
+        out, _ = run_plan(image, plan[start:], self._run_step, stats, _dispatch_geometry, checkpoint)
+        if self.encode is None:
+            return out
+        ok, buf = cv2.imencode(self.encode, out)
+        if not ok:
+            raise RuntimeError('Failed to encode image')
+        return buf.tobytes()
+
+    def map(self, images, workers: int = 1, prefetch=None):
+        """Yield results for ``images`` in order.
+
+        Up to ``workers`` images are processed at once (the heavy steps
+        release the GIL) and at most ``prefetch`` (default 2 * workers) are
+        pulled from the iterable ahead of the consumer, so memory stays
+        bounded on long streams.
+        """
+        if workers <= 1:
+            for image in images:
+                yield self.run(image)
+            return
+        prefetch = max(prefetch or 2 * workers, 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for image in images:
+                pending.append(pool.submit(self.run, image))
+                if len(pending) >= prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def run_tree(image, leaves, options=None, proxy_analysis: bool = False, max_pixels=None, stats=None):
+    """Yield (leaf, output, error) for every leaf pipeline of ``leaves``
+    (see parse_tree) on one input.
+
+    ``image`` (bytes are decoded once, at full resolution if any leaf needs
+    it) goes through every shared prefix once. Only the outputs where the
+    tree branches are kept (see _SharedSteps), each until the last leaf
+    that resumes from it has run, so at most one image per branch point is
+    held besides the running pipeline. A leaf that fails yields (leaf,
+    None, exception) and the others still run. ``stats`` maps each leaf
+    ("trim|bleach") to its pipeline stats.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image, _ = decode_input(bytes(image), [step for leaf in leaves for step in leaf], max_pixels)
+        if image is None:
+            raise ValueError('Invalid image')
+    fmt = image_format(image)
+    pipelines = [Pipeline(leaf, options, proxy_analysis, cache=False) for leaf in leaves]
+    plans = [p._plan(fmt) for p in pipelines]
+    # every leaf has the same input, so the keys need not hash it
+    keys = [p._prefix_keys(plan) for p, plan in zip(pipelines, plans)]
+    shared = _SharedSteps(_branch_points(keys))
+    for leaf, pipeline, plan, leaf_keys in zip(leaves, pipelines, plans, keys):
+        leaf_stats = new_stats()
+        if stats is not None:
+            stats["|".join(leaf)] = leaf_stats
+        try:
+            out = pipeline._run(image, plan, leaf_stats, shared, leaf_keys)
+        except Exception as e:
+            yield leaf, None, e
+        else:
+            yield leaf, out, None
+        finally:
+            shared.release(leaf_keys.values())
+
+
+def _branch_points(keys):
+    """{key: number of leaves} for the prefixes where a tree branches:
+    shared by several leaves, and either the end of one of them or followed
+    by a step that fewer leaves share. ``keys`` holds the prefix keys of
+    every leaf (see Pipeline._prefix_keys)."""
+    counts = {}
+    for leaf_keys in keys:
+        for key in leaf_keys.values():
+            counts[key] = counts.get(key, 0) + 1
+    points = {}
+    for leaf_keys in keys:
+        chain = [leaf_keys[i] for i in sorted(leaf_keys)]
+        for i, key in enumerate(chain):
+            if counts[key] > 1 and (i + 1 == len(chain) or counts[chain[i + 1]] < counts[key]):
+                points[key] = counts[key]
+    return points
+
+
+class _SharedSteps:
+    """Step cache for run_tree: keeps only the outputs in ``refs`` (key ->
+    number of leaves that need it) and drops each once ``release`` has been
+    called for all of them. Like StepCache, arrays are copied in and out;
+    the last reader gets the stored array itself."""
+
+    def __init__(self, refs):
+        self.refs = dict(refs)
+        self.items = {}
+        self.peak = 0
+
+    def get(self, key):
+        img = self.items.get(key)
+        if img is None:
+            return None
+        if self.refs[key] == 1:
+            return self.items.pop(key)
+        return img.copy()
+
+    def put(self, key, img):
+        if key in self.refs and key not in self.items:
+            self.items[key] = img.copy()
+            self.peak = max(self.peak, len(self.items))
+
+    def release(self, keys):
+        for key in keys:
+            if key in self.refs:
+                self.refs[key] -= 1
+                if self.refs[key] <= 0:
+                    del self.refs[key]
+                    self.items.pop(key, None)
+
+
+def _dispatch_image(img, action: str, stats=None, proxy_analysis: bool = False, options=None, palette=None):
+    """Run the pipeline through the planner.
+
+    Colour order, dtype and channel count are tracked between steps and only
+    the conversions a step actually needs are inserted; the result is BGR or
+    gray uint8, ready for cv2.imencode. Pass a dict from
+    ``pipeline.new_stats()`` as ``stats`` to get copy/allocation counts.
+
+    With ``proxy_analysis`` consecutive geometric steps are decided on a
+    shared proxy and applied to the full-resolution image in one remap.
+    ``options`` holds per-action parameters (see ``parse_options``);
+    ``palette`` is a shared denoise palette (see ``build_batch_palette``).
+    """
+    return Pipeline(action, options, proxy_analysis, palette).run(img, stats)
+
+
+def _decide_geometry(img, action: str):
+    """Geometric decision for one step, in ``img`` pixel coordinates."""
+    if action == "orientation":
+        return estimate_angle(img, ORIENTATION_RANGE)
+    if action == "trim":
+        corners, _ = doc_trimming_enhancement_corners(img, channel_order='BGR')
+        return corners
+    if action == "dewarp":
+        return bm_to_numpy(predict_bm(img))
+    raise ValueError(f"Not a geometric action: {action}")
+
+
+def _geometry_transform(action: str, decision, in_size, scale: float = 1.0):
+    """Backward transform of ``decision`` (taken on an image ``scale`` times
+    the size of this one) for an input of ``in_size`` = (w, h)."""
+    if action == "orientation":
+        m_inv, size = rotation_matrix(in_size[0], in_size[1], decision)
+        return perspective_transform(m_inv, in_size, size, fill=255)
+    if action == "trim":
+        corners = [[x / scale, y / scale] for x, y in decision]
+        m, size = perspective_from_corners(corners)
+        return perspective_transform(np.linalg.inv(m), in_size, size, fill=0)
+    if action == "dewarp":
+        return grid_transform(decision, in_size, fill=0)
+    raise ValueError(f"Not a geometric action: {action}")
+
+
+def _dispatch_geometry(img, steps):
+    proxy, scale = make_proxy(img, PROXY_MAX_SIDE)
+    size = (img.shape[1], img.shape[0])
+    transforms = []
+    for i, step in enumerate(steps):
+        decision = _decide_geometry(proxy, step)
+        t = _geometry_transform(step, decision, size, scale)
+        transforms.append(t)
+        size = t["size"]
+        if i + 1 < len(steps):
+            # the next decision is taken on the proxy as this step leaves it
+            proxy_size = (proxy.shape[1], proxy.shape[0])
+            proxy = apply_geometry(proxy, [_geometry_transform(step, decision, proxy_size)])
+    return apply_geometry(img, transforms)
+
+
+def _dispatch_single(img, action: str, params=None, palette=None):
+    # Reuse existing functions; the planner has already converted the input
+    # to the format declared in pipeline.STEP_SPECS.
+    params = params or {}
     if action == "bleach":
-        return sauvola_threshold(img)
+        return sauvola_threshold(img, **params)
     if action == "orientation":
-        out, _ = eval_angle(img, [-30, 30])
+        out, _ = eval_angle(img, ORIENTATION_RANGE)
         return out
     if action == "sharpen":
-        out = doc_sharpening_pred(img)
-        out = img_enh(out)
-        return out
+        return doc_sharpening_pred(img, enh='usm', **params)
     if action == "denoise":
-        return docscan_main(img, get_argument_parser().parse_args([]))
+        if palette is not None:
+            palette = np.asarray(palette, dtype=np.uint8)
+        return docscan_main(img, _denoise_options(), palette)
     if action == "shadow":
-        return removeShadow(img)
+        return removeShadow(img, **params)
     if action == "dewarp":
         return dewarping_pred(img)
     if action == "trim":
-        if len(img.shape) == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-        if img.shape[2] == 4:
-            img = img[:, :, :3]
-        img = img[:, :, ::-1]
-        return doc_trimming_enhancement_pred(img)
+        return doc_trimming_enhancement_pred(img, channel_order='BGR')
     raise ValueError(f"Unknown action: {action}")
 
 
-def process_job_bg(job_id: str, data: bytes, action: str):
-    """BackgroundTasks target: write status file, process and save result JPEG."""
-    status_path = os.path.join(RESULT_DIR, f'{job_id}.status')
-    result_path = os.path.join(RESULT_DIR, f'{job_id}.jpg')
-    temp_result_path = os.path.join(RESULT_DIR, f'{job_id}.jpg.tmp')
-    meta_path = os.path.join(RESULT_DIR, f'{job_id}.meta.json')
+def process_job_bg(
+    job_id: str,
+    data: bytes,
+    action: str,
+    proxy_analysis: bool = False,
+    options=None,
+    palette=None,
+    profile: bool = False,
+    max_pixels=None,
+):
+    """BackgroundTasks target: record status, process and store result JPEG.
+
+    With ``profile`` (see should_profile; "sampled" profiles are skipped
+    while another job is being profiled) the dispatch runs under cProfile
+    and the meta links the profile once it is saved. ``max_pixels`` is the
+    ingest pixel budget (see decode_input).
+    """
     t0 = time.perf_counter()
+    stats = new_stats()
+    profiled = {}
+    ingest = {}
 
-    def _write_meta(status: str, error: str = ""):
+    def _meta(status: str, error: str = ""):
         elapsed_ms = int((time.perf_counter() - t0) * 1000)
         payload = {
             "id": job_id,
             "action": action,
             "status": status,
             "elapsed_ms": elapsed_ms,
+            "updated_at": time.time(),
         }
+        if proxy_analysis:
+            payload["proxy_analysis"] = True
+        if options:
+            payload["options"] = options
+        if palette is not None:
+            payload["global_palette"] = palette
         if error:
             payload["error"] = error
-        with open(meta_path, "w", encoding="utf-8") as mf:
-            json.dump(payload, mf, ensure_ascii=False)
+        if status == "finished":
+            payload["pipeline"] = stats
+        if profiled:
+            payload["profile"] = profiled
+        if ingest:
+            payload["input"] = ingest
+        return payload
 
     try:
-        with open(status_path, 'w', encoding='utf-8') as f:
-            f.write('processing')
-        _write_meta("processing")
+        STORE.put_status(job_id, "processing", _meta("processing"))
 
-        nparr = np.frombuffer(data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+        img, info = decode_input(data, parse_actions(action), max_pixels)
+        ingest.update(info)
         if img is None:
-            with open(status_path, 'w', encoding='utf-8') as f:
-                f.write('error')
-            _write_meta("error", "Invalid image")
+            STORE.put_status(job_id, "error", _meta("error", "Invalid image"))
             return
 
-        out = _dispatch_image(img, action)
-
-        # Encode to JPEG bytes first, then atomically replace target file.
-        # This avoids OpenCV writer detection issues with temporary suffixes.
-        if len(out.shape) == 2:
-            ok, buf = cv2.imencode(".jpg", out)
+        if profile:
+            out, summary = _profiled_dispatch(job_id, img, action, stats, proxy_analysis, options, palette,
+                                              wait=profile != "sampled")
+            profiled.update(summary or {"skipped": "another job was being profiled"})
         else:
-            ok, buf = cv2.imencode(".jpg", out[:, :, ::-1])
+            out = _dispatch_image(img, action, stats, proxy_analysis, options, palette)
+
+        # Encode to JPEG bytes first; the store commits result and status
+        # atomically.
+        ok, buf = cv2.imencode(".jpg", out)
         if not ok:
             raise RuntimeError("Failed to encode result image")
-        with open(temp_result_path, "wb") as wf:
-            wf.write(buf.tobytes())
-        os.replace(temp_result_path, result_path)
+        STORE.commit(job_id, buf.tobytes(), _meta("finished"))
+    except Exception as e:
+        # a profile is most useful for the jobs that fail
+        if profile and not profiled and os.path.exists(profile_path(job_id)):
+            profiled.update(profile_summary(job_id))
+        STORE.put_status(job_id, "error", _meta("error", str(e)))
+
+
+def process_tree_bg(
+    tree_id: str,
+    job_ids,
+    data: bytes,
+    leaves,
+    proxy_analysis: bool = False,
+    options=None,
+    max_pixels=None,
+):
+    """Queue target for a pipeline tree (see parse_tree): decode once, run
+    every shared prefix once and store each leaf's JPEG under the matching
+    id of ``job_ids``."""
+    t0 = time.perf_counter()
+    stats = {}
+    ingest = {}
+    pending = {"|".join(leaf): job_id for leaf, job_id in zip(leaves, job_ids)}
+
+    def _meta(job_id: str, action: str, status: str, error: str = ""):
+        payload = {
+            "id": job_id,
+            "action": action,
+            "tree": tree_id,
+            "status": status,
+            "elapsed_ms": int((time.perf_counter() - t0) * 1000),
+            "updated_at": time.time(),
+        }
+        if proxy_analysis:
+            payload["proxy_analysis"] = True
+        if options:
+            payload["options"] = options
+        if error:
+            payload["error"] = error
+        if status == "finished":
+            payload["pipeline"] = stats.get(action)
+        if ingest:
+            payload["input"] = ingest
+        return payload
 
-        with open(status_path, 'w', encoding='utf-8') as f:
-            f.write('finished')
-        _write_meta("finished")
+    try:
+        for action, job_id in pending.items():
+            STORE.put_status(job_id, "processing", _meta(job_id, action, "processing"))
+        img, info = decode_input(data, [step for leaf in leaves for step in leaf], max_pixels)
+        ingest.update(info)
+        if img is None:
+            raise ValueError("Invalid image")
+        for leaf, out, error in run_tree(img, leaves, options, proxy_analysis, stats=stats):
+            action = "|".join(leaf)
+            job_id = pending.pop(action)
+            if error is None:
+                ok, buf = cv2.imencode(".jpg", out)
+                if not ok:
+                    error = RuntimeError("Failed to encode result image")
+                else:
+                    STORE.commit(job_id, buf.tobytes(), _meta(job_id, action, "finished"))
+                    continue
+            STORE.put_status(job_id, "error", _meta(job_id, action, "error", str(error)))
     except Exception as e:
-        if os.path.exists(temp_result_path):
-            try:
-                os.remove(temp_result_path)
-            except OSError:
-                pass
-        with open(status_path, 'w', encoding='utf-8') as f:
-            f.write('error')
-        _write_meta("error", str(e))
+        for action, job_id in pending.items():
+            STORE.put_status(job_id, "error", _meta(job_id, action, "error", str(e)))
@@ -0,0 +1,305 @@
+"""Hot-folder service: process images as they appear in a watched folder.
+
+The input folder is polled (this also works on network shares where change
+notifications are unreliable). A file is picked up once its size and
+modification time have not changed for --settle seconds, then runs through
+the pipeline on the same worker pool as web.batch. Outputs and
+<name>.error.txt markers are written atomically to the output folder.
+
+Processed files are recorded in a checkpoint (path, size and mtime) that is
+saved atomically as work completes, so a restarted service skips everything
+it has already handled; a file that is replaced by a new scan is processed
+again. If a worker process dies, the pool is rebuilt and the files that were
+running are processed again; a file that is running every time a worker
+dies (MAX_WORKER_DEATHS) is marked as an error.
+
+Outputs are named by the input name without its extension. A file whose
+output another file in the input folder already writes (page1.png next to
+page1.jpg) is not processed; it gets a <name>.<ext>.error.txt marker.
+
+    python -m web.watch //scanner/share/inbox -a "trim|orientation|shadow" -o out -j 2
+"""
+import json
+import multiprocessing as mp
+import os
+import signal
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from web.batch import IMAGE_EXTS, _init_worker, _parse_options, _process_file, output_key, parse_steps
+
+CHECKPOINT_NAME = '.watch_checkpoint.json'
+# a file that was running this many times when a worker died is given up on
+MAX_WORKER_DEATHS = 3
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_checkpoint(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def write_error_marker(path, message):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(message + '\n')
+    os.replace(tmp, path)
+
+
+def _init_watch_worker(threads):
+    # Ctrl-C stops the service; the workers finish their current file.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(threads)
+
+
+def scan(folder, recursive, exclude=None):
+    """{relative path: (size, mtime)} of the images in ``folder``; the
+    ``exclude`` folder (the output, if it lives inside) is skipped."""
+    found = {}
+    for root, dirs, files in os.walk(folder):
+        if not recursive:
+            dirs[:] = []
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != exclude]
+        for name in files:
+            if not name.lower().endswith(IMAGE_EXTS):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # removed between listing and stat
+            found[os.path.relpath(path, folder)] = (st.st_size, st.st_mtime)
+    return found
+
+
+class Watcher:
+    # run in the workers
+    initializer = staticmethod(_init_watch_worker)
+    process_file = staticmethod(_process_file)
+
+    def __init__(self, args, options):
+        self.args = args
+        self.options = options
+        self.checkpoint_path = args.checkpoint or os.path.join(args.output, CHECKPOINT_NAME)
+        self.done = load_checkpoint(self.checkpoint_path)
+        if args.retry_errors:
+            self.done = {k: v for k, v in self.done.items() if v.get('status') != 'error'}
+        # rel -> (size, mtime, first time this state was seen)
+        self.pending = {}
+        self.running = {}
+        # output key (see batch.output_key) -> the file that writes it
+        self.owners = {output_key(rel): rel for rel, entry in self.done.items() if entry.get('status') == 'done'}
+        self.current = {}
+        # rel -> number of times a worker died while it was running
+        self.deaths = {}
+        self.dirty = False
+        self.stopping = False
+
+    def _output_paths(self, rel):
+        stem = os.path.join(self.args.output, os.path.splitext(rel)[0])
+        return stem + '.' + self.args.format, stem + '.error.txt'
+
+    def _is_done(self, rel, size, mtime):
+        entry = self.done.get(rel)
+        return entry is not None and entry.get('size') == size and entry.get('mtime') == mtime
+
+    def ready_files(self):
+        """Files whose size and mtime have settled and that are not done yet."""
+        now = time.time()
+        current = self.current = scan(self.args.input, self.args.recursive, os.path.abspath(self.args.output))
+        ready = []
+        for rel, (size, mtime) in current.items():
+            if rel in self.running or self._is_done(rel, size, mtime):
+                self.pending.pop(rel, None)
+                continue
+            seen = self.pending.get(rel)
+            if seen is None or seen[:2] != (size, mtime):
+                self.pending[rel] = (size, mtime, now)
+            elif now - seen[2] >= self.args.settle:
+                ready.append(rel)
+        for rel in list(self.pending):
+            if rel not in current:
+                del self.pending[rel]
+        return sorted(ready, key=lambda rel: self.pending[rel][2])
+
+    def claim(self, rel):
+        """Make ``rel`` the writer of its output, unless another file that
+        is still in the input folder writes it; returns that file or None."""
+        key = output_key(rel)
+        owner = self.owners.get(key)
+        if owner is not None and owner != rel and owner in self.current:
+            return owner
+        self.owners[key] = rel
+        return None
+
+    def reject(self, rel, size, mtime, owner):
+        out_path, _ = self._output_paths(rel)
+        err_path = os.path.join(self.args.output, rel + '.error.txt')
+        os.makedirs(os.path.dirname(err_path) or '.', exist_ok=True)
+        write_error_marker(err_path, 'OutputClash: {} is written by {}; rename one of them'.format(
+            os.path.basename(out_path), owner))
+        print('error: {}: same output as {}'.format(rel, owner))
+        self.done[rel] = {'size': size, 'mtime': mtime, 'status': 'error', 'time': time.time()}
+        self.dirty = True
+
+    def finish(self, rel, future):
+        size, mtime = self.running.pop(rel)
+        out_path, err_path = self._output_paths(rel)
+        try:
+            future.result()
+            status = 'done'
+            if os.path.exists(err_path):
+                os.remove(err_path)
+            print('done: {}'.format(rel))
+        except Exception as e:
+            status = 'error'
+            os.makedirs(os.path.dirname(err_path) or '.', exist_ok=True)
+            write_error_marker(err_path, '{}: {}'.format(type(e).__name__, e))
+            print('error: {}: {}'.format(rel, e))
+            if self.owners.get(output_key(rel)) == rel:
+                del self.owners[output_key(rel)]
+        self.deaths.pop(rel, None)
+        self.done[rel] = {'size': size, 'mtime': mtime, 'status': status, 'time': time.time()}
+        self.dirty = True
+
+    def requeue(self, rel, future):
+        """A worker died while ``rel`` was running: process it again on the
+        new pool, unless that keeps happening."""
+        self.deaths[rel] = self.deaths.get(rel, 0) + 1
+        if self.deaths[rel] >= MAX_WORKER_DEATHS:
+            self.finish(rel, future)
+            return
+        size, mtime = self.running.pop(rel)
+        # seen long ago: ready again as soon as a scan finds it unchanged
+        self.pending[rel] = (size, mtime, 0.0)
+        print('retry: {} (worker process died)'.format(rel))
+
+    def _new_pool(self, threads):
+        return ProcessPoolExecutor(max_workers=self.args.workers, mp_context=mp.get_context('spawn'),
+                                   initializer=self.initializer, initargs=(threads,))
+
+    def check_options(self, pool):
+        # --options is checked by a worker; the service does not import web.tasks
+        try:
+            self.options = pool.submit(_parse_options, self.options).result()
+        except ValueError as e:
+            sys.exit('error: invalid --options: {}'.format(e))
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self):
+        args = self.args
+        os.makedirs(args.output, exist_ok=True)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+        # keep a few files queued per worker, but never the whole backlog
+        max_in_flight = args.workers * 2
+        print('watching {} -> {} ({} checkpointed)'.format(args.input, args.output, len(self.done)))
+        pool = self._new_pool(threads)
+        try:
+            self.check_options(pool)
+            futures = {}
+            last_save = time.time()
+            while not self.stopping or futures:
+                broken = False
+                if not self.stopping and len(futures) < max_in_flight:
+                    for rel in self.ready_files()[:max_in_flight - len(futures)]:
+                        size, mtime, _ = self.pending.pop(rel)
+                        owner = self.claim(rel)
+                        if owner is not None:
+                            self.reject(rel, size, mtime, owner)
+                            continue
+                        out_path, _ = self._output_paths(rel)
+                        self.running[rel] = (size, mtime)
+                        try:
+                            future = pool.submit(self.process_file, os.path.join(args.input, rel), out_path,
+                                                 args.action, args.proxy_analysis, self.options,
+                                                 args.max_pixels)
+                        except BrokenProcessPool:
+                            del self.running[rel]
+                            self.pending[rel] = (size, mtime, 0.0)
+                            broken = True
+                            break
+                        futures[future] = rel
+                if futures and not broken:
+                    finished, _ = wait(futures, timeout=args.interval, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        if isinstance(future.exception(), BrokenProcessPool):
+                            broken = True
+                        else:
+                            self.finish(futures.pop(future), future)
+                elif not futures:
+                    time.sleep(args.interval)
+                if broken:
+                    # every file on the pool failed with it, not only the one
+                    # that killed the worker: run them again on a new pool
+                    print('worker process died, restarting the pool')
+                    pool.shutdown(wait=True)
+                    for future, rel in futures.items():
+                        if isinstance(future.exception(), BrokenProcessPool):
+                            self.requeue(rel, future)
+                        else:
+                            self.finish(rel, future)
+                    futures = {}
+                    if not self.stopping:
+                        pool = self._new_pool(threads)
+                if self.dirty and (time.time() - last_save >= 1.0 or self.stopping):
+                    save_checkpoint(self.checkpoint_path, self.done)
+                    self.dirty, last_save = False, time.time()
+        finally:
+            pool.shutdown(wait=True)
+        if self.dirty:
+            save_checkpoint(self.checkpoint_path, self.done)
+        print('stopped')
+
+
+def main():
+    parser = ArgumentParser(description='process images dropped into a folder')
+    parser.add_argument('input', help='folder to watch')
+    parser.add_argument('-a', '--action', required=True, help='pipeline, e.g. "trim|orientation|shadow"')
+    parser.add_argument('-o', '--output', required=True, help='output folder')
+    parser.add_argument('-f', '--format', default='jpg', choices=['jpg', 'png'], help='output format')
+    parser.add_argument('-j', '--workers', type=int, default=2, help='worker processes')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='OpenCV / torch threads per worker (default: cpus / workers)')
+    parser.add_argument('--options', default='', help='per-action options as JSON, as the web API takes')
+    parser.add_argument('--proxy-analysis', action='store_true', help='take geometric decisions on a proxy')
+    parser.add_argument('--max-pixels', type=int, default=None,
+                        help='pixel budget: decode larger inputs smaller (default: INPUT_PIXEL_BUDGET, 0 = off)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='watch subfolders too')
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help='seconds a file must stay unchanged before it is processed')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between folder scans')
+    parser.add_argument('--checkpoint', default=None,
+                        help='checkpoint file (default: %s in the output folder)' % CHECKPOINT_NAME)
+    parser.add_argument('--retry-errors', action='store_true', help='process files that failed before again')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.input):
+        parser.error('not a folder: {}'.format(args.input))
+    try:
+        parse_steps(args.action)
+    except ValueError as e:
+        parser.error(str(e))
+    Watcher(args, args.options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""RQ worker for QUEUE_BACKEND=rq.
+
+Loads the models once (by importing web.tasks) and then runs jobs from the
+queue in this process, so start as many workers per host as it has room
+for. Use the same RESULT_STORE (and REDIS_URL) as the web server:
+
+    set RESULT_STORE=redis
+    set REDIS_URL=redis://queue-host:6379/0
+    python -m web.worker --threads 4
+"""
+import os
+from argparse import ArgumentParser
+
+from web.jobqueue import RQ_QUEUE
+from web.storage import REDIS_URL, redis_connection
+
+
+def main():
+    parser = ArgumentParser(description='run processing jobs from the RQ queue')
+    parser.add_argument('--url', default=REDIS_URL, help='Redis URL (default: REDIS_URL)')
+    parser.add_argument('--queue', default=RQ_QUEUE, help='queue name (default: RQ_QUEUE)')
+    parser.add_argument('--threads', type=int, default=0, help='OpenCV / torch threads (default: all cpus)')
+    parser.add_argument('--burst', action='store_true', help='quit once the queue is empty')
+    args = parser.parse_args()
+
+    import cv2
+    from rq import Queue, SimpleWorker
+
+    threads = args.threads or os.cpu_count() or 1
+    cv2.setNumThreads(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    # models load here, once; SimpleWorker runs jobs without forking
+    from web import tasks  # noqa: F401
+    connection = redis_connection(args.url)
+    worker = SimpleWorker([Queue(args.queue, connection=connection)], connection=connection)
+    worker.work(burst=args.burst)
+
+
+if __name__ == '__main__':
+    main()